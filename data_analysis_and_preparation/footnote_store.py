@@ -0,0 +1,87 @@
+#####
+# Typed columnar copy of the footnote_df (parquet)
+# scripts that only need a few columns (e.g. letter_id and n_footnote) don't have to parse the whole csv
+
+# pyarrow is imported in the functions, without it the csv is read (read_footnote_df)
+
+import argparse
+import os
+import pandas as pd
+
+DICTIONARY_COLUMNS = ["edition", "label"]
+NULLABLE_COLUMNS = ["n_sentence", "pos_footnote"]
+
+
+def footnote_schema():
+    """columns of the footnote_df with their types, strings with few distinct values are dictionary encoded"""
+    import pyarrow as pa
+    return pa.schema([
+        ("letter_id", pa.int32()),
+        ("edition", pa.dictionary(pa.int32(), pa.string())),
+        ("n_footnote", pa.int32()),
+        ("n_sentence", pa.int32()),
+        ("xml_footnote", pa.string()),
+        ("xml_sentence", pa.string()),
+        ("text_footnote", pa.string()),
+        ("text_sentence", pa.string()),
+        ("len_footnote", pa.int32()),
+        ("pos_footnote", pa.int32()),
+        ("label", pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+
+def parquet_path_for(csv_path):
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+
+def footnote_df_to_parquet(csv_path, parquet_path=None):
+    """write the typed parquet version of a footnote_df csv (by default next to the csv)"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if parquet_path is None:
+        parquet_path = parquet_path_for(csv_path)
+
+    # edition as string, otherwise '01' becomes 1
+    footnote_df = pd.read_csv(csv_path, dtype={"edition": str, "label": str})
+    # pos_footnote is "NaN" if the footnote was not found in the sentence, thus nullable integers
+    for column in NULLABLE_COLUMNS:
+        values = pd.to_numeric(footnote_df[column], errors="coerce")
+        unparsable = values.isna() & footnote_df[column].notna()
+        if unparsable.any():
+            raise ValueError(f"{unparsable.sum()} values of {column} are not numbers, e.g. {footnote_df.loc[unparsable, column].iloc[0]!r}")
+        footnote_df[column] = values.astype("Int32")
+    for column in DICTIONARY_COLUMNS:
+        footnote_df[column] = footnote_df[column].astype("category")
+
+    table = pa.Table.from_pandas(footnote_df, schema=footnote_schema(), preserve_index=False)
+    pq.write_table(table, parquet_path, use_dictionary=DICTIONARY_COLUMNS, compression="zstd")
+    print(f"wrote {table.num_rows} footnotes to {parquet_path}")
+    return parquet_path
+
+
+def read_footnote_df(path, columns=None, memory_map=True):
+    """read the footnote_df, only the columns specified
+    path can point to the .parquet or the .csv file, if the parquet file does not exist (yet) the csv is read"""
+    parquet_path = parquet_path_for(path)
+    csv_path = os.path.splitext(path)[0] + ".csv"
+    if os.path.exists(parquet_path):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            print(f"pyarrow not installed, reading {csv_path}")
+            return pd.read_csv(csv_path, usecols=columns)
+        table = pq.read_table(parquet_path, columns=columns, memory_map=memory_map)
+        return table.to_pandas()
+
+    print(f"{parquet_path} not found, reading {csv_path}")
+    return pd.read_csv(csv_path, usecols=columns)
+
+
+if __name__ == "__main__":
+    # example call: python footnote_store.py ../../data/footnote_downsized_df.csv
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csv_path", help="footnote_df csv, as created by parse_bullinger.py")
+    parser.add_argument("--parquet_path", default=None, help="where to write the parquet file, default is next to the csv")
+    args = parser.parse_args()
+
+    footnote_df_to_parquet(args.csv_path, args.parquet_path)
@@ -4,6 +4,12 @@ from html import unescape  # from xml.sax.saxutils import unescape ->> does not
 from tqdm import tqdm
 from lxml import etree
 import argparse
+import tempfile, time, hashlib, copy
+from multiprocessing import Pool
+from footnote_store import footnote_df_to_parquet
+
+TEI = "{http://www.tei-c.org/ns/1.0}"  # namespace prefix for tags when using .iter
+CACHE_VERSION = 1  # bump when the parsing of the letters changes, to invalidate the cached shards
 
 def make_id_to_edition_map(infolder):
     id_to_edition = {}
@@ -16,8 +22,31 @@ def make_id_to_edition_map(infolder):
     return id_to_edition
 
 
-def count_fns_in_letter(root):
-    footnotes = root.findall(".//note[@type='footnote']", {None: 'http://www.tei-c.org/ns/1.0'})
+def sentence_index(root):
+    """single pass over the notes of a letter
+    returns the footnotes (in document order) and a map from the n attribute of every note
+    to the <s> elements containing it (same as .//tei:s[descendant::tei:note[@n='n']], but without rescanning the tree)"""
+    footnotes = []
+    note_to_sentences = {}
+    for note in root.iter(f"{TEI}note"):
+        if note.get("type") == "footnote":
+            footnotes.append(note)
+
+        n = note.get("n")
+        if n is None:
+            continue
+        sentences = note_to_sentences.setdefault(n, [])
+        for sentence in note.iterancestors(f"{TEI}s"):
+            if not any(sentence is s for s in sentences):  # same sentence can contain several notes with the same n
+                sentences.append(sentence)
+
+    return footnotes, note_to_sentences
+
+
+def count_fns_in_letter(root, footnotes=None):
+    """count editorial and content footnotes, pass the footnotes from sentence_index to skip the search"""
+    if footnotes is None:
+        footnotes = root.findall(".//note[@type='footnote']", {None: 'http://www.tei-c.org/ns/1.0'})
     
     ed_footnote_count = 0  # editorial footnotes
     cont_footnote_count = 0  # content footnotes
@@ -30,98 +59,372 @@ def count_fns_in_letter(root):
     
     return ed_footnote_count, cont_footnote_count
 
-def make_letter_df(infolder, id_to_edition):
-    """make some stats about letters, return pandas df"""
-    letter_df = pd.DataFrame(columns=["letter_id", "edition", "sent_count", "cont_footnote_count", "ed_footnote_count"])
-    namespaces_none = {None: 'http://www.tei-c.org/ns/1.0'}  # works well with findall, but not with .xpath
-    total_footnote_count = 0
-    # namespaces_tei = {'tei': 'http://www.tei-c.org/ns/1.0'}  # when using .xpath, but need to use prefix in path
-    for filename in tqdm(os.listdir(infolder)):
-
-        with open(os.path.join(infolder, filename), "r", encoding="utf-8") as f:
-            tree = etree.parse(f)
-        root = tree.getroot()
+def letter_tasks(infolder, id_to_edition, test_letter=False):
+    """list the letters to parse as (filepath, letter_id, edition), in the order of os.listdir"""
+    tasks = []
+    for filename in os.listdir(infolder):
         letter_id = filename.split(".")[0]
 
         if letter_id not in id_to_edition:  # only work on edited letters...
             continue
-        
-        ed_footnote_count, cont_footnote_count = count_fns_in_letter(root)
-        
 
-        sentences = root.findall(".//s", namespaces_none) # list of sentences
-        if len(sentences) == 0:  # empty letters, not published in the edition?
-            continue
+        if test_letter:
+            if letter_id != test_letter:
+                continue
 
-        letter_df.loc[len(letter_df)] = [letter_id, id_to_edition[letter_id], len(sentences), cont_footnote_count, ed_footnote_count]
-        total_footnote_count += cont_footnote_count
-    print("total content footnotes: ", total_footnote_count)
-    return letter_df
+        tasks.append((os.path.join(infolder, filename), letter_id, id_to_edition[letter_id]))
+    return tasks
 
 
-def make_footnote_df(infolder, outfilename, id_to_edition, test_letter = False):  # todo: write test option
-    """get all footnotes into a csv file"""  # with a DataFrame it takes to much time...
+def letter_stats(root, letter_id, edition, footnotes=None):
+    """row for the letter_df, None for letters without sentences"""
     namespaces_none = {None: 'http://www.tei-c.org/ns/1.0'}  # works well with findall, but not with .xpath
-    namespaces_tei = {'tei': 'http://www.tei-c.org/ns/1.0'}  # when using .xpath, but need to use prefix in path
-    counter = 0
-    with open(outfilename, 'w', encoding='utf-8', newline='') as outfile:
-        csv_writer = csv.writer(outfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL, doublequote=True)
-        csv_writer.writerow(['letter_id', 'edition', 'n_footnote', "n_sentence", 'xml_footnote', 'xml_sentence', 'text_footnote', 'text_sentence', 'len_footnote', 'pos_footnote', 'label'])  # column names
-        # footnote_df = pd.DataFrame(columns=[['letter_id', 'edition', 'n_footnote', "n_sentence", 'xml_footnote', 'xml_sentence', 'text_footnote', 'text_sentence', 'len_footnote']])
-        for filename in tqdm(os.listdir(infolder)):
+    ed_footnote_count, cont_footnote_count = count_fns_in_letter(root, footnotes)
 
-            letter_id = filename.split(".")[0]
+    sentences = root.findall(".//s", namespaces_none) # list of sentences
+    if len(sentences) == 0:  # empty letters, not published in the edition?
+        return None
 
-            if letter_id not in id_to_edition:  # only work on edited letters...
-                continue
-            
-            if test_letter:
-                if letter_id != test_letter:
-                    continue
+    return [letter_id, edition, len(sentences), cont_footnote_count, ed_footnote_count]
+
+
+def footnote_rows(root, letter_id, edition, index=None):
+    """rows for the footnote_df, one per content footnote in a sentence"""
+    if index is None:
+        index = sentence_index(root)
+    footnotes, note_to_sentences = index
+    rows = []
+
+    for footnote in footnotes:
+        try:
+            n_footnote = int(footnote.get("n"))
+            # footnote.tail = None  # can't remove it here, otherwise it is also gone in the sentence... 
+            xml_footnote = etree.tostring(footnote, encoding="unicode", with_tail=False) # have to specify the encoding argument as such, bc otherwise it returns a byte string... get_node_string(footnote)
+        except ValueError:  # editorial footnotes
+            continue
+
+        # get the sentence to the footnote
+        sentence = note_to_sentences.get(str(n_footnote), [])
+        if len(sentence) == 1:
+            sentence = sentence[0]
+        else:  # No anscestor is a sentence element, some are in the Regest, some to other footnotes...
+            # print(f"{letter_id}, {n_footnote}")
+            continue
+
+        n_sentence = sentence.get('n')
+        sentence.tail = None
+        xml_sentence = etree.tostring(sentence, encoding="unicode") # get_node_string(sentence)
+
+        rows.append(footnote_row(letter_id, edition, n_footnote, n_sentence, xml_footnote, xml_sentence))
+    return rows
+
+
+def footnote_row(letter_id, edition, n_footnote, n_sentence, xml_footnote, xml_sentence):
+    """all columns of the footnote_df, given the xml of the footnote and its sentence"""
+    # replace footnote elements with all content by '__<n>'
+    xml_sentence_no_fn = footnote_placeholder(xml_sentence)
+    # remove all other markup (assumption is that everything not in footnotes is purely for markup reasons)
+    text_sentence = remove_markup(xml_sentence_no_fn)
+    text_footnote = remove_markup(xml_footnote)
+    len_footnote = len_text(text_footnote)
+    pos_footnote = footnote_pos(n_footnote, text_sentence)
 
-            with open(os.path.join(infolder, filename), "r", encoding="utf-8") as f:
-                tree = etree.parse(f)
-            root = tree.getroot()
+    # classify the label
+    label = classify_footnote(text_footnote, xml_footnote)
 
+    return [letter_id, edition, n_footnote, n_sentence, xml_footnote, xml_sentence, text_footnote, text_sentence, len_footnote, pos_footnote, label]
 
-            # get the footnotes
-            footnotes = root.findall(".//note[@type='footnote']", namespaces_none)
-            for footnote in footnotes:
+
+def parse_letter(task):
+    """parse a single letter, return its footnote rows and letter stats
+    (top level function, so it can be sent to the worker processes)"""
+    filepath, letter_id, edition = task
+    with open(filepath, "r", encoding="utf-8") as f:
+        tree = etree.parse(f)
+    root = tree.getroot()
+
+    # one pass for the sentence index, used for both the stats and the footnotes
+    index = sentence_index(root)
+    # stats first, footnote_rows changes the tails of the sentences
+    stats = letter_stats(root, letter_id, edition, footnotes=index[0])
+    return footnote_rows(root, letter_id, edition, index), stats
+
+
+def stream_letter(task):
+    """same result as parse_letter, but with iterparse: every sentence is processed when it ends and then cleared,
+    so the memory does not grow with the size of the letter"""
+    filepath, letter_id, edition = task
+    ed_footnote_count = 0
+    cont_footnote_count = 0
+    sent_count = 0
+    sentences_per_n = {}  # n of a note -> number of sentences containing it
+    candidate_rows = []  # (n, row), only kept if no other sentence contains a note with the same n
+
+    for _, element in etree.iterparse(filepath, events=("end",), tag=(f"{TEI}s", f"{TEI}note")):
+        if element.tag == f"{TEI}note":
+            if element.get("type") == "footnote":
                 try:
-                    n_footnote = int(footnote.get("n"))
-                    # footnote.tail = None  # can't remove it here, otherwise it is also gone in the sentence... 
-                    xml_footnote = etree.tostring(footnote, encoding="unicode", with_tail=False) # have to specify the encoding argument as such, bc otherwise it returns a byte string... get_node_string(footnote)
-                except ValueError:  # editorial footnotes
-                    continue
-
-                # get the sentence to the footnote
-                sentence = root.xpath(f".//tei:s[descendant::tei:note[@n='{n_footnote}']]", namespaces=namespaces_tei)
-                if len(sentence) == 1:
-                    sentence = sentence[0]
-                else:  # No anscestor is a sentence element, some are in the Regest, some to other footnotes...
-                    # print(f"{letter_id}, {n_footnote}")
-                    continue
-
-                n_sentence = sentence.get('n')
-                sentence.tail = None
-                xml_sentence = etree.tostring(sentence, encoding="unicode") # get_node_string(sentence)
-
-                # replace footnote elements with all content by '__<n>'
-                xml_sentence_no_fn = footnote_placeholder(xml_sentence)
-                # remove all other markup (assumption is that everything not in footnotes is purely for markup reasons)
-                text_sentence = remove_markup(xml_sentence_no_fn)
-                text_footnote = remove_markup(xml_footnote)
-                len_footnote = len_text(text_footnote)
-                pos_footnote = footnote_pos(n_footnote, text_sentence)
-
-                # classify the label
-                label = classify_footnote(text_footnote, xml_footnote)
-
-                edition = id_to_edition[letter_id]
-                csv_writer.writerow([letter_id, edition, n_footnote, n_sentence, xml_footnote, xml_sentence, text_footnote, text_sentence, len_footnote, pos_footnote, label])
-                counter += 1
+                    int(element.get("n"))
+                    cont_footnote_count += 1
+                except ValueError:
+                    ed_footnote_count += 1
+            continue
+
+        sent_count += 1
+        if next(element.iterancestors(f"{TEI}s"), None) is not None:  # nested sentence, handled with the outer one
+            continue
+
+        # the sentences (this one and the nested ones) containing the notes, by n
+        local_sentences = {}
+        for note in element.iter(f"{TEI}note"):
+            n = note.get("n")
+            if n is None:
+                continue
+            sentences = local_sentences.setdefault(n, [])
+            for sentence in note.iterancestors(f"{TEI}s"):
+                if not any(sentence is s for s in sentences):
+                    sentences.append(sentence)
+                if sentence is element:
+                    break
+        for n, sentences in local_sentences.items():
+            sentences_per_n[n] = sentences_per_n.get(n, 0) + len(sentences)
+
+        xml_sentence = None
+        for footnote in element.iter(f"{TEI}note"):
+            if footnote.get("type") != "footnote":
+                continue
+            try:
+                n_footnote = int(footnote.get("n"))
+            except ValueError:  # editorial footnotes
+                continue
+            if len(local_sentences.get(str(n_footnote), [])) != 1:
+                continue
+
+            xml_footnote = etree.tostring(footnote, encoding="unicode", with_tail=False)
+            if xml_sentence is None:
+                xml_sentence = etree.tostring(element, encoding="unicode", with_tail=False)
+            candidate_rows.append((str(n_footnote), footnote_row(letter_id, edition, n_footnote, element.get('n'), xml_footnote, xml_sentence)))
+
+        # free the memory of the sentence and of the finished elements before it
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+    if sent_count == 0:  # empty letters, not published in the edition?
+        stats = None
+    else:
+        stats = [letter_id, edition, sent_count, cont_footnote_count, ed_footnote_count]
+
+    rows = [row for n, row in candidate_rows if sentences_per_n[n] == 1]
+    return rows, stats
+
+
+def parse_letters(tasks, workers=1, cache_dir=None, streaming=False, prune_cache=True):
+    """yield the parse results in the order of the tasks, 
+    with workers > 1 the letters are spread over a process pool,
+    with a cache_dir only new or changed letters are parsed, the rest is read from the cache
+    (prune_cache: remove the cached letters that are not in the tasks, False if the tasks are not all the letters),
+    with streaming the letters are parsed with iterparse (stream_letter)"""
+    if cache_dir:
+        yield from parse_letters_cached(tasks, workers, cache_dir, streaming, prune_cache)
+        return
+
+    yield from map_letters(stream_letter if streaming else parse_letter, tasks, workers)
+
+
+def map_letters(func, tasks, workers=1):
+    """yield func(task) in the order of the tasks, with workers > 1 over a process pool"""
+    if workers <= 1:
+        for task in tqdm(tasks):
+            yield func(task)
+        return
+
+    # imap keeps the order of the tasks, thus the output is the same as in the serial run
+    chunksize = max(1, len(tasks) // (workers * 16))
+    with Pool(workers) as pool:
+        for result in tqdm(pool.imap(func, tasks, chunksize=chunksize), total=len(tasks)):
+            yield result
+
+
+#####################
+# Incremental parsing: cache of the parse results per letter
+####################
+
+
+def file_sha1(filepath):
+    with open(filepath, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+SHARD_NAME_REGEX = re.compile(r"[0-9a-f]{40}\.json")
+
+
+def shard_name(letter_id, edition, content_hash, streaming=False):
+    """name of the cached parse result, changes with the content of the letter, its edition, the parser and the CACHE_VERSION
+    (the results of parse_letter and stream_letter are cached separately, so they can be compared)"""
+    parser = "stream" if streaming else "dom"
+    key = hashlib.sha1(f"{CACHE_VERSION}|{parser}|{letter_id}|{edition}|{content_hash}".encode("utf-8")).hexdigest()
+    return f"{key}.json"
+
+
+def load_manifest(cache_dir, filename="manifest.json"):
+    """manifest maps the letter files to their content hash (and mtime and size, to avoid rehashing unchanged files)"""
+    manifest_path = os.path.join(cache_dir, filename)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as injson:
+        return json.load(injson)
+
+
+def write_json_atomic(filepath, data):
+    """write to a temporary file first, so an interrupted run does not leave a broken file"""
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outjson:
+        json.dump(data, outjson)
+    os.replace(tmp_path, filepath)
+
+
+def content_hash(filepath, manifest):
+    """sha1 of the file, taken from the manifest if the file was not touched since"""
+    stat = os.stat(filepath)
+    entry = manifest.get(os.path.abspath(filepath))
+    if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        return entry["sha1"]
+
+    sha1 = file_sha1(filepath)
+    manifest[os.path.abspath(filepath)] = {"sha1": sha1, "mtime": stat.st_mtime, "size": stat.st_size}
+    return sha1
+
+
+def parse_letters_cached(tasks, workers, cache_dir, streaming=False, prune=True):
+    """like parse_letters, but reassemble unchanged letters from the cached shards
+    with prune the shards of changed or removed letters are deleted (the ones of both parsers for the tasks are kept)"""
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = load_manifest(cache_dir)
+
+    shard_paths = []
+    to_parse = []
+    keep = set()
+    for filepath, letter_id, edition in tasks:
+        sha1 = content_hash(filepath, manifest)
+        shard_path = os.path.join(cache_dir, shard_name(letter_id, edition, sha1, streaming))
+        shard_paths.append(shard_path)
+        keep.update([shard_name(letter_id, edition, sha1, False), shard_name(letter_id, edition, sha1, True)])
+        if not os.path.exists(shard_path):
+            to_parse.append((filepath, letter_id, edition))
+    if prune:
+        task_paths = {os.path.abspath(filepath) for filepath, _, _ in tasks}
+        manifest = {filepath: entry for filepath, entry in manifest.items() if filepath in task_paths}
+    write_json_atomic(os.path.join(cache_dir, "manifest.json"), manifest)
+    print(f"letters from cache: {len(tasks)-len(to_parse)}, letters to parse: {len(to_parse)}")
+    if prune:
+        stale = [filename for filename in os.listdir(cache_dir) if SHARD_NAME_REGEX.fullmatch(filename) and filename not in keep]
+        for filename in stale:
+            os.remove(os.path.join(cache_dir, filename))
+        if stale:
+            print(f"removed {len(stale)} cached letters that changed or are gone")
+
+    # the letters to parse are in the same order as the tasks, so we can go through both at once
+    parsed = parse_letters(to_parse, workers, streaming=streaming)
+    for shard_path in shard_paths:
+        if os.path.exists(shard_path):
+            with open(shard_path, "r", encoding="utf-8") as injson:
+                shard = json.load(injson)
+            yield shard["footnote_rows"], shard["stats"]
+        else:
+            rows, stats = next(parsed)
+            write_json_atomic(shard_path, {"footnote_rows": rows, "stats": stats})
+            yield rows, stats
+
+
+def make_letter_df(infolder, id_to_edition, workers=1, cache_dir=None, streaming=False):
+    """make some stats about letters, return pandas df"""
+    letter_rows = []  # collect the rows first, adding them to the df one by one is quadratic
+    total_footnote_count = 0
+    tasks = letter_tasks(infolder, id_to_edition)
+    for _, stats in parse_letters(tasks, workers, cache_dir, streaming):
+        if stats is None:
+            continue
+
+        letter_rows.append(stats)
+        total_footnote_count += stats[3]  # cont_footnote_count
+    print("total content footnotes: ", total_footnote_count)
+    return pd.DataFrame(letter_rows, columns=["letter_id", "edition", "sent_count", "cont_footnote_count", "ed_footnote_count"])
+
+
+def make_footnote_df(infolder, outfilename, id_to_edition, test_letter = False, workers=1, cache_dir=None, parquet=False, streaming=False):
+    """get all footnotes into a csv file (and a typed parquet file next to it, if specified)"""  # with a DataFrame it takes to much time...
+    counter = 0
+    tasks = letter_tasks(infolder, id_to_edition, test_letter)
+    with open(outfilename, 'w', encoding='utf-8', newline='') as outfile:
+        csv_writer = csv.writer(outfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL, doublequote=True)
+        csv_writer.writerow(['letter_id', 'edition', 'n_footnote', "n_sentence", 'xml_footnote', 'xml_sentence', 'text_footnote', 'text_sentence', 'len_footnote', 'pos_footnote', 'label'])  # column names
+        # footnote_df = pd.DataFrame(columns=[['letter_id', 'edition', 'n_footnote', "n_sentence", 'xml_footnote', 'xml_sentence', 'text_footnote', 'text_sentence', 'len_footnote', 'pos_footnote', 'label']])
+        for rows, _ in parse_letters(tasks, workers, cache_dir, streaming, prune_cache=not test_letter):
+            csv_writer.writerows(rows)
+            counter += len(rows)
                 
         print(f"Total footnotes found: {counter}")
+
+    if parquet:
+        footnote_df_to_parquet(outfilename)
+
+
+def test_footnote_df(infolder, reference_csv, id_to_edition, test_letter=False, workers=1, streaming=False):
+    """regression check: rebuild the footnote_df and compare it row by row to a previous build
+    (e.g. footnote_df.csv, or footnote_df_10013.csv with test_letter='10013')"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp_csv = os.path.join(tmpdir, "footnote_df.csv")
+        make_footnote_df(infolder, tmp_csv, id_to_edition, test_letter=test_letter, workers=workers, streaming=streaming)
+
+        with open(tmp_csv, "r", encoding="utf-8", newline="") as new_file, open(reference_csv, "r", encoding="utf-8", newline="") as reference_file:
+            new_rows = list(csv.reader(new_file))
+            reference_rows = list(csv.reader(reference_file))
+
+    differences = 0
+    for new_row, reference_row in zip(new_rows, reference_rows):
+        if new_row != reference_row:
+            if differences < 10:
+                print(f"row differs: letter {reference_row[0]}, footnote {reference_row[2]}")
+            differences += 1
+
+    if len(new_rows) != len(reference_rows):
+        print(f"number of rows differs: {len(new_rows)-1} instead of {len(reference_rows)-1}")
+    print(f"{differences} differing rows out of {len(reference_rows)-1}")
+    return differences == 0 and len(new_rows) == len(reference_rows)
+
+
+def benchmark_workers(infolder, outfilename, id_to_edition, max_workers):
+    """time make_footnote_df with 1, 2, 4, ... max_workers processes, 
+    check that the csv is the same as in the serial run and write the timings to outfilename"""
+    worker_counts = [1]
+    while worker_counts[-1] * 2 < max_workers:
+        worker_counts.append(worker_counts[-1] * 2)
+    if max_workers > 1:
+        worker_counts.append(max_workers)
+
+    timings = []
+    serial_csv = None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for workers in worker_counts:
+            tmp_csv = os.path.join(tmpdir, f"footnote_df_{workers}.csv")
+            start = time.perf_counter()
+            make_footnote_df(infolder, tmp_csv, id_to_edition, workers=workers)
+            seconds = time.perf_counter() - start
+
+            with open(tmp_csv, "rb") as f:
+                output = f.read()
+            if serial_csv is None:
+                serial_csv = output
+            identical = output == serial_csv
+
+            timings.append([workers, round(seconds, 2), round(timings[0][1] / seconds, 2) if timings else 1.0, identical])
+            print(f"workers: {workers}, seconds: {seconds:.2f}, identical to serial run: {identical}")
+
+    with open(outfilename, "w", encoding="utf-8", newline="") as outfile:
+        csv_writer = csv.writer(outfile)
+        csv_writer.writerow(["workers", "seconds", "speedup", "identical"])
+        csv_writer.writerows(timings)
                     
 
 
@@ -192,6 +495,175 @@ def downsize_tei(root, footnotes_to_keep=[]):
 
 
 
+#####################
+# Extracting everything from a letter in one pass
+####################
+
+
+def read_footnotes_to_keep(csv_path):
+    """letter_id -> set of footnote numbers to keep, from a (filtered) footnote_df"""
+    footnote_df = pd.read_csv(csv_path, usecols=["letter_id", "n_footnote"], dtype={"letter_id": str})
+    return footnote_df.groupby("letter_id")["n_footnote"].agg(set).to_dict()
+
+
+def letter_title_and_summary(root):
+    """title of the letter and the text of the regest (as in extract_summary_hbbw.py)"""
+    namespaces_tei = {'tei': 'http://www.tei-c.org/ns/1.0'}
+    titles = root.xpath('//tei:title[@subtype="file"]/text()', namespaces=namespaces_tei)
+    title_text = titles[0] if titles else ""
+    summary_text_list = root.xpath('//tei:summary//text()', namespaces=namespaces_tei)
+    summary_text = ' '.join([re.sub(r"(\s)\s+", r"\1", s) for s in summary_text_list])
+    return title_text, summary_text
+
+
+def downsized_letter_xml(root, letter_id, footnotes_to_keep):
+    """downsize the letter (changes root), return the xml as bytes, None if less than 2 content footnotes are left"""
+    new_tree = etree.ElementTree(downsize_tei(root, footnotes_to_keep))
+    ed_footnote_count, cont_footnote_count = count_fns_in_letter(new_tree.getroot())
+    if ed_footnote_count != 0:
+        print(f"problem!! ed_footnote_count != 0 in {letter_id}")
+    elif cont_footnote_count > 1:
+        return etree.tostring(new_tree, encoding="utf-8", pretty_print=True)
+    return None
+
+
+def extract_letter(task):
+    """parse a letter once and get all per letter artifacts:
+    footnote rows, letter stats, title, regest and the downsized TEI (None if the letter is not kept)"""
+    filepath, letter_id, edition, footnotes_to_keep = task
+    with open(filepath, "r", encoding="utf-8") as f:
+        tree = etree.parse(f)
+    root = tree.getroot()
+
+    title, summary = letter_title_and_summary(root)
+
+    downsized_xml = None
+    if footnotes_to_keep is not None:
+        # downsize a copy, footnote_rows needs the footnotes (and changes the tails of the sentences)
+        downsized_xml = downsized_letter_xml(copy.deepcopy(root), letter_id, footnotes_to_keep)
+
+    index = sentence_index(root)
+    stats = letter_stats(root, letter_id, edition, footnotes=index[0])
+    rows = footnote_rows(root, letter_id, edition, index)
+
+    return {"footnote_rows": rows, "stats": stats, "title": title, "summary": summary, "downsized_xml": downsized_xml}
+
+
+def extract_all(infolder, outfolder, id_to_edition, footnotes_to_keep_csv="", workers=1):
+    """one pass over the letters, writing everything to outfolder:
+    letter_df.csv, footnote_df.csv, title_index.json, hbbw_regesten/<id>.txt and,
+    if footnotes_to_keep_csv is given, downsized_letters/<id>.xml"""
+    footnotes_to_keep = read_footnotes_to_keep(footnotes_to_keep_csv) if footnotes_to_keep_csv else {}
+    tasks = [(filepath, letter_id, edition, footnotes_to_keep.get(letter_id)) for filepath, letter_id, edition in letter_tasks(infolder, id_to_edition)]
+
+    regest_dir = os.path.join(outfolder, "hbbw_regesten")
+    downsized_dir = os.path.join(outfolder, "downsized_letters")
+    os.makedirs(regest_dir, exist_ok=True)
+    if footnotes_to_keep:
+        os.makedirs(downsized_dir, exist_ok=True)
+
+    letter_rows = []
+    title_index = {}
+    counter = 0
+    with open(os.path.join(outfolder, "footnote_df.csv"), 'w', encoding='utf-8', newline='') as outfile:
+        csv_writer = csv.writer(outfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL, doublequote=True)
+        csv_writer.writerow(['letter_id', 'edition', 'n_footnote', "n_sentence", 'xml_footnote', 'xml_sentence', 'text_footnote', 'text_sentence', 'len_footnote', 'pos_footnote', 'label'])  # column names
+
+        for (_, letter_id, _, _), result in zip(tasks, map_letters(extract_letter, tasks, workers)):
+            csv_writer.writerows(result["footnote_rows"])
+            counter += len(result["footnote_rows"])
+            if result["stats"] is not None:
+                letter_rows.append(result["stats"])
+
+            title_index[letter_id] = result["title"]
+            with open(os.path.join(regest_dir, f"{letter_id}.txt"), "w", encoding="utf-8") as regest_file:
+                regest_file.write(f"{result['title']}\n\n{result['summary']}")
+
+            if result["downsized_xml"] is not None:
+                with open(os.path.join(downsized_dir, f"{letter_id}.xml"), "wb") as downsized_file:
+                    downsized_file.write(result["downsized_xml"])
+
+    print(f"Total footnotes found: {counter}")
+
+    letter_df = pd.DataFrame(letter_rows, columns=["letter_id", "edition", "sent_count", "cont_footnote_count", "ed_footnote_count"])
+    letter_df["footnotes_per_sentence"] = letter_df.cont_footnote_count / letter_df.sent_count  # content footnotes per sentence for the stats
+    letter_df.to_csv(os.path.join(outfolder, "letter_df.csv"))
+
+    with open(os.path.join(outfolder, "title_index.json"), "w", encoding="utf-8") as outjson:
+        json.dump(title_index, outjson, ensure_ascii=False)
+
+
+#####################
+# Downsizing the corpus
+####################
+
+
+def downsize_letter(task):
+    """parse and downsize a single letter (top level function for the worker processes)"""
+    filepath, letter_id, footnotes_to_keep = task
+    with open(filepath, "r", encoding="utf-8") as f:
+        tree = etree.parse(f)
+    return downsized_letter_xml(tree.getroot(), letter_id, footnotes_to_keep)
+
+
+def write_bytes_atomic(filepath, data):
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, "wb") as outfile:
+        outfile.write(data)
+    os.replace(tmp_path, filepath)
+
+
+def downsize_corpus(infolder, outfolder, id_to_edition, footnotes_to_keep_csv, workers=1, footnote_df_path=""):
+    """downsize all letters with footnotes to keep into outfolder (replaces the loop in prepare_data.ipynb)
+    letters whose source and set of footnotes to keep did not change since the last run are skipped
+    with a footnote_df_path the footnote_df of the downsized letters is written there, with the parquet file next to it
+    (footnote_downsized_df.csv/.parquet, read by the prompt and dataset scripts)"""
+    footnotes_to_keep = read_footnotes_to_keep(footnotes_to_keep_csv)
+    os.makedirs(outfolder, exist_ok=True)
+    manifest_path = os.path.join(outfolder, "downsize_manifest.json")
+    manifest = load_manifest(outfolder, "downsize_manifest.json")
+    sources = manifest.setdefault("sources", {})  # content hashes of the source letters
+    outputs = manifest.setdefault("outputs", {})  # letter_id -> key of the source and footnotes it was made from
+
+    tasks = []
+    keys = {}
+    for filepath, letter_id, _ in letter_tasks(infolder, id_to_edition):
+        if letter_id not in footnotes_to_keep:
+            continue
+        keep = sorted(int(n) for n in footnotes_to_keep[letter_id])
+        # the numbers written out, the repr of numpy ints changes between versions
+        keys[letter_id] = hashlib.sha1(f"{CACHE_VERSION}|{content_hash(filepath, sources)}|{','.join(map(str, keep))}".encode("utf-8")).hexdigest()
+        if outputs.get(letter_id) == keys[letter_id]:
+            continue
+        tasks.append((filepath, letter_id, set(keep)))
+    print(f"letters unchanged: {len(keys)-len(tasks)}, letters to downsize: {len(tasks)}")
+
+    # letters that are not kept anymore
+    for letter_id in [letter_id for letter_id in outputs if letter_id not in keys]:
+        outfile_path = os.path.join(outfolder, f"{letter_id}.xml")
+        if os.path.exists(outfile_path):
+            os.remove(outfile_path)
+        del outputs[letter_id]
+
+    written = 0
+    for (_, letter_id, _), downsized_xml in zip(tasks, map_letters(downsize_letter, tasks, workers)):
+        outfile_path = os.path.join(outfolder, f"{letter_id}.xml")
+        if downsized_xml is None:
+            # not enough footnotes left, remove the version of a previous run
+            if os.path.exists(outfile_path):
+                os.remove(outfile_path)
+        else:
+            write_bytes_atomic(outfile_path, downsized_xml)
+            written += 1
+        outputs[letter_id] = keys[letter_id]
+    print(f"letters written: {written}")
+
+    write_json_atomic(manifest_path, manifest)
+
+    if footnote_df_path:
+        make_footnote_df(outfolder, footnote_df_path, id_to_edition, workers=workers, parquet=True)
+
+
 #####################
 # Functions to work with the footnotes
 ####################
@@ -252,103 +724,173 @@ def test_downsize():
 
 
 
-def classify_footnote(text, xml_str):
-    # quoting a dictionary: Schweizer Idiotikon, Grimm, Otto (latin)
-    # Note that "Fischer" is used for quoting from "schwäbisches Wörterbuch" AND "Conrrad Gessner 1515-1565". But from all I can tell only in one instance it is the latter...
-    dictionary = r"<bibl.*?>(SI|Grimm|Otto|Fischer)</bibl>"
-    # referencing another edition
-    self_ref = r"<bibl.*?>(HBBW( (II?I?)?V?I?I?I?X?X?)?)</bibl>"
+#####################
+# Footnote labels
+####################
 
-    # referencing the bible (and indicated in the xml)
-    bible_ref = r"(Vgl\. |Siehe )?<cit[^>]+?type=\"bible\""
+# quoting a dictionary: Schweizer Idiotikon, Grimm, Otto (latin)
+# Note that "Fischer" is used for quoting from "schwäbisches Wörterbuch" AND "Conrrad Gessner 1515-1565". But from all I can tell only in one instance it is the latter...
+DICTIONARY_REGEX = re.compile(r"<bibl.*?>(SI|Grimm|Otto|Fischer)</bibl>")
+# referencing another edition
+SELF_REF_REGEX = re.compile(r"<bibl.*?>(HBBW( (II?I?)?V?I?I?I?X?X?)?)</bibl>")
 
+# referencing the bible (and indicated in the xml)
+BIBLE_REF_REGEX = re.compile(r"(Vgl\. |Siehe )?<cit[^>]+?type=\"bible\"")
 
-    # indicating a missing source (like a previous letter that is mentioned)
-    missing = r"([Uu]nbekannt.|[Nn]icht erhalten.|[Nn]icht auffindbar.|[Nn]icht bekannt.)$"
-    # changed to include it anywhere in the FN
-    missing = r"([Uu]nbekannt.|[Nn]icht erhalten.|[Nn]icht auffindbar.|[Nn]icht bekannt.)"
+# indicating a missing source (like a previous letter that is mentioned)
+# missing = r"([Uu]nbekannt.|[Nn]icht erhalten.|[Nn]icht auffindbar.|[Nn]icht bekannt.)$"
+# changed to include it anywhere in the FN
+MISSING_REGEX = re.compile(r"([Uu]nbekannt.|[Nn]icht erhalten.|[Nn]icht auffindbar.|[Nn]icht bekannt.)")
 
-    # referencing the same edition
-    inner_ref = r"([Ss]iehe( dazu)? (oben|unten)|([Oo]ben|[Uu]nten)|[Vv]gl. (oben|unten))"  # S.O. and S.u. etc, seem not to be used
+# referencing the same edition
+INNER_REF_REGEX = re.compile(r"([Ss]iehe( dazu)? (oben|unten)|([Oo]ben|[Uu]nten)|[Vv]gl. (oben|unten))")  # S.O. and S.u. etc, seem not to be used
 
-    # Regex for lexical footnotes, that do not quote any dictionary
-    lex_regex = (r"(^="  # starts with =
-                "|([A-Za-zäöüÄÖÜß]+,? ?){1,3}[\.!]$"  # no more than 3 words, sometimes ending in ! if a verb in imperative
-                "|[A-Za-zäöüÄÖÜß]+: [A-Za-zäöüÄÖÜß]+)"
-                "|[^A-ZÖÄÜß]+$")  # no caps in all of the footnote
-    
-    # biliographien (only the bullinger bibliography that is cited enough to care)
-    # actually it is not cited enough to care... I'll take it out...
-    bibl = r"<bibl.*?>HBBibl</bibl>"
+# Regex for lexical footnotes, that do not quote any dictionary
+LEX_REGEX = re.compile(r"(^="  # starts with =
+            "|([A-Za-zäöüÄÖÜß]+,? ?){1,3}[\.!]$"  # no more than 3 words, sometimes ending in ! if a verb in imperative
+            "|[A-Za-zäöüÄÖÜß]+: [A-Za-zäöüÄÖÜß]+)"
+            "|[^A-ZÖÄÜß]+$")  # no caps in all of the footnote
+
+# biliographien (only the bullinger bibliography that is cited enough to care)
+# actually it is not cited enough to care... I'll take it out...
+BIBL_REGEX = re.compile(r"<bibl.*?>HBBibl</bibl>")
 
+LABELS = ["lex_dict", "self_ref", "bible", "missing", "inner_ref", "lex", "short", "misc"]
 
+
+def non_capturing(regex):
+    """same regex with (?:...) groups, str.contains warns for every call with capturing groups"""
+    return re.compile(re.sub(r"(?<!\\)\((?!\?)", "(?:", regex.pattern), regex.flags)
+
+# for classify_footnote_df
+DICTIONARY_REGEX_NC = non_capturing(DICTIONARY_REGEX)
+SELF_REF_REGEX_NC = non_capturing(SELF_REF_REGEX)
+BIBLE_REF_REGEX_NC = non_capturing(BIBLE_REF_REGEX)
+MISSING_REGEX_NC = non_capturing(MISSING_REGEX)
+
+
+def classify_footnote(text, xml_str):
     label_list = []
 
-    if re.findall(dictionary, xml_str):
+    if DICTIONARY_REGEX.search(xml_str):
         label_list.append("lex_dict")
-        # return "lex_dict"
 
-    if re.findall(self_ref, xml_str): 
+    if SELF_REF_REGEX.search(xml_str): 
         label_list.append("self_ref") 
-        # return "self_ref"
     
-    if re.search(bible_ref, xml_str):
+    if BIBLE_REF_REGEX.search(xml_str):
         label_list.append("bible")
-        # return "bible"
     
-    if re.search(missing, text):
+    if MISSING_REGEX.search(text):
         label_list.append("missing")
-        # return "missing"
     
-    if re.match(inner_ref, text):
+    if INNER_REF_REGEX.match(text):
         label_list.append("inner_ref")
-        # return "inner_ref"
     
-    if re.match(lex_regex, text):
+    if LEX_REGEX.match(text):
         label_list.append("lex")
-        # return "lex"
     
-    # if re.findall(bibl, xml_str):
+    # if BIBL_REGEX.search(xml_str):
         # label_list.append("bibl")
-        # return "bibl"
     
     if len(label_list) < 1:
             
         if len(text.split()) < 6:  # on the text without markup!!
             label_list.append("short")
-            # return "short"
 
         else:
             label_list.append("misc")
-            # return "misc"
     return ", ".join(label_list)
 
 
+def classify_footnote_df(footnote_df, text_column="text_footnote", xml_column="xml_footnote"):
+    """same as classify_footnote, but over a whole footnote_df (or arrow table) at once
+    returns a DataFrame with one boolean column per label"""
+    if not isinstance(footnote_df, pd.DataFrame):  # arrow table
+        footnote_df = footnote_df.select([text_column, xml_column]).to_pandas()
+
+    # empty footnotes are NaN when read from the csv
+    text = footnote_df[text_column].fillna("").astype(str)
+    xml_str = footnote_df[xml_column].fillna("").astype(str)
+
+    label_df = pd.DataFrame(index=footnote_df.index)
+    label_df["lex_dict"] = xml_str.str.contains(DICTIONARY_REGEX_NC, na=False)
+    label_df["self_ref"] = xml_str.str.contains(SELF_REF_REGEX_NC, na=False)
+    label_df["bible"] = xml_str.str.contains(BIBLE_REF_REGEX_NC, na=False)
+    label_df["missing"] = text.str.contains(MISSING_REGEX_NC, na=False)
+    label_df["inner_ref"] = text.str.match(INNER_REF_REGEX, na=False)
+    label_df["lex"] = text.str.match(LEX_REGEX, na=False)
+
+    no_label = ~label_df.any(axis=1)
+    short = text.str.split().str.len() < 6  # on the text without markup!!
+    label_df["short"] = no_label & short
+    label_df["misc"] = no_label & ~short
+    return label_df
+
+
+def join_labels(label_df):
+    """boolean label columns back to the comma separated label string of the footnote_df"""
+    labels = pd.Series("", index=label_df.index)
+    for label in LABELS:
+        labels = labels.where(~label_df[label], labels + ", " + label)
+    return labels.str.removeprefix(", ")
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("mode", choices=["letter_df", "footnote_df", "id_to_edition_map"])
-    parser.add_argument("outfilename", type=str, help="csv filename for the DFs and json filename for the map")
+    parser.add_argument("mode", choices=["letter_df", "footnote_df", "id_to_edition_map", "benchmark_workers", "test_footnote_df", "relabel", "extract_all", "downsize"])
+    parser.add_argument("outfilename", type=str, help="csv filename for the DFs (benchmark timings, the reference footnote_df for test_footnote_df, or the footnote_df to relabel) and json filename for the map, output folder for extract_all and downsize")
     parser.add_argument("--infolder", default="../../bullinger_source_data/letters" ,help="folder containing the letters")
     parser.add_argument("--id_to_edition_map", default="../../data/id_to_edition_map.json", help="json file mapping the ids to the edition (can be created with this script, if corresponding folder is available)")
     parser.add_argument("--test_letter", default="", help="for testing cases, run only on a specific letter")
+    parser.add_argument("--workers", default=1, type=int, help="number of processes to parse the letters with (max number for benchmark_workers), default=1")
+    parser.add_argument("--cache_dir", default="", help="folder for the parse cache, only new or changed letters are parsed again (no cache if left empty)")
+    parser.add_argument("--footnotes_to_keep", default="", help="extract_all/downsize: (filtered) footnote_df with the footnotes to keep in the downsized letters, no downsizing in extract_all if left empty")
+    parser.add_argument("--streaming", action="store_true", default=False, help="letter_df/footnote_df: parse the letters with iterparse, memory stays flat for large letters")
+    parser.add_argument("--downsized_footnote_df", default="", help="downsize: footnote_df of the downsized letters (csv and parquet), default=footnote_downsized_df.csv next to the output folder, 'none' to skip")
+    parser.add_argument("--parquet", action="store_true", default=False, help="footnote_df: also write a typed parquet file next to the csv")
     args = parser.parse_args()
     mode = args.mode 
     outfilename = args.outfilename 
     infolder = args.infolder
     id_to_edition_map = args.id_to_edition_map
     test_letter = args.test_letter
+    workers = args.workers
+    cache_dir = args.cache_dir
     # call the model to make the dataframes (takes a long time when calling through the ipynb somehow...)
     with open(id_to_edition_map, "r", encoding="utf-8") as injson:
         id_to_edition = json.load(injson)
 
     if mode == "letter_df":
-        letter_df = make_letter_df(infolder, id_to_edition)
+        letter_df = make_letter_df(infolder, id_to_edition, workers=workers, cache_dir=cache_dir, streaming=args.streaming)
         letter_df["footnotes_per_sentence"] = letter_df.cont_footnote_count / letter_df.sent_count  # content footnotes per sentence for the stats
         letter_df.to_csv(outfilename)
 
     elif mode == "footnote_df":
-        make_footnote_df(infolder, outfilename, id_to_edition, test_letter=test_letter)
+        make_footnote_df(infolder, outfilename, id_to_edition, test_letter=test_letter, workers=workers, cache_dir=cache_dir, parquet=args.parquet, streaming=args.streaming)
+
+    elif mode == "benchmark_workers":
+        benchmark_workers(infolder, outfilename, id_to_edition, workers)
+
+    elif mode == "test_footnote_df":
+        test_footnote_df(infolder, outfilename, id_to_edition, test_letter=test_letter, workers=workers, streaming=args.streaming)
+
+    elif mode == "extract_all":
+        extract_all(infolder, outfilename, id_to_edition, footnotes_to_keep_csv=args.footnotes_to_keep, workers=workers)
+
+    elif mode == "downsize":
+        if not args.footnotes_to_keep:
+            parser.error("downsize needs --footnotes_to_keep")
+        footnote_df_path = args.downsized_footnote_df or os.path.join(os.path.dirname(os.path.normpath(outfilename)), "footnote_downsized_df.csv")
+        if footnote_df_path == "none":
+            footnote_df_path = ""
+        downsize_corpus(infolder, outfilename, id_to_edition, args.footnotes_to_keep, workers=workers, footnote_df_path=footnote_df_path)
+
+    elif mode == "relabel":  # after a change of the rules, no need to parse the letters again
+        footnote_df = pd.read_csv(outfilename, dtype=str, keep_default_na=False)  # all as strings, so the other columns stay untouched
+        footnote_df["label"] = join_labels(classify_footnote_df(footnote_df))
+        footnote_df.to_csv(outfilename, index=False)
 
     elif mode == "id_to_edition_map":
         id_to_edition = make_id_to_edition_map(infolder) 
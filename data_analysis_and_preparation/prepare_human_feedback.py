@@ -1,5 +1,9 @@
-import re, random, os
+import re, random, os, json
 import pandas as pd
+import sys
+module_path = "../generate_data_prep"
+sys.path.append(module_path)
+from prompt_store import PromptStore
 from openpyxl import load_workbook
 from openpyxl.styles import PatternFill
 
@@ -116,12 +120,12 @@ def fill_excel_with_data(df, infile_path, outfile_path):
 def sample_from_test_set(footnote_df):
 
     # get letter ids and n-footnotes from the testset
-    test_fns = [filename.split(".")[0] for filename in os.listdir("../../data/prompts/instruct_add/test")]
+    test_fns = PromptStore("../../data/prompts/instruct_add/test").keys()
 
     filtered_rows = []
-    for test_fn in test_fns:
-        letter_id = int(test_fn.split("_")[0])
-        n_footnote = int(test_fn.split("_")[1])
+    for letter_id, n_footnote in test_fns:
+        letter_id = int(letter_id)
+        n_footnote = int(n_footnote)
         filtered_rows.append(footnote_df[(footnote_df['letter_id'] == letter_id) & (footnote_df['n_footnote'] == n_footnote)])
 
     df = pd.concat(filtered_rows, ignore_index=True)
@@ -164,12 +168,20 @@ def stratify_sample_by_label(df, n=20):
 
     return sample
 
-def input_letter_head(sample_df, n_column):
-    """find the letter titles and put them into the df"""
+def input_letter_head(sample_df, n_column, title_index_path=None):
+    """find the letter titles and put them into the df
+    title_index_path: title_index.json from parse_bullinger.py extract_all, otherwise the titles are searched in the letters"""
     titles = []
     letters_dir = "../../data/downsized_letters"
     title_regex = r"<titleStmt>[^<]*<title[^>]+>([^<]+)"
 
+    if title_index_path:
+        with open(title_index_path, "r", encoding="utf-8") as injson:
+            title_index = json.load(injson)
+        titles = [title_index.get(str(letter_id), "NaN") for letter_id in sample_df.letter_id]
+        sample_df.insert(n_column, "title_letter", titles)
+        return
+
     for _, row in sample_df.iterrows():
         with open(os.path.join(letters_dir, f"{row.letter_id}.xml"), "r", encoding="utf-8") as infile:
             letter_text = infile.read()
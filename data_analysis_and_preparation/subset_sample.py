@@ -5,6 +5,7 @@ import argparse
 import os, json, re
 import pandas as pd
 from tqdm import tqdm
+from footnote_store import read_footnote_df
 
 def check_for_bible_ref(text):
     # referencing the bible (and indicated in the xml)
@@ -16,7 +17,7 @@ def main(category):
         strat_sample = json.load(infile)
     
  
-    footnote_df = pd.read_csv("../../data/footnote_downsized_df.csv")
+    footnote_df = read_footnote_df("../../data/footnote_downsized_df.parquet", columns=["letter_id", "n_footnote", "xml_footnote"])
     new_dict = {
         "train": [],
         "dev": [],
@@ -15,7 +15,10 @@ from huggingface_hub import HfApi, HfFolder
 # getting functions from other modules
 module_path = "../generate_FNs_llama"
 sys.path.append(module_path)
-from run_llama_over_prompts import get_model
+from run_llama_over_prompts import get_model, adapter_label
+module_path = "../data_analysis_and_preparation"
+sys.path.append(module_path)
+from footnote_store import read_footnote_df
 
 module_path = "../data"
 
@@ -47,7 +50,7 @@ def contains_source(xml_footnote, source):
 def get_data(data_path, filter=""):
     """get the fns from the dev set in a list
     filter can be either 'bible', 'EA', 'Zwa' or 'Z'"""
-    footnote_df = pd.read_csv(os.path.join(data_path, "footnote_downsized_df.csv"))
+    footnote_df = read_footnote_df(os.path.join(data_path, "footnote_downsized_df.parquet"), columns=["letter_id", "xml_footnote"])
 
     with open(os.path.join(data_path, "strat_sample.json"), "r", encoding="utf-8") as injson:
         strat_sample = json.load(injson)
@@ -152,13 +155,10 @@ def main(args):
         monitor_thread = threading.Thread(target=monitor_gpu, args=(5,stop_monitoring), daemon=True)
         monitor_thread.start()
 
-    model, tokenizer = get_model(args.size, args.adapters)
+    model, tokenizer = get_model(args.size, args.adapters, combo_dir=args.combo_dir)
 
     model_name=f"llama-{args.size}B"
-    if type(model.active_adapter) == str:
-        adapter_name = model.active_adapter
-    else:
-        adapter_name = "base"
+    adapter_name = adapter_label(model)
 
     # testing dataset:
     dataset = get_data(args.dir, filter=args.filter_dataset)
@@ -195,6 +195,7 @@ if __name__=="__main__":
   parser.add_argument("--batch_size", type=int, default=1, help="heavily affects score with quantized models, though")
   parser.add_argument("--filter_dataset", default="", choices=["bible", "EA", "Zwa", "Z"])
   parser.add_argument("--dir", default = "/data/nbauer/data", help="Directory where the data are stored, default=/data/nbauer/data")
+  parser.add_argument("--combo_dir", default="", help="Directory with adapter combinations exported by export_adapter_combo.py, used if the combination is there")
   parser.add_argument("--log_gpu_usage", default="", help="Log-file for gpu-usage, no logging if left empty")
   parser.add_argument("--test", default=0, type=int, help="run only on a partition of the data")
   parser.add_argument("--quantized", type=bool, default=True, help="Set to false to load the original model from Meta")
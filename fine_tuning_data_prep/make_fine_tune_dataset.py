@@ -6,15 +6,18 @@ from tqdm import tqdm
 # import other modules, with the path
 module_path = os.path.abspath(os.path.join('..', 'generate_data_prep'))
 sys.path.append(module_path)
-from generate_instruction import SYSTEM_PROMPT, HISTORIAN_PROMPT, instruct_prompt_add, get_letter_text
+from generate_instruction import SYSTEM_PROMPT, HISTORIAN_PROMPT, remove_footnotes_content, get_footnote_content, get_letter_text
 from generate_prompts_from_questions import get_query 
+module_path = os.path.abspath(os.path.join('..', 'data_analysis_and_preparation'))
+sys.path.append(module_path)
+from footnote_store import read_footnote_df
 
 
 # Some variables
 LETTER_DIR = "../../data/downsized_letters"
 SAMPLE_FILEPATH = "../../data/strat_sample.json"
 DATA_DIR = "../../data"
-FOOTNOTE_DF_PATH = "../../data/footnote_downsized_df.csv"
+FOOTNOTE_DF_PATH = "../../data/footnote_downsized_df.parquet"
 OUT_DIR = "../../data/fine_tune_data"
 
 def get_letter_ids(run_full):
@@ -56,7 +59,7 @@ def main(args):
     if prompt == "instruct_qa":
         question_df = get_question_df(run_full)
 
-    footnote_df = pd.read_csv(FOOTNOTE_DF_PATH)
+    footnote_df = read_footnote_df(FOOTNOTE_DF_PATH, columns=["letter_id", "n_footnote", "xml_sentence"])
 
     data = []
 
@@ -65,9 +68,11 @@ def main(args):
 
         ns = list(footnote_df[footnote_df["letter_id"] == int(letter_id)].n_footnote)
 
+        # the letter without FNs is the same for all of them, only strip it once
+        letter_no_fns, footnote_contents = remove_footnotes_content(letter_text, ns)
 
         for n in ns:
-            letter_no_fns, footnote_content = instruct_prompt_add(letter_text, ns, n)
+            footnote_content = footnote_contents[n] if n in footnote_contents else get_footnote_content(letter_text, n)
             if prompt == "instruct_add":
                 query = HISTORIAN_PROMPT(letter_no_fns, n)
             elif prompt == "instruct_qa":
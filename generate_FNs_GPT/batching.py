@@ -1,7 +1,10 @@
 
 import jsonlines
-import os, json, argparse
+import os, sys, json, argparse
 from tqdm import tqdm
+module_path = "../generate_data_prep"
+sys.path.append(module_path)
+from prompt_store import PromptStore
 
 def generate_batch_file(folder_path, model_name):
 
@@ -11,11 +14,9 @@ def generate_batch_file(folder_path, model_name):
     outfile_name = f"{model_name}-{prompt_name}-{sample}.jsonl"
     outfile_path = os.path.join(dir_path, outfile_name)
 
-    for filename in tqdm(os.listdir(folder_path)):
-        id = filename.split(".")[0]  # letter id and footnote
-        file_path = os.path.join(folder_path, filename)
-        with jsonlines.open(file_path, "r") as reader:
-            messages = list(reader)
+    prompt_store = PromptStore(folder_path)
+    for letter_id, n_footnote, messages in tqdm(prompt_store):
+        id = f"{letter_id}_{n_footnote}"  # letter id and footnote
         request_dict = {
             "custom_id": id, 
             "method": "POST", 
@@ -1,9 +1,17 @@
 import argparse
-import os
+import os, sys
 import pandas as pd
 import json
 import jsonlines
 from tqdm import tqdm
+# typed footnote_df, only reading the columns needed
+module_path = "../data_analysis_and_preparation"
+sys.path.append(module_path)
+from footnote_store import read_footnote_df
+module_path = "../generate_data_prep"
+sys.path.append(module_path)
+from prompt_store import PromptStoreWriter
+from generate_instruction import map_letters
 
 # open the meta data file
 def get_letter_ids(split):
@@ -11,7 +19,7 @@ def get_letter_ids(split):
         samples = json.load(injson)
     return samples[split]
 
-footnote_df = pd.read_csv("../../data/footnote_downsized_df.csv")
+footnote_df = read_footnote_df("../../data/footnote_downsized_df.parquet", columns=["letter_id", "n_footnote", "xml_sentence"])
 
 
 # get the letter, get the sentence with the footnote
@@ -28,12 +36,19 @@ def make_prompt(n_footnote, xml_sentence):
     return messages
 
 
+def make_letter_prompts(task):
+    """prompts of a letter, list of (n_footnote, messages)"""
+    letter_id, rows = task
+    return [(row["n_footnote"], make_prompt(row["n_footnote"], row["xml_sentence"])) for row in rows]
+
+
 # create the prompt for the question
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("split", type=str, choices=["train", "dev", "test"])
     parser.add_argument("--example", action="store_true", default=False)  # only do 5 example letters for testing purposes
+    parser.add_argument("--workers", default=1, type=int, help="number of processes making the prompts, default=1")
     args = parser.parse_args()
     split = args.split
     example = args.example
@@ -48,14 +63,13 @@ if __name__ == "__main__":
     if example:
         letter_ids = letter_ids[:5]
 
-    # go over letters
-    for letter_id in tqdm(letter_ids):
-
-        letter_df = footnote_df[footnote_df["letter_id"]==int(letter_id)]
-        for _, row in letter_df.iterrows():
-            messages = make_prompt(row.n_footnote, row.xml_sentence)
-            outfile_name = f"{letter_id}_{row.n_footnote}.jsonl"
-            outfile_path = os.path.join(out_path, outfile_name)
-            with jsonlines.open(outfile_path, "w") as outfile:
-                outfile.write_all(messages)
-        
+    # rows per letter, grouped once instead of filtering the df for every letter
+    rows_per_letter = {letter_id: letter_df.to_dict("records") for letter_id, letter_df in footnote_df.groupby("letter_id", sort=False)}
+    tasks = [(letter_id, rows_per_letter.get(int(letter_id), [])) for letter_id in letter_ids]
+
+    # go over letters, the prompts are written in the order of the letters
+    prompt_store = PromptStoreWriter(out_path)
+    for (letter_id, _), prompts in zip(tasks, map_letters(make_letter_prompts, tasks, args.workers)):
+        for n_footnote, messages in prompts:
+            prompt_store.write(letter_id, n_footnote, messages)
+    prompt_store.close()
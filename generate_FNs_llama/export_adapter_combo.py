@@ -0,0 +1,54 @@
+#####
+# Save an adapter combination once, so the generation and perplexity jobs don't have to combine the adapters at every start
+# default: the combined (weighted) adapter alone, as safetensors, loaded on top of the base model
+# --merge: the adapter merged into the weights of the (not quantized) model, a plain checkpoint
+# load_model / get_model in run_llama_over_prompts.py take it from --combo_dir if it is there
+
+import argparse
+import os, json
+import run_llama_over_prompts as llama
+from run_llama_over_prompts import load_model, combo_name, combo_path, base_model_id
+
+
+def export_adapter_combo(size, adapters, combo_dir, quantized=True, merge=False):
+    """combine the adapters like load_model does and save the result under combo_path"""
+    if merge and quantized:
+        print("merging into the 4bit model is lossy, use --not_quantized with --merge")
+        exit(1)
+
+    load_model(size, adapters, quantized)
+    model, tokenizer = llama.model, llama.tokenizer
+    name = combo_name(adapters)
+    out_path = combo_path(combo_dir, size, adapters, quantized)
+    os.makedirs(out_path, exist_ok=True)
+
+    if merge:
+        model = model.merge_and_unload()
+        model.config.merged_adapter = name  # for the names of the output files
+        model.save_pretrained(out_path, safe_serialization=True)
+        tokenizer.save_pretrained(out_path)
+    else:
+        # only the combined adapter, peft puts adapters not called "default" into a subfolder
+        model.save_pretrained(combo_dir, selected_adapters=[name], safe_serialization=True)
+        saved_path = os.path.join(combo_dir, name)
+        for filename in os.listdir(saved_path):
+            os.replace(os.path.join(saved_path, filename), os.path.join(out_path, filename))
+        os.rmdir(saved_path)
+
+    with open(os.path.join(out_path, "combo.json"), "w", encoding="utf-8") as outfile:
+        json.dump({"base_model": base_model_id(size, quantized), "adapters": adapters, "name": name, "merged": merge}, outfile, indent=2)
+    print(f"saved {name} to {out_path}")
+    return out_path
+
+
+if __name__ == "__main__":
+    # example call: python export_adapter_combo.py 8 EA qa bible --combo_dir /data/nbauer/adapter_combos
+    parser = argparse.ArgumentParser()
+    parser.add_argument("size", choices=["8", "70"], help="Size of the llama model, either 8 or 70")
+    parser.add_argument("adapters", nargs="+", help="adapters to combine, in the same order as for run_llama_over_prompts.py")
+    parser.add_argument("--combo_dir", default="/data/nbauer/adapter_combos", help="where to save the combination, default=/data/nbauer/adapter_combos")
+    parser.add_argument("--merge", action="store_true", default=False, help="merge the adapter into the model weights (needs --not_quantized)")
+    parser.add_argument("--not_quantized", action="store_true", default=False, help="use the original model from Meta instead of the 4bit one")
+    args = parser.parse_args()
+
+    export_adapter_combo(args.size, args.adapters, args.combo_dir, not args.not_quantized, args.merge)
@@ -0,0 +1,184 @@
+#####
+# Number of new tokens per footnote, instead of the same 256 for every prompt
+# most footnotes are short (len_footnote, labels like short or lex), but a generation that does not stop runs until the limit.
+# The limit of a footnote is a high quantile of the length of the footnotes with the same edition and position
+# in the letter (sentence), from the footnote_df without the letters that are generated.
+# Only what is known when prompting is used: a label can be given if it is predicted from the prompt,
+# the labels of the reference footnotes only with gold_labels (not for evaluation runs, the limit then depends on the reference)
+# In addition the generation stops at patterns that only come after the end of a footnote (StopOnPatterns)
+# DecodeStats counts the decode steps, to compare with the fixed budget
+
+import sys
+import re
+import math
+import torch
+from transformers import StoppingCriteria
+
+FIXED_MAX_NEW_TOKENS = 256
+TOKENS_PER_WORD = 3.0  # without a tokenizer, the generated footnotes have markup (persName, placeName, ...) around the words
+# the generated footnote is the content of the note, anything of these means it is over
+STOP_PATTERNS = ["</note>", "<note", "</s>", "\n\n"]
+# n_sentence of the footnote: opening of the letter, ..., long letters
+POSITION_BINS = [0, 2, 5, 15, 40, math.inf]
+POSITION_LABELS = ["1-2", "3-5", "6-15", "16-40", "41-"]
+NOTE_CONTENT_REGEX = re.compile(r"<note[^>]*>(.*?)</note>", re.DOTALL)
+
+
+def trim_at_stop(text, patterns=STOP_PATTERNS):
+    """the footnote without the stop pattern and what comes after it"""
+    end = len(text)
+    for pattern in patterns:
+        position = text.find(pattern)
+        if position != -1:
+            end = min(end, position)
+    return text[:end].rstrip()
+
+
+class DecodeStats:
+    """decode steps of the generations with the footnote budget, compared to FIXED_MAX_NEW_TOKENS for every prompt"""
+
+    def __init__(self):
+        self.prompts = 0
+        self.budget = 0  # sum of the limits of the prompts
+        self.steps = 0  # decode steps done (a row of a batch only until it is finished)
+        self.ended = {"eos": 0, "pattern": 0, "limit": 0}
+
+    def report(self):
+        fixed = self.prompts * FIXED_MAX_NEW_TOKENS
+        saved = fixed - self.steps
+        return (f"decode steps: {self.steps} for {self.prompts} prompts, {fixed} with the fixed budget of {FIXED_MAX_NEW_TOKENS} "
+                f"(at most {saved} saved, {100 * saved / max(fixed, 1):.0f}%), limits: {self.budget} tokens, "
+                f"ended by eos: {self.ended['eos']}, by an end of note pattern: {self.ended['pattern']}, at the limit: {self.ended['limit']}")
+
+
+class StopOnPatterns(StoppingCriteria):
+    """stops a row when the end of its new tokens contains one of the patterns, and counts the decode steps in stats
+    max_new_tokens: one for all rows or a list with the limit of every row of a batch
+    a new one for every call of generate (the length of the prompt is taken at the first step)"""
+
+    def __init__(self, tokenizer, eos_token_ids, max_new_tokens, stats:DecodeStats, patterns=STOP_PATTERNS, tail_tokens=8):
+        self.tokenizer = tokenizer
+        self.eos_token_ids = eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids]
+        self.max_new_tokens = max_new_tokens
+        self.stats = stats
+        self.patterns = patterns
+        self.tail_tokens = tail_tokens
+        self.prompt_length = None
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1] - 1
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+            if not isinstance(self.max_new_tokens, list):
+                self.max_new_tokens = [self.max_new_tokens] * input_ids.shape[0]
+        n_new = input_ids.shape[1] - self.prompt_length
+        for row in range(input_ids.shape[0]):
+            if self.done[row]:
+                continue
+            self.stats.steps += 1
+            last_token = int(input_ids[row, -1])
+            if last_token in self.eos_token_ids:
+                self.done[row] = True
+                self.stats.ended["eos"] += 1
+                continue
+            start = max(self.prompt_length, input_ids.shape[1] - self.tail_tokens)
+            tail = self.tokenizer.decode(input_ids[row, start:])
+            if any(pattern in tail for pattern in self.patterns):
+                self.done[row] = True
+                self.stats.ended["pattern"] += 1
+            elif n_new >= self.max_new_tokens[row]:
+                self.done[row] = True
+                self.stats.ended["limit"] += 1
+        return self.done.clone()
+
+
+class FootnoteBudget:
+    """max_new_tokens per footnote from the lengths of similar footnotes
+    the most specific group (edition, position) with at least min_count footnotes is used,
+    with a label (predicted, or the gold labels with gold_labels) first the groups with the label"""
+
+    GROUPS = [["edition", "position"], ["edition"]]
+    LABEL_GROUPS = [["label", "edition", "position"], ["label", "edition"], ["label"]]
+
+    def __init__(self, quantiles:dict, default:float, footnotes:dict, quantile=0.95, margin=1.2, min_tokens=32, max_tokens=FIXED_MAX_NEW_TOKENS, gold_labels=False):
+        self.quantile = quantile
+        self.quantiles = quantiles  # tuple of the group columns -> {group values: tokens}
+        self.default = default
+        self.footnotes = footnotes  # (letter_id, n_footnote) -> (labels, edition, position)
+        self.margin = margin
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.gold_labels = gold_labels  # labels of the reference footnotes, not for evaluation runs
+
+    @staticmethod
+    def footnote_lengths(footnote_df, tokenizer=None):
+        """length of the footnotes in tokens, counted with the tokenizer (content of the note with the markup)
+        or estimated from len_footnote (words)"""
+        import pandas as pd
+        if tokenizer is None:
+            return footnote_df["len_footnote"].astype(float) * TOKENS_PER_WORD
+        contents = [match.group(1) if (match := NOTE_CONTENT_REGEX.search(str(xml))) else "" for xml in footnote_df["xml_footnote"]]
+        return pd.Series([len(ids) for ids in tokenizer(contents, add_special_tokens=False)["input_ids"]], index=footnote_df.index, dtype=float)
+
+    @classmethod
+    def fit(cls, footnote_df, exclude_letters=(), tokenizer=None, quantile=0.95, min_count=30, **kwargs):
+        """quantiles of the footnote lengths per group, the letters in exclude_letters (the ones generated) are not used
+        the labels, editions and positions of all footnotes are kept to look them up"""
+        import numpy as np
+        import pandas as pd
+        footnote_df = footnote_df.copy()
+        footnote_df["letter_id"] = footnote_df["letter_id"].astype(str)
+        footnote_df["n_footnote"] = footnote_df["n_footnote"].astype(str)
+        footnote_df["edition"] = footnote_df["edition"].astype(str)
+        footnote_df["position"] = pd.cut(footnote_df["n_sentence"].astype(float), POSITION_BINS, labels=POSITION_LABELS).astype(str)
+        # a footnote can have several labels ("lex, bibl"), counted for each of them
+        footnote_df["labels"] = footnote_df["label"].astype(str).str.split(", ")
+        footnotes = {(letter_id, n_footnote): (labels, edition, position) for letter_id, n_footnote, labels, edition, position
+                     in zip(footnote_df["letter_id"], footnote_df["n_footnote"], footnote_df["labels"], footnote_df["edition"], footnote_df["position"])}
+
+        train_df = footnote_df[~footnote_df["letter_id"].isin({str(letter_id) for letter_id in exclude_letters})]
+        train_df = train_df.assign(tokens=cls.footnote_lengths(train_df, tokenizer)).explode("labels").rename(columns={"labels": "label_single"})
+        quantiles = {}
+        for group in cls.LABEL_GROUPS + cls.GROUPS:
+            columns = ["label_single" if column == "label" else column for column in group]
+            grouped = train_df.groupby(columns)["tokens"]
+            counts = grouped.size()
+            values = grouped.quantile(quantile)[counts >= min_count]
+            quantiles[tuple(group)] = {key if isinstance(key, tuple) else (key,): value for key, value in values.items()}
+        default = float(np.quantile(train_df["tokens"], quantile)) if len(train_df) else FIXED_MAX_NEW_TOKENS
+        return cls(quantiles, default, footnotes, quantile, **kwargs)
+
+    @classmethod
+    def from_data(cls, footnote_df_path, exclude_letters=(), tokenizer=None, **kwargs):
+        # pandas and pyarrow only needed with the footnote budget
+        sys.path.append("../data_analysis_and_preparation")
+        from footnote_store import read_footnote_df
+        columns = ["letter_id", "edition", "n_footnote", "n_sentence", "len_footnote", "label"] + (["xml_footnote"] if tokenizer is not None else [])
+        return cls.fit(read_footnote_df(footnote_df_path, columns=columns), exclude_letters, tokenizer, **kwargs)
+
+    def _tokens(self, label, edition, position):
+        values = {"label": label, "edition": edition, "position": position}
+        for group in (self.LABEL_GROUPS if label is not None else []) + self.GROUPS:
+            tokens = self.quantiles[tuple(group)].get(tuple(values[column] for column in group))
+            if tokens is not None:
+                return tokens
+        return self.default
+
+    def max_new_tokens(self, letter_id, n_footnote, label=None):
+        """limit for the footnote from its edition and position, label: predicted from the prompt (optional)
+        with gold_labels the largest one of the labels of the reference footnote. Footnotes not in the footnote_df get max_tokens"""
+        footnote = self.footnotes.get((str(letter_id), str(n_footnote)))
+        if footnote is None:
+            return self.max_tokens
+        labels, edition, position = footnote
+        if label is not None:
+            labels = [label]
+        elif not self.gold_labels:
+            labels = [None]
+        tokens = max(self._tokens(label, edition, position) for label in labels)
+        return int(min(self.max_tokens, max(self.min_tokens, math.ceil(tokens * self.margin))))
+
+    def describe(self):
+        """what changes the footnotes apart from the limits, for the generation cache (the limit is part of the key of every prompt)"""
+        return {"stop_patterns": STOP_PATTERNS}
@@ -0,0 +1,106 @@
+#####
+# Cache of generated footnotes (sqlite), shared between runs
+# the same prompts come up again and again: dev_100 is part of dev, test_human_eval overlaps with test,
+# and runs are started again after a crash or with another output name
+# key: base model, adapter (combination), hash of the prompt as rendered by the chat template and the generation arguments
+# (with the footnote budget also the max_new_tokens of the prompt)
+# only for greedy decoding, with sampling every run should give new footnotes
+# at most max_entries are kept, the ones not used for the longest time are removed first (LRU)
+
+import argparse
+import os, json, time, hashlib
+import sqlite3
+
+DEFAULT_MAX_ENTRIES = 200000
+
+
+def prompt_hash(prompt_text):
+    return hashlib.sha1(prompt_text.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.scope = ""
+        # same as the job ledger: no WAL (network filesystems), transactions are started explicitly
+        self.connection = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS generations (
+            key TEXT PRIMARY KEY, model TEXT, adapter TEXT, generated TEXT, last_used REAL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS generations_last_used ON generations (last_used)")
+
+    def set_model(self, model_id, adapter, generation_kwargs:dict):
+        """model, adapter and generation arguments of the following get and put"""
+        self.model_id = model_id
+        self.adapter = adapter
+        self.scope = json.dumps([model_id, adapter, generation_kwargs], sort_keys=True, default=str)
+
+    def key(self, prompt_text, max_new_tokens=None):
+        """key of a prompt (rendered by the chat template) for the model set with set_model
+        max_new_tokens: the limit of the prompt if it is not the same for all (footnote budget)"""
+        return hashlib.sha1(f"{self.scope}\t{max_new_tokens}\t{prompt_hash(prompt_text)}".encode("utf-8")).hexdigest()
+
+    def get(self, keys:list):
+        """generated footnote for every key, None if it is not in the cache"""
+        found = {}
+        for start in range(0, len(keys), 500):  # sqlite has a limit on the number of parameters
+            chunk = keys[start:start+500]
+            rows = self.connection.execute(f"SELECT key, generated FROM generations WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            found.update(rows)
+        if found:
+            self.connection.executemany("UPDATE generations SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return [found.get(key) for key in keys]
+
+    def put(self, keys:list, generated_footnotes:list):
+        """add the generated footnotes (None is not cached), then remove the least recently used beyond max_entries"""
+        now = time.time()
+        rows = [(key, self.model_id, self.adapter, generated, now) for key, generated in zip(keys, generated_footnotes) if generated is not None]
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.executemany("INSERT OR REPLACE INTO generations (key, model, adapter, generated, last_used) VALUES (?, ?, ?, ?, ?)", rows)
+            n_entries = cursor.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+            if n_entries > self.max_entries:
+                cursor.execute("DELETE FROM generations WHERE key IN (SELECT key FROM generations ORDER BY last_used LIMIT ?)", (n_entries - self.max_entries,))
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def report(self):
+        return f"generation cache: {self.hits} hits, {self.misses} misses, hit rate {100 * self.hit_rate():.1f}%"
+
+    def counts(self):
+        """number of cached footnotes per model and adapter"""
+        return self.connection.execute("SELECT model, adapter, COUNT(*) FROM generations GROUP BY model, adapter").fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    # example call: python generation_cache.py status /data/nbauer/data/model_responses/llama/generation_cache.sqlite
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["status", "clear"], help="status: cached footnotes per model and adapter, clear: remove everything")
+    parser.add_argument("cache_path")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.cache_path):
+        print(f"{args.cache_path} does not exist")
+        exit(1)
+    cache = GenerationCache(args.cache_path)
+    if args.mode == "status":
+        for model_id, adapter, n in cache.counts():
+            print(f"{model_id}\t{adapter}\t{n}")
+    elif args.mode == "clear":
+        cache.connection.execute("DELETE FROM generations")
+        print("cleared")
+    cache.close()
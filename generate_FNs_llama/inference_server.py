@@ -0,0 +1,328 @@
+#####
+# Local inference server, keeps the model and the adapters loaded between experiments
+# POST /generate {"messages": [...], "adapter": "EA", "do_sample": true} -> {"generated": "..."}
+# (messages in the same format as the prompts in the prompt store), GET /health -> adapters, waiting and running requests
+# Continuous batching: the requests are decoded together token by token, a new request joins the running batch
+# after its prefill and a finished one leaves it right away, instead of waiting for the whole batch to finish.
+# All requests of a running batch use the same adapter, requests for another adapter wait until the batch is empty.
+# run_llama_over_prompts.py --server http://127.0.0.1:8765 sends its prompts here instead of loading a model
+
+import argparse
+import json, time
+import threading
+import collections
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+def cache_tensors(cache):
+    """(keys, values) of every layer of a DynamicCache"""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))  # older versions of transformers
+
+def make_cache(tensors):
+    from transformers import DynamicCache
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(tensors):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+def pad_left(tensor, length, dim):
+    """zeros on the left of dim, up to length"""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([torch.zeros(shape, dtype=tensor.dtype, device=tensor.device), tensor], dim=dim)
+
+
+class Request:
+    """one prompt (token ids) with its generation parameters, done is set when generated is complete"""
+
+    def __init__(self, input_ids:list, adapter="base", max_new_tokens=256, do_sample=True, temperature=0.6, top_p=0.9):
+        self.input_ids = input_ids
+        self.adapter = adapter
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated = []
+        self.error = None
+        self.done = threading.Event()
+
+
+def sample_tokens(logits, requests):
+    """next token of every row, greedy or with temperature and top p (as in generation_kwargs)"""
+    tokens = []
+    for row, request in zip(logits, requests):
+        if not request.do_sample:
+            tokens.append(int(torch.argmax(row)))
+            continue
+        probs = torch.softmax(row.float() / request.temperature, dim=-1)
+        sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+        # keep the smallest set of tokens with at least top_p of the probability
+        keep = torch.cumsum(sorted_probs, dim=-1) - sorted_probs < request.top_p
+        sorted_probs = sorted_probs * keep
+        tokens.append(int(sorted_ids[torch.multinomial(sorted_probs / sorted_probs.sum(), 1)]))
+    return tokens
+
+
+def request_params(data:dict):
+    """max_new_tokens, do_sample, temperature and top_p of a request, ValueError if one of them is not valid
+    (checked before the request reaches the engine thread, where an error fails all running requests)"""
+    params = {"max_new_tokens": data.get("max_new_tokens", 256), "do_sample": data.get("do_sample", True),
+              "temperature": data.get("temperature", 0.6), "top_p": data.get("top_p", 0.9)}
+    if type(params["max_new_tokens"]) is not int or params["max_new_tokens"] < 1:
+        raise ValueError("max_new_tokens has to be a positive integer")
+    if not isinstance(params["do_sample"], bool):
+        raise ValueError("do_sample has to be true or false")
+    for name in ["temperature", "top_p"]:
+        if type(params[name]) not in (int, float) or not params[name] > 0:
+            raise ValueError(f"{name} has to be a positive number")
+    if params["top_p"] > 1:
+        raise ValueError("top_p has to be at most 1")
+    return params
+
+
+class ContinuousBatcher:
+    """decodes the running requests together, one token per step, the batch is left padded
+    run() is the loop of the engine thread, submit() can be called from any thread"""
+
+    def __init__(self, model, eos_token_ids, max_batch=8):
+        self.model = model
+        self.eos_token_ids = set(eos_token_ids)
+        self.max_batch = max_batch
+        self.waiting = collections.deque()
+        self.condition = threading.Condition()
+        self.adapter = None
+        self.reset()
+
+    def reset(self):
+        self.running = []  # requests in the batch, the rows of the cache
+        self.layers = None  # (keys, values) per layer, [batch, heads, length, head_dim]
+        self.attention_mask = None  # [batch, length], 0 for the padding
+        self.next_tokens = None  # [batch, 1]
+
+    def submit(self, request):
+        with self.condition:
+            self.waiting.append(request)
+            self.condition.notify()
+
+    def stats(self):
+        return {"waiting": len(self.waiting), "running": len(self.running), "adapter": self.adapter}
+
+    def _set_adapter(self, adapter):
+        if adapter == self.adapter or not hasattr(self.model, "peft_config"):
+            self.adapter = adapter
+            return
+        if adapter == "base":
+            self.model.base_model.disable_adapter_layers()
+        else:
+            self.model.base_model.enable_adapter_layers()
+            self.model.set_adapter(adapter)
+        self.adapter = adapter
+
+    def _admit(self):
+        """requests that can join the batch now: same adapter as the running ones, up to max_batch"""
+        with self.condition:
+            while not self.waiting and not self.running:
+                self.condition.wait()
+            if not self.running and self.waiting:
+                try:
+                    self._set_adapter(self.waiting[0].adapter)
+                except Exception as e:  # the request asking for the adapter fails, not the engine
+                    request = self.waiting.popleft()
+                    request.error = f"{type(e).__name__}: {e}"
+                    request.done.set()
+                    return []
+            admitted = []
+            still_waiting = collections.deque()
+            while self.waiting:
+                request = self.waiting.popleft()
+                if request.adapter == self.adapter and len(self.running) + len(admitted) < self.max_batch:
+                    admitted.append(request)
+                else:
+                    still_waiting.append(request)
+            self.waiting = still_waiting
+        return admitted
+
+    def _finished(self, request):
+        return len(request.generated) >= request.max_new_tokens or (request.generated and request.generated[-1] in self.eos_token_ids)
+
+    def _join(self, request):
+        """prefill of a new request, then it is added to the batch (both padded to the same length)"""
+        input_ids = torch.tensor([request.input_ids], device=self.model.device)
+        outputs = self.model(input_ids=input_ids, use_cache=True)
+        request.generated.append(sample_tokens(outputs.logits[:, -1, :], [request])[0])
+        if self._finished(request):
+            request.done.set()
+            return
+
+        layers = cache_tensors(outputs.past_key_values)
+        attention_mask = torch.ones_like(input_ids)
+        next_tokens = torch.tensor([[request.generated[-1]]], device=self.model.device)
+        if self.running:
+            length = max(attention_mask.shape[1], self.attention_mask.shape[1])
+            layers = [(torch.cat([pad_left(keys, length, 2), pad_left(new_keys, length, 2)]), torch.cat([pad_left(values, length, 2), pad_left(new_values, length, 2)]))
+                      for (keys, values), (new_keys, new_values) in zip(self.layers, layers)]
+            attention_mask = torch.cat([pad_left(self.attention_mask, length, 1), pad_left(attention_mask, length, 1)])
+            next_tokens = torch.cat([self.next_tokens, next_tokens])
+        self.layers, self.attention_mask, self.next_tokens = layers, attention_mask, next_tokens
+        self.running.append(request)
+
+    def _step(self):
+        """one token for every running request, the finished ones leave the batch"""
+        attention_mask = torch.cat([self.attention_mask, torch.ones_like(self.next_tokens)], dim=1)
+        # the new token comes after all real tokens of its row (the padding is left)
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+        outputs = self.model(input_ids=self.next_tokens, attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=make_cache(self.layers), use_cache=True)
+        self.layers, self.attention_mask = cache_tensors(outputs.past_key_values), attention_mask
+
+        tokens = sample_tokens(outputs.logits[:, -1, :], self.running)
+        keep = []
+        for i, (request, token) in enumerate(zip(self.running, tokens)):
+            request.generated.append(token)
+            if self._finished(request):
+                request.done.set()
+            else:
+                keep.append(i)
+
+        if len(keep) < len(self.running):
+            if not keep:
+                self.reset()
+                return
+            rows = torch.tensor(keep, device=self.attention_mask.device)
+            self.running = [self.running[i] for i in keep]
+            self.attention_mask = self.attention_mask[rows]
+            # columns that are padding in all remaining rows are not needed anymore
+            start = int((self.attention_mask.sum(dim=0) > 0).nonzero()[0])
+            self.attention_mask = self.attention_mask[:, start:]
+            self.layers = [(keys[rows][:, :, start:], values[rows][:, :, start:]) for keys, values in self.layers]
+            tokens = [tokens[i] for i in keep]
+        self.next_tokens = torch.tensor(tokens, device=self.attention_mask.device).unsqueeze(1)
+
+    def run(self):
+        while True:
+            admitted = self._admit()
+            try:
+                with torch.no_grad():
+                    # a request leaves admitted once it is in the batch (or already finished)
+                    while admitted:
+                        self._join(admitted[0])
+                        admitted.pop(0)
+                    if self.running:
+                        self._step()
+            except Exception as e:  # e.g. out of memory, the running and admitted requests fail, the server keeps going
+                for request in self.running + admitted:
+                    request.error = f"{type(e).__name__}: {e}"
+                    request.done.set()
+                self.reset()
+                torch.cuda.empty_cache()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+
+def make_handler(batcher, tokenizer, adapters):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _respond(self, status, data):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self._respond(404, {"error": "unknown path"})
+            self._respond(200, dict(batcher.stats(), adapters=adapters))
+
+        def do_POST(self):
+            if self.path != "/generate":
+                return self._respond(404, {"error": "unknown path"})
+            try:
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except ValueError as e:  # also json.JSONDecodeError
+                return self._respond(400, {"error": f"malformed request: {e}"})
+            if not isinstance(data, dict) or not isinstance(data.get("messages"), list) or not data["messages"]:
+                return self._respond(400, {"error": "the request needs a non-empty list of messages"})
+            adapter = data.get("adapter", "base")
+            if adapter not in adapters:
+                return self._respond(400, {"error": f"adapter {adapter} is not loaded, loaded: {adapters}"})
+            try:
+                params = request_params(data)
+            except ValueError as e:
+                return self._respond(400, {"error": str(e)})
+
+            try:
+                input_ids = tokenizer.apply_chat_template(data["messages"], add_generation_prompt=True, tokenize=True)
+            except Exception as e:  # e.g. messages without role or content
+                return self._respond(400, {"error": f"malformed messages: {e}"})
+            if not isinstance(input_ids, list):  # newer versions of transformers return a BatchEncoding
+                input_ids = input_ids["input_ids"]
+            request = Request(input_ids, adapter, **params)
+            start = time.time()
+            batcher.submit(request)
+            request.done.wait()
+            if request.error:
+                return self._respond(500, {"error": request.error})
+            self._respond(200, {"generated": tokenizer.decode(request.generated, skip_special_tokens=True),
+                                "prompt_tokens": len(input_ids), "new_tokens": len(request.generated), "seconds": time.time() - start})
+
+        def log_message(self, format, *args):  # no line per request on stderr
+            pass
+
+    return Handler
+
+
+class ServerClient:
+    """client for the inference server, same messages as for generate_chat"""
+
+    def __init__(self, url=DEFAULT_URL, timeout=3600):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def generate(self, messages:list, adapter="base", **params):
+        data = json.dumps(dict(params, messages=messages, adapter=adapter)).encode("utf-8")
+        request = urllib.request.Request(f"{self.url}/generate", data=data, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())["generated"]
+
+    def health(self):
+        with urllib.request.urlopen(f"{self.url}/health", timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    # example call: python inference_server.py 70 --adapters base EA qa EA+qa+bible --port 8765
+    from run_llama_over_prompts import load_sweep
+    import run_llama_over_prompts as llama
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("size", choices=["8", "70"], help="Size of the llama model, either 8 or 70")
+    parser.add_argument("--adapters", nargs="*", default=["base"], help="'base', adapters or combinations like EA+qa+bible to keep loaded, default=base")
+    parser.add_argument("--port", default=8765, type=int)
+    parser.add_argument("--max_batch", default=8, type=int, help="requests decoded together, default=8")
+    args = parser.parse_args()
+
+    adapters = load_sweep(args.size, args.adapters)
+    model, tokenizer = llama.model, llama.tokenizer
+    eos_token_ids = [tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")]
+    batcher = ContinuousBatcher(model, eos_token_ids, args.max_batch)
+    batcher.start()
+
+    # only on localhost
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(batcher, tokenizer, adapters))
+    print(f"serving {adapters} on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,137 @@
+#####
+# Ledger of the footnotes to generate for a run (sqlite)
+# every footnote is a job: pending -> claimed (with a lease) -> done (with the generated footnote) or failed
+# several workers (also on different machines with a shared filesystem) can take jobs from the same ledger,
+# a job whose lease ran out (worker crashed) is given to the next worker asking for jobs
+# the results are committed one by one, at the end they are exported to the usual csv
+
+import argparse
+import os, csv, time, socket
+import sqlite3
+
+PENDING, CLAIMED, DONE, FAILED = "pending", "claimed", "done", "failed"
+
+
+def worker_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobLedger:
+
+    def __init__(self, path, lease_seconds=3600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # no WAL, it does not work on network filesystems. isolation_level=None: transactions are started explicitly
+        self.connection = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            letter_id TEXT, n_footnote TEXT, length INTEGER DEFAULT 0,
+            state TEXT DEFAULT 'pending', worker TEXT, lease_until REAL DEFAULT 0, attempts INTEGER DEFAULT 0,
+            result TEXT, error TEXT,
+            PRIMARY KEY (letter_id, n_footnote))""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, length)")
+
+    def _transaction(self, statements):
+        """run (sql, parameters) in one write transaction, BEGIN IMMEDIATE takes the write lock right away"""
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            results = [cursor.execute(sql, parameters).fetchall() for sql, parameters in statements]
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        return results
+
+    def add_jobs(self, keys, lengths=None):
+        """add (letter_id, n_footnote) jobs, jobs already in the ledger stay as they are
+        with the token lengths of the prompts, the jobs are claimed by length (prompts of similar length together)"""
+        if lengths is None:
+            lengths = [0] * len(keys)
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany("INSERT OR IGNORE INTO jobs (letter_id, n_footnote, length) VALUES (?, ?, ?)",
+                           [(str(letter_id), str(n_footnote), length) for (letter_id, n_footnote), length in zip(keys, lengths)])
+        cursor.execute("COMMIT")
+
+    def import_csv(self, csv_path):
+        """mark the footnotes in a csv of an earlier run (letter_id, n_footnote, generated_footnote) as done"""
+        with open(csv_path, "r", encoding="utf-8") as infile:
+            reader = csv.reader(infile, escapechar="\\")
+            next(reader)  # skip header
+            rows = [(row[2], row[0], row[1]) for row in reader if len(row) == 3]
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.executemany("INSERT OR IGNORE INTO jobs (letter_id, n_footnote) VALUES (?, ?)", [row[1:] for row in rows])
+        cursor.executemany(f"UPDATE jobs SET state = '{DONE}', result = ? WHERE letter_id = ? AND n_footnote = ? AND state != '{DONE}'", rows)
+        cursor.execute("COMMIT")
+        return len(rows)
+
+    def claim(self, worker, n=1):
+        """claim up to n jobs that are pending or whose lease ran out, returns their (letter_id, n_footnote)"""
+        now = time.time()
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # first the jobs of crashed workers, then the pending ones (both use the index on state and length)
+            keys = cursor.execute(f"SELECT letter_id, n_footnote FROM jobs WHERE state = '{CLAIMED}' AND lease_until < ? ORDER BY length, rowid LIMIT ?", (now, n)).fetchall()
+            if len(keys) < n:
+                keys += cursor.execute(f"SELECT letter_id, n_footnote FROM jobs WHERE state = '{PENDING}' ORDER BY length, rowid LIMIT ?", (n - len(keys),)).fetchall()
+            cursor.executemany(f"UPDATE jobs SET state = '{CLAIMED}', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE letter_id = ? AND n_footnote = ?",
+                               [(worker, now + self.lease_seconds, letter_id, n_footnote) for letter_id, n_footnote in keys])
+            cursor.execute("COMMIT")
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        return keys
+
+    def complete(self, key, result):
+        self._transaction([(f"UPDATE jobs SET state = '{DONE}', result = ?, error = NULL WHERE letter_id = ? AND n_footnote = ?",
+                            (result, str(key[0]), str(key[1])))])
+
+    def fail(self, key, error):
+        """the job goes back to pending, unless it already failed max_attempts times"""
+        self._transaction([(f"UPDATE jobs SET state = CASE WHEN attempts >= ? THEN '{FAILED}' ELSE '{PENDING}' END, error = ?, lease_until = 0 "
+                            "WHERE letter_id = ? AND n_footnote = ?", (self.max_attempts, str(error), str(key[0]), str(key[1])))])
+
+    def keys(self):
+        """set of all (letter_id, n_footnote) in the ledger"""
+        return set(self.connection.execute("SELECT letter_id, n_footnote FROM jobs").fetchall())
+
+    def done_keys(self):
+        """set of (letter_id, n_footnote) that are done"""
+        return set(self.connection.execute(f"SELECT letter_id, n_footnote FROM jobs WHERE state = '{DONE}'").fetchall())
+
+    def counts(self):
+        """number of jobs per state"""
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def export_csv(self, csv_path):
+        """write the done jobs to the csv (letter_id, n_footnote, generated_footnote), in the order they were added"""
+        tmp_path = f"{csv_path}.{os.getpid()}.tmp"  # several workers may export at the end
+        with open(tmp_path, "w", encoding="utf-8", newline="") as outfile:
+            outfile.write("letter_id,n_footnote,generated_footnote\n")
+            writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, escapechar="\\")
+            writer.writerows(self.connection.execute(f"SELECT letter_id, n_footnote, result FROM jobs WHERE state = '{DONE}' ORDER BY rowid"))
+        os.replace(tmp_path, csv_path)
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    # example call: python job_ledger.py status /data/nbauer/data/model_responses/llama/llama-8B-base_instruct-add_test.ledger.sqlite
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["status", "export"], help="status: number of jobs per state, export: write the done jobs to a csv")
+    parser.add_argument("ledger_path")
+    parser.add_argument("--csv_path", default="", help="export: csv to write, default is next to the ledger")
+    args = parser.parse_args()
+
+    ledger = JobLedger(args.ledger_path)
+    if args.mode == "status":
+        print(ledger.counts())
+    elif args.mode == "export":
+        csv_path = args.csv_path or args.ledger_path.replace(".ledger.sqlite", ".csv")
+        ledger.export_csv(csv_path)
+        print(f"wrote {csv_path}")
+    ledger.close()
@@ -0,0 +1,66 @@
+#####
+# Memory-aware scheduling of the prompts
+# instead of trying a prompt and catching the out of memory error, the memory needed is estimated from the number of tokens
+# and the model config. Prompts that don't fit are replaced by shorter versions (see prompt_variants in run_llama_over_prompts.py)
+# or skipped with a reason, the rest is put into batches that fit into the memory budget.
+# No torch needed here, so the decisions can be checked on cpu with made up budgets (test_model_output.py memory_scheduler)
+
+GB = 1024**3
+
+
+class MemoryModel:
+    """rough estimate of the memory needed for generating from a prompt, on top of the model weights
+    kv cache for the prompt and the new tokens, plus the activations of the prefill
+    (the logits are computed in float32 for every position of the prompt, for long prompts that is the biggest part)"""
+
+    def __init__(self, n_layers, n_kv_heads, head_dim, hidden_size, vocab_size, dtype_bytes=2, max_new_tokens=256, overhead=1.2):
+        self.kv_bytes_per_token = 2 * n_layers * n_kv_heads * head_dim * dtype_bytes  # keys and values
+        self.activation_bytes_per_token = 4 * hidden_size * dtype_bytes + 4 * vocab_size
+        self.max_new_tokens = max_new_tokens
+        self.overhead = overhead  # for what is not counted (fragmentation, temporary buffers)
+
+    @classmethod
+    def from_config(cls, config, dtype_bytes=2, max_new_tokens=256, overhead=1.2):
+        """from a transformers config (e.g. model.config)"""
+        n_heads = config.num_attention_heads
+        n_kv_heads = getattr(config, "num_key_value_heads", None) or n_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // n_heads
+        return cls(config.num_hidden_layers, n_kv_heads, head_dim, config.hidden_size, config.vocab_size, dtype_bytes, max_new_tokens, overhead)
+
+    def prompt_bytes(self, n_tokens):
+        return self.overhead * (self.kv_bytes_per_token * (n_tokens + self.max_new_tokens) + self.activation_bytes_per_token * n_tokens)
+
+    def batch_bytes(self, n_prompts, max_n_tokens):
+        """left padded, every prompt of the batch is as long as the longest one"""
+        return n_prompts * self.prompt_bytes(max_n_tokens)
+
+    def max_tokens(self, budget):
+        """longest prompt that fits into the budget (bytes)"""
+        n_tokens = (budget / self.overhead - self.kv_bytes_per_token * self.max_new_tokens) / (self.kv_bytes_per_token + self.activation_bytes_per_token)
+        return max(0, int(n_tokens))
+
+
+def choose_variant(variants, memory_model, budget):
+    """first (name, n_tokens) of the variants (in order of preference) that fits into the budget, None if none does
+    variants can be a generator, the shorter versions are only made if needed"""
+    for name, n_tokens in variants:
+        if memory_model.prompt_bytes(n_tokens) <= budget:
+            return name, n_tokens
+    return None
+
+
+def schedule(jobs, memory_model, budget, max_batch=1):
+    """put the jobs (key, n_tokens, ...) into batches
+    sorted by length (little padding), as many prompts per batch as fit into the budget, at most max_batch
+    jobs that don't fit on their own should have been replaced or skipped by choose_variant, they get a batch of their own"""
+    batches = []
+    batch = []
+    for job in sorted(jobs, key=lambda job: job[1]):
+        # sorted, thus the new job is the longest of the batch
+        if batch and (len(batch) >= max_batch or memory_model.batch_bytes(len(batch) + 1, job[1]) > budget):
+            batches.append(batch)
+            batch = []
+        batch.append(job)
+    if batch:
+        batches.append(batch)
+    return batches
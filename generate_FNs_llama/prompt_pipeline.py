@@ -0,0 +1,114 @@
+#####
+# Pipeline around the generation: the next prompts are read and tokenized in background threads (bounded),
+# the results are written to the csv by another thread, so the model does not wait for the disk or the tokenizer
+# StageTimer counts the seconds spent in every stage, if the stages overlap their sum is bigger than the wall clock time
+
+import time
+import threading
+import queue
+import csv
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StageTimer:
+    """seconds and calls per stage, from several threads"""
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def report(self):
+        wall = time.perf_counter() - self.start
+        lines = [f"wall clock: {wall:.1f}s"]
+        for stage, seconds in self.seconds.items():
+            lines.append(f"{stage}: {seconds:.1f}s in {self.calls[stage]} calls ({100 * seconds / max(wall, 1e-9):.0f}% of the wall clock)")
+        lines.append(f"overlap (sum of the stages - wall clock): {sum(self.seconds.values()) - wall:.1f}s")
+        return "\n".join(lines)
+
+
+class Prefetcher:
+    """load(chunk) for the next chunks in a thread pool, at most depth ahead, yielded in the order of the chunks
+    the time the consumer waits for a chunk is counted as wait_for_input"""
+
+    def __init__(self, chunks, load, workers=2, depth=8, timer=None):
+        self.chunks = iter(chunks)
+        self.load = load
+        self.workers = workers
+        self.depth = depth
+        self.timer = timer or StageTimer()
+
+    def __iter__(self):
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = deque()
+            for chunk in self.chunks:
+                futures.append(pool.submit(self.load, chunk))
+                if len(futures) >= self.depth:
+                    break
+            while futures:
+                with self.timer("wait_for_input"):
+                    result = futures.popleft().result()
+                # keep the queue full
+                for chunk in self.chunks:
+                    futures.append(pool.submit(self.load, chunk))
+                    break
+                yield result
+
+
+class ResultWriter:
+    """appends rows to the csv in a background thread, flushed after every batch of rows that is there"""
+
+    def __init__(self, outfile_path, timer=None):
+        self.outfile_path = outfile_path
+        self.timer = timer or StageTimer()
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, rows):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(rows)
+
+    def _run(self):
+        try:
+            with open(self.outfile_path, "a", encoding="utf-8") as outfile:
+                writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, escapechar="\\")
+                done = False
+                while not done:
+                    rows = [self.queue.get()]
+                    # everything else that is already waiting goes into the same flush
+                    while not self.queue.empty():
+                        rows.append(self.queue.get())
+                    with self.timer("write"):
+                        for chunk in rows:
+                            if chunk is None:
+                                done = True
+                                continue
+                            writer.writerows(chunk)
+                        outfile.flush()
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
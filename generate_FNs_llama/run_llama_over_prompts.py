@@ -1,9 +1,9 @@
 # functions to run over the prompts
 
-import os, csv
+import os, sys, csv
 from tqdm import tqdm
 import jsonlines
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig, StoppingCriteriaList
 import torch
 from peft import PeftModel
 import argparse
@@ -11,10 +11,24 @@ import time
 import threading
 import GPUtil
 import logging
+module_path = "../generate_data_prep"
+sys.path.append(module_path)
+from prompt_store import PromptStore, prefix_hash
+from token_index import token_lengths, long_letters
+from job_ledger import JobLedger, worker_name
+from memory_scheduler import MemoryModel, choose_variant, schedule, GB
+from inference_server import ServerClient
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from prompt_pipeline import StageTimer, Prefetcher, ResultWriter
+from generation_cache import GenerationCache, DEFAULT_MAX_ENTRIES
+from footnote_budget import FootnoteBudget, DecodeStats, StopOnPatterns, trim_at_stop, FIXED_MAX_NEW_TOKENS
 
 global model
 global tokenizer
 
+DO_SAMPLE = True  # False for greedy decoding (--greedy), only then the generation cache is used
+DECODE_STATS = None  # DecodeStats with --footnote_budget, then the generation also stops at the end of the note
+
 adapter_map = {
   "EA": "pretrain-EA",
   "qa": "instruct-qa",
@@ -41,86 +55,525 @@ def monitor_gpu(interval=5):
         time.sleep(interval)
 
 
-def count_prompt_tokens(model_id, prompt_type, split):
-  tokenizer = AutoTokenizer.from_pretrained(model_id)
+def count_prompt_tokens(model_id, prompt_type, split, max_tokens=20000, workers=1):
+  """token lengths of the prompts and the letters with prompts over max_tokens, from the cached token index (see token_index.py)"""
   data_path = DATA_DIR
   folder_path = os.path.join(data_path, f"prompts/{prompt_type}/{split}")
-  tokenizer = AutoTokenizer.from_pretrained(model_id)
-  token_len_list = []
-  long_letters_set = set()
-  for filename in tqdm(os.listdir(folder_path)):
-    filepath = os.path.join(folder_path, filename)
-    with jsonlines.open(filepath) as infile:
-      messages = [line for line in infile]
-
-    # get the input ids
-    input_ids = tokenizer.apply_chat_template(
-    messages,
-    add_generation_prompt=True,
-    return_tensors="pt"
-    )
-    if input_ids.shape[1] > 20000:
-      letter_id = filename.split("_")[0]
-      long_letters_set.add(letter_id)
-    token_len_list.append(input_ids.shape[1])
-  return token_len_list, long_letters_set
+  lengths = token_lengths(folder_path, model_id, workers)
+  return list(lengths.values()), long_letters(lengths, max_tokens)
+
+def generation_kwargs(model, tokenizer, do_sample=None, max_new_tokens=FIXED_MAX_NEW_TOKENS):
+  """arguments for model.generate, the same for single prompts and batches
+  max_new_tokens can be a list with the limit of every prompt of a batch (only used with --footnote_budget)"""
+  if do_sample is None:
+    do_sample = DO_SAMPLE
+  if "llama" in model.config._name_or_path:
+    eos_token_id = [
+        tokenizer.eos_token_id,
+        tokenizer.convert_tokens_to_ids("<|eot_id|>")
+    ]
+    pad_token_id = tokenizer.eos_token_id
+  else:  # for the Qwen model
+    eos_token_id = tokenizer.eos_token_id
+    pad_token_id = tokenizer.pad_token_id
+  kwargs = {"max_new_tokens": max(max_new_tokens) if isinstance(max_new_tokens, list) else max_new_tokens,
+            "eos_token_id": eos_token_id, "pad_token_id": pad_token_id, "do_sample": do_sample}
+  if do_sample:
+    kwargs.update({"temperature": 0.6, "top_p": 0.9})
+  if DECODE_STATS is not None:
+    kwargs["stopping_criteria"] = StoppingCriteriaList([StopOnPatterns(tokenizer, eos_token_id, max_new_tokens, DECODE_STATS)])
+  return kwargs
+
+def left_pad(batch_ids, pad_token_id, device="cpu"):
+  """input_ids and attention_mask for prompts of different length, padded on the left so the generation starts right after every prompt"""
+  max_len = max(len(ids) for ids in batch_ids)
+  input_ids = torch.full((len(batch_ids), max_len), pad_token_id, dtype=torch.long)
+  attention_mask = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+  for i, ids in enumerate(batch_ids):
+    input_ids[i, max_len-len(ids):] = torch.tensor(ids, dtype=torch.long)
+    attention_mask[i, max_len-len(ids):] = 1
+  return input_ids.to(device), attention_mask.to(device)
+
+def sdp_backends(padded:bool, cached:bool=False):
+  """kernels of scaled dot product attention for a llama model: FlashAttention if possible,
+  it does not take an attention mask, which transformers passes for padded batches and for prompts on top of
+  past_key_values (PrefixCache), then the other kernels are allowed as well"""
+  flash_only = not padded and not cached
+  return {"enable_flash": True, "enable_math": not flash_only, "enable_mem_efficient": not flash_only}
+
+def generate_ids(batch_ids:list, model, kwargs:dict, past_key_values=None):
+  """generate for tokenized prompts (lists of ids), returns the generated ids for each prompt
+  past_key_values of the first tokens of the prompt(s) can be passed, then only the rest is computed"""
+  input_ids, attention_mask = left_pad(batch_ids, kwargs["pad_token_id"], model.device)
+  if past_key_values is not None:
+    kwargs = dict(kwargs, past_key_values=past_key_values)
+
+  if "llama" in model.config._name_or_path:
+    # enable FlashAttention
+    with torch.backends.cuda.sdp_kernel(**sdp_backends(padded=len({len(ids) for ids in batch_ids}) > 1, cached=past_key_values is not None)):
+      outputs = model.generate(input_ids, attention_mask=attention_mask, **kwargs)
+  else:
+    outputs = model.generate(input_ids, attention_mask=attention_mask, **kwargs)
+
+  return [output[input_ids.shape[1]:] for output in outputs]
+
+def tokenize_chat(messages:list, tokenizer, add_generation_prompt=True):
+  """ids of the prompt as a list"""
+  input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=add_generation_prompt, tokenize=True)
+  if not isinstance(input_ids, list):  # newer versions of transformers return a BatchEncoding
+    input_ids = input_ids["input_ids"]
+  return input_ids
 
 # Generating with a chat model
-def generate_chat(messages:list, model, tokenizer):
-    input_ids = tokenizer.apply_chat_template(
-        messages,
-        add_generation_prompt=True,
-        return_tensors="pt"
-    ).to(model.device)
+def generate_chat(messages:list, model, tokenizer, do_sample=None, input_ids=None, max_new_tokens=FIXED_MAX_NEW_TOKENS):
+    if input_ids is None:  # not tokenized beforehand
+        input_ids = tokenize_chat(messages, tokenizer)
     
-    log_message = f"prompt length: {input_ids.shape[1]}"
+    log_message = f"prompt length: {len(input_ids)}"
     logging.info(log_message)
 
-    # generate the attention mask, got a warning that it might be needed, though I am not sure if that is necessary
-    attention_mask = torch.ones(input_ids.shape, dtype=torch.long, device=model.device)
-
-    if "llama" in model.config._name_or_path:
-      terminators = [
-          tokenizer.eos_token_id,
-          tokenizer.convert_tokens_to_ids("<|eot_id|>")
-      ]
-
-      # enable FlashAttention
-      with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=False, enable_mem_efficient=False):
-        outputs = model.generate(
-            input_ids,
-            attention_mask=attention_mask,
-            max_new_tokens=256,
-            eos_token_id=terminators,
-            do_sample=True,
-            temperature=0.6,
-            top_p=0.9,
-            pad_token_id=tokenizer.eos_token_id
-      )
-    else:  # for the Qwen model
-        outputs = model.generate(
-        input_ids,
-        attention_mask=attention_mask,
-        max_new_tokens=256,
-        eos_token_id=tokenizer.eos_token_id,
-        do_sample=True,
-        temperature=0.6,
-        top_p=0.9,
-        pad_token_id=tokenizer.pad_token_id
-    )
-
-
-
-    response = outputs[0][input_ids.shape[-1]:]
+    response = generate_ids([input_ids], model, generation_kwargs(model, tokenizer, do_sample, max_new_tokens))[0]
     return tokenizer.decode(response, skip_special_tokens=True)
 
+def generate_batch(messages_list:list, model, tokenizer, do_sample=None, batch_ids=None, max_new_tokens=FIXED_MAX_NEW_TOKENS):
+    """like generate_chat, but for several prompts at once (left padded)"""
+    if batch_ids is None:
+        batch_ids = [tokenize_chat(messages, tokenizer) for messages in messages_list]
 
-def run_llama_over_prompts(prompt_type, split, long_letters_set=set(), batch_size=0, testrun=False, model_name=""):
+    log_message = f"batch of {len(batch_ids)}, prompt lengths: {min(len(ids) for ids in batch_ids)}-{max(len(ids) for ids in batch_ids)}"
+    logging.info(log_message)
+
+    responses = generate_ids(batch_ids, model, generation_kwargs(model, tokenizer, do_sample, max_new_tokens))
+    return [tokenizer.decode(response, skip_special_tokens=True) for response in responses]
+
+
+class PrefixCache:
+  """past_key_values of the shared prefix of the prompts of a letter (system prompt and one-shot example),
+  computed once and reused for every footnote with the same prefix, so only the last user message is computed again"""
+
+  def __init__(self, model):
+    self.model = model
+    self.key = None
+    self.prefix_ids = None
+    self.past_key_values = None
+
+  def reset(self):
+    self.key = self.prefix_ids = self.past_key_values = None
+
+  def generate(self, key, input_ids:list, prefix_length:int, kwargs:dict):
+    """generated ids for the prompt, whose first prefix_length tokens are the prefix with this key
+    (prefix_length is only used when the key changes)"""
+    if key != self.key or input_ids[:len(self.prefix_ids)] != self.prefix_ids:
+      self.reset()
+      # at least one token of the prompt has to be left for generate
+      self.prefix_ids = input_ids[:min(prefix_length, len(input_ids) - 1)]
+      with torch.no_grad():
+        outputs = self.model(input_ids=torch.tensor([self.prefix_ids], device=self.model.device), use_cache=True)
+      self.past_key_values = outputs.past_key_values
+      self.key = key
+
+    try:
+      return generate_ids([input_ids], self.model, kwargs, past_key_values=self.past_key_values)[0]
+    finally:
+      # generate extends the cache in place, cut it back to the prefix for the next footnote (instead of copying it every time)
+      n_generated = self.past_key_values.get_seq_length() - len(self.prefix_ids)
+      if n_generated > 0:
+        self.past_key_values.crop(-n_generated)
+
+
+def shared_prefix_length(messages:list, input_ids:list, tokenizer):
+  """number of tokens of the prompt belonging to everything but the last message"""
+  prefix_ids = tokenize_chat(messages[:-1], tokenizer, add_generation_prompt=False)
+  length = 0
+  for prefix_id, input_id in zip(prefix_ids, input_ids):
+    if prefix_id != input_id:
+      break
+    length += 1
+  return length
+
+
+def generate_chat_with_prefix(key, messages:list, prefix_cache:PrefixCache, do_sample=None, input_ids=None, max_new_tokens=FIXED_MAX_NEW_TOKENS):
+  """generate_chat, reusing the past_key_values of the shared prefix if the prompt before had the same one"""
+  if input_ids is None:
+    input_ids = tokenize_chat(messages, tokenizer)
+  prefix_length = shared_prefix_length(messages, input_ids, tokenizer) if key != prefix_cache.key else len(prefix_cache.prefix_ids)
+
+  log_message = f"prompt length: {len(input_ids)}, shared prefix: {prefix_length}"
+  logging.info(log_message)
+
+  response = prefix_cache.generate(key, input_ids, prefix_length, generation_kwargs(model, tokenizer, do_sample, max_new_tokens))
+  return tokenizer.decode(response, skip_special_tokens=True)
+
+
+def length_buckets(keys:list, lengths:list, batch_size:int):
+  """batches of keys with prompts of similar length, to pad as little as possible"""
+  order = sorted(range(len(keys)), key=lambda i: lengths[i])
+  return [[keys[i] for i in order[start:start+batch_size]] for start in range(0, len(order), batch_size)]
+
+
+def generate_with_fallback(letter_id, n_footnote, messages, prompt_type, folder_path, long_letters_set, input_ids=None, max_new_tokens=FIXED_MAX_NEW_TOKENS):
+  """generate_chat, if it runs out of memory, try again with a shorter one-shot example
+  and for instruct_add with the instruct_add_window prompt
+  returns the generated footnote and the version of the prompt it is from (as in prompt_variants), (None, None) if nothing fits"""
+  try:
+    return generate_chat(messages, model, tokenizer, input_ids=input_ids, max_new_tokens=max_new_tokens), "original"
+  except RuntimeError as e:
+    if 'CUDA out of memory' not in str(e):
+      # Raise other exceptions
+      raise e
+  logging.info("CUDA out of memory")
+  # Try to replace the one-shot with the shorter letter
+  print(f"letter {letter_id} causes out of memory error, trying with shorter prompt")
+  messages = [messages[0]] + ONE_SHOT_10224 + messages[3:]  # example user question and answer
+  torch.cuda.empty_cache()
+  try:
+    return generate_chat(messages, model, tokenizer, max_new_tokens=max_new_tokens), "short_example"
+  # If it still does not work...
+  except RuntimeError as e:
+    if 'CUDA out of memory' not in str(e):
+      raise e
+  logging.info("CUDA out of memory")
+  print(f"letter {letter_id} causes out of memory error, even with shorter prompt")
+  long_letters_set.add(letter_id)
+  torch.cuda.empty_cache()
+
+  # if we have the instruct_add prompt, we can add the window version
+  if prompt_type == "instruct_add":
+    substitute_store = PromptStore(folder_path.replace("instruct_add", "instruct_add_window"))
+    messages = substitute_store.get(letter_id, n_footnote)
+    substitute_store.close()
+    try: 
+      return generate_chat(messages, model, tokenizer, max_new_tokens=max_new_tokens), "window"
+    except RuntimeError as e:
+      if 'CUDA out of memory' not in str(e):
+        raise e
+      torch.cuda.empty_cache()
+  return None, None
+
+
+def generate_keys(keys:list, prompt_store, prompt_type, folder_path, long_letters_set, batched=False, prefix_cache=None, messages_list=None, batch_ids=None, generation_cache=None, footnote_budget=None):
+  """generated footnotes for the prompts (None if a prompt does not fit), as one batch or one by one
+  with a prefix_cache the shared prefix of the prompts of a letter is computed only once
+  messages_list and batch_ids can be read and tokenized beforehand (see prompt_pipeline.py)
+  with a generation_cache (greedy decoding) the footnotes generated before are taken from there, only the others are generated
+  with a footnote_budget (footnote_budget.py) every prompt gets its own max_new_tokens and the footnotes end at the end of note patterns"""
+  if messages_list is None:
+    messages_list = [prompt_store.get(letter_id, n_footnote) for letter_id, n_footnote in keys]
+  if batch_ids is None:
+    batch_ids = [None] * len(keys)
+
+  if footnote_budget is not None:
+    max_new_tokens = [footnote_budget.max_new_tokens(letter_id, n_footnote) for letter_id, n_footnote in keys]
+  else:
+    max_new_tokens = [FIXED_MAX_NEW_TOKENS] * len(keys)
+
+  if generation_cache is None:
+    return generate_uncached(keys, messages_list, batch_ids, max_new_tokens, prompt_store, prompt_type, folder_path, long_letters_set, batched, prefix_cache, footnote_budget)[0]
+
+  cache_keys = [generation_cache.key(tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False), limit if footnote_budget is not None else None)
+                for messages, limit in zip(messages_list, max_new_tokens)]
+  generated_footnotes = generation_cache.get(cache_keys)
+  missing = [i for i, generated_footnote in enumerate(generated_footnotes) if generated_footnote is None]
+  if missing:
+    new_footnotes, variants = generate_uncached([keys[i] for i in missing], [messages_list[i] for i in missing], [batch_ids[i] for i in missing],
+                                                [max_new_tokens[i] for i in missing], prompt_store, prompt_type, folder_path, long_letters_set, batched, prefix_cache, footnote_budget)
+    # only footnotes of the prompt itself are cached, not the ones of a shorter version after running out of memory (depends on the gpu)
+    original = [j for j, variant in enumerate(variants) if variant == "original"]
+    generation_cache.put([cache_keys[missing[j]] for j in original], [new_footnotes[j] for j in original])
+    for i, generated_footnote in zip(missing, new_footnotes):
+      generated_footnotes[i] = generated_footnote
+  return generated_footnotes
+
+
+def generate_uncached(keys:list, messages_list:list, batch_ids:list, max_new_tokens:list, prompt_store, prompt_type, folder_path, long_letters_set, batched=False, prefix_cache=None, footnote_budget=None):
+  """generate_keys without the generation cache, returns the generated footnotes and the version of the prompt each is from"""
+  torch.cuda.empty_cache()
+
+  generated_footnotes = None
+  variants = ["original"] * len(keys)
+  if batched:
+    try:
+      generated_footnotes = generate_batch(messages_list, model, tokenizer, batch_ids=None if None in batch_ids else batch_ids,
+                                           max_new_tokens=max_new_tokens if footnote_budget is not None else FIXED_MAX_NEW_TOKENS)
+    except RuntimeError as e:
+      if 'CUDA out of memory' not in str(e):
+        raise e
+      # the batch does not fit, one by one (with the shorter prompts if needed)
+      logging.info("CUDA out of memory for the batch")
+      torch.cuda.empty_cache()
+  if generated_footnotes is None:
+    generated_footnotes, variants = generate_one_by_one(keys, messages_list, batch_ids, max_new_tokens, prompt_store, prompt_type, folder_path, long_letters_set, prefix_cache)
+
+  if footnote_budget is not None and DECODE_STATS is not None:
+    DECODE_STATS.prompts += len(keys)
+    DECODE_STATS.budget += sum(max_new_tokens)
+    # the stop pattern (and whatever came in the same token) is not part of the footnote
+    generated_footnotes = [None if generated_footnote is None else trim_at_stop(generated_footnote) for generated_footnote in generated_footnotes]
+  return generated_footnotes, variants
+
+
+def generate_one_by_one(keys:list, messages_list:list, batch_ids:list, max_new_tokens:list, prompt_store, prompt_type, folder_path, long_letters_set, prefix_cache=None):
+  """generate_keys without batches, with the shorter prompts if a prompt does not fit
+  returns the generated footnotes and the version of the prompt each is from"""
+  generated_footnotes = []
+  variants = []
+  for (letter_id, n_footnote), messages, input_ids, limit in zip(keys, messages_list, batch_ids, max_new_tokens):
+    generated_footnote, variant = None, "original"
+    if prefix_cache is not None:
+      key = prompt_store.prefix_key(letter_id, n_footnote) or prefix_hash(messages[:-1])
+      try:
+        generated_footnote = generate_chat_with_prefix(key, messages, prefix_cache, input_ids=input_ids, max_new_tokens=limit)
+      except RuntimeError as e:
+        if 'CUDA out of memory' not in str(e):
+          raise e
+        logging.info("CUDA out of memory with the cached prefix")
+        prefix_cache.reset()
+    if generated_footnote is None:
+      generated_footnote, variant = generate_with_fallback(letter_id, n_footnote, messages, prompt_type, folder_path, long_letters_set, input_ids, limit)
+    torch.cuda.empty_cache()
+    generated_footnotes.append(generated_footnote)
+    variants.append(variant)
+  return generated_footnotes, variants
+
+
+def run_with_ledger(ledger_path, outfile_path, unfinished, prompt_store, prompt_type, folder_path, long_letters_set, batch_size=0, prefix_cache=None, generation_cache=None, footnote_budget=None):
+  """take jobs from the ledger until there are none left, several workers can run on the same ledger
+  at the end the done jobs are written to the csv"""
+  ledger = JobLedger(ledger_path)
+  if os.path.exists(outfile_path):
+    print(f"footnotes already in {outfile_path}: {ledger.import_csv(outfile_path)}")
+
+  # add the jobs not yet in the ledger (another worker may have added them already)
+  in_ledger = ledger.keys()
+  new_keys = [key for key in unfinished if key not in in_ledger]
+  lengths = None
+  if batch_size:  # claimed by length, so the batches have prompts of similar length
+    index_lengths = token_lengths(prompt_store.path, tokenizer.name_or_path)
+    lengths = [index_lengths[key] for key in new_keys]
+  ledger.add_jobs(new_keys, lengths)
+  print(f"jobs: {ledger.counts()}")
+
+  worker = worker_name()
+  progress = tqdm()
+  while True:
+    keys = ledger.claim(worker, max(batch_size, 1))
+    if not keys:
+      break
+    try:
+      generated_footnotes = generate_keys(keys, prompt_store, prompt_type, folder_path, long_letters_set, batch_size > 0, prefix_cache, generation_cache=generation_cache, footnote_budget=footnote_budget)
+    except BaseException as e:
+      for key in keys:
+        ledger.fail(key, repr(e))
+      raise e
+    for key, generated_footnote in zip(keys, generated_footnotes):
+      if generated_footnote is None:
+        ledger.fail(key, "out of memory, also with the shorter prompts")
+      else:
+        ledger.complete(key, generated_footnote)
+    progress.update(len(keys))
+  progress.close()
+
+  print(f"jobs: {ledger.counts()}")
+  ledger.export_csv(outfile_path)
+  ledger.close()
+
+
+def split_document(messages:list):
+  """instruction and document of the last user message (separated by the first blank line), None if it has no document"""
+  parts = messages[-1]["content"].split("\n\n", 1)
+  return tuple(parts) if len(parts) == 2 else None
+
+
+def truncate_context(messages:list, n_footnote, max_tokens:int, tokenizer):
+  """cut the document in the last user message to the part around the footnote, so the prompt has at most max_tokens
+  returns None if not even the prompt without the document fits, or if there is no document to cut"""
+  parts = split_document(messages)
+  if parts is None:
+    return None
+  instruction, document = parts
+
+  def with_document(text):
+    return messages[:-1] + [{"role": "user", "content": f"{instruction}\n\n{text}"}]
+
+  n_tokens_without = len(tokenize_chat(with_document(""), tokenizer))
+  if n_tokens_without >= max_tokens:
+    return None
+
+  center = document.find(f'n="{n_footnote}"')
+  if center == -1:
+    center = len(document) // 2
+  # characters to keep on each side, from the characters per token of the document
+  chars_per_token = len(document) / max(1, len(tokenize_chat(with_document(document), tokenizer)) - n_tokens_without)
+  half_window = int((max_tokens - n_tokens_without) * chars_per_token / 2)
+  for _ in range(10):
+    truncated = with_document(document[max(0, center - half_window):center + half_window])
+    if len(tokenize_chat(truncated, tokenizer)) <= max_tokens:
+      return truncated
+    half_window = int(half_window * 0.8)
+  return None
+
+
+def prompt_variants(letter_id, n_footnote, messages:list, prompt_type, substitute_store=None, max_tokens=0):
+  """the prompt and its shorter versions, in the order they are tried: (name, messages)
+  original, shorter one-shot example, window prompt (for instruct_add), document cut around the footnote"""
+  yield "original", messages
+  if len(messages) < 4:  # no one-shot example
+    return
+  short_example = [messages[0]] + ONE_SHOT_10224 + messages[3:]
+  yield "short_example", short_example
+  if substitute_store is not None and (letter_id, n_footnote) in substitute_store:
+    yield "window", substitute_store.get(letter_id, n_footnote)
+  if max_tokens:
+    truncated = truncate_context(short_example, n_footnote, max_tokens, tokenizer)
+    if truncated is not None:
+      yield "truncated", truncated
+
+
+def variant_messages(key, variant, prompt_store, prompt_type, substitute_store, max_tokens):
+  """messages of the variant chosen for the prompt (made again, to not keep all prompts in memory)"""
+  letter_id, n_footnote = key
+  for name, messages in prompt_variants(letter_id, n_footnote, prompt_store.get(letter_id, n_footnote), prompt_type, substitute_store, max_tokens):
+    if name == variant:
+      return messages
+
+
+def run_scheduled(outfile_path, unfinished, prompt_store, prompt_type, folder_path, memory_budget, batch_size=0):
+  """generate with the memory scheduler (memory_scheduler.py) instead of trying and catching out of memory errors
+  prompts that don't fit in any version are written with the reason to ..._skipped.csv"""
+  memory_model = MemoryModel.from_config(model.config)
+  max_tokens = memory_model.max_tokens(memory_budget)
+  print(f"memory budget: {memory_budget / GB:.1f}GB, longest prompt: {max_tokens} tokens")
+  substitute_store = None
+  if prompt_type == "instruct_add":
+    substitute_store = PromptStore(folder_path.replace("instruct_add", "instruct_add_window"))
+
+  # choose the version of every prompt that fits
+  jobs = []
+  skipped = []
+  variant_counts = {}
+  index_lengths = token_lengths(folder_path, tokenizer.name_or_path)
+  for letter_id, n_footnote in tqdm(unfinished, desc="planning"):
+    if memory_model.prompt_bytes(index_lengths[(letter_id, n_footnote)]) <= memory_budget:  # most prompts fit, no need to read them
+      jobs.append(((letter_id, n_footnote), index_lengths[(letter_id, n_footnote)], "original"))
+      variant_counts["original"] = variant_counts.get("original", 0) + 1
+      continue
+    variants = prompt_variants(letter_id, n_footnote, prompt_store.get(letter_id, n_footnote), prompt_type, substitute_store, max_tokens)
+    choice = choose_variant(((name, len(tokenize_chat(messages, tokenizer))) for name, messages in variants), memory_model, memory_budget)
+    if choice is None:
+      reason = "does not fit into the memory budget in any version"
+      if split_document(prompt_store.get(letter_id, n_footnote)) is None:
+        reason += " (no blank line before a document to cut)"
+      skipped.append([letter_id, n_footnote, reason])
+      continue
+    variant, n_tokens = choice
+    variant_counts[variant] = variant_counts.get(variant, 0) + 1
+    jobs.append(((letter_id, n_footnote), n_tokens, variant))
+  print(f"prompt versions: {variant_counts}, skipped: {len(skipped)}")
+
+  batches = schedule(jobs, memory_model, memory_budget, max(batch_size, 1))
+  with open(outfile_path, "a", encoding="utf-8") as outfile:
+    writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, escapechar="\\")
+    for batch in tqdm(batches):
+      torch.cuda.empty_cache()
+      messages_list = [variant_messages(key, variant, prompt_store, prompt_type, substitute_store, max_tokens) for key, _, variant in batch]
+      try:
+        generated_footnotes = generate_batch(messages_list, model, tokenizer)
+      except RuntimeError as e:
+        if 'CUDA out of memory' not in str(e):
+          raise e
+        # the estimate was too low, record it instead of trying other versions
+        logging.info("CUDA out of memory despite the estimate")
+        skipped += [[key[0], key[1], f"out of memory despite the estimate ({n_tokens} tokens, batch of {len(batch)})"] for key, n_tokens, _ in batch]
+        continue
+      writer.writerows([[letter_id, n_footnote, generated_footnote] for ((letter_id, n_footnote), _, _), generated_footnote in zip(batch, generated_footnotes)])
+      outfile.flush()
+
+  if skipped:
+    skipped_path = outfile_path.replace(".csv", "_skipped.csv")
+    with open(skipped_path, "a", encoding="utf-8") as outfile:
+      csv.writer(outfile).writerows(skipped)
+    print(f"skipped {len(skipped)} footnotes, see {skipped_path}")
+  if substitute_store is not None:
+    substitute_store.close()
+
+
+def run_client(outfile_path, unfinished, prompt_store, client, adapter_name, threads=8):
+  """send the prompts to the inference server (inference_server.py), several at once so they are batched there
+  with the same decoding as here (--greedy, max_new_tokens), the results are written in the order they come back"""
+  params = {"do_sample": DO_SAMPLE, "max_new_tokens": FIXED_MAX_NEW_TOKENS}
+  with open(outfile_path, "a", encoding="utf-8") as outfile, ThreadPoolExecutor(threads) as pool:
+    writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, escapechar="\\")
+    pending = {}
+    keys = iter(unfinished)
+    progress = tqdm(total=len(unfinished))
+    while True:
+      # a few more requests than threads, so the server always has the next ones
+      for key in keys:
+        pending[pool.submit(client.generate, prompt_store.get(*key), adapter_name, **params)] = key
+        if len(pending) >= 2 * threads:
+          break
+      if not pending:
+        break
+      done, _ = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        letter_id, n_footnote = pending.pop(future)
+        try:
+          writer.writerow([letter_id, n_footnote, future.result()])
+        except Exception as e:  # e.g. out of memory on the server, the footnote stays unfinished
+          logging.info(f"{letter_id}_{n_footnote} failed on the server: {e}")
+        progress.update(1)
+      outfile.flush()
+    progress.close()
+
+
+def run_pipelined(outfile_path, chunks, prompt_store, prompt_type, folder_path, long_letters_set, batched=False, prefix_cache=None, workers=2, generation_cache=None, footnote_budget=None):
+  """generate_keys for the chunks, while background threads read and tokenize the next chunks and write the results
+  prints the seconds per stage at the end"""
+  timer = StageTimer()
+  stores = []  # one prompt store per thread, reading seeks in the shards
+  local = threading.local()
+
+  def load(keys):
+    if not hasattr(local, "store"):
+      local.store = PromptStore(prompt_store.path)
+      stores.append(local.store)
+    with timer("read"):
+      messages_list = [local.store.get(letter_id, n_footnote) for letter_id, n_footnote in keys]
+    with timer("tokenize"):
+      batch_ids = [tokenize_chat(messages, tokenizer) for messages in messages_list]
+    return keys, messages_list, batch_ids
+
+  writer = ResultWriter(outfile_path, timer)
+  try:
+    for keys, messages_list, batch_ids in tqdm(Prefetcher(chunks, load, workers, depth=4 * workers, timer=timer), total=len(chunks)):
+      with timer("generate"):
+        generated_footnotes = generate_keys(keys, prompt_store, prompt_type, folder_path, long_letters_set, batched, prefix_cache, messages_list, batch_ids, generation_cache, footnote_budget)
+      writer.put([[letter_id, n_footnote, generated_footnote] for (letter_id, n_footnote), generated_footnote in zip(keys, generated_footnotes) if generated_footnote is not None])
+  finally:
+    writer.close()
+    for store in stores:
+      store.close()
+  print(timer.report())
+  logging.info(timer.report())
+
+
+def run_llama_over_prompts(prompt_type, split, long_letters_set=set(), batch_size=0, testrun=False, model_name="", reuse_prefix=False, ledger=False, memory_budget=0, adapter_name="", server=None, client_threads=8, prefetch_workers=0, cache_path="", cache_size=DEFAULT_MAX_ENTRIES, footnote_budget=False, footnote_budget_gold_labels=False):
   """run over the set specified. Saves in a csv file under model_responses
   Note that if there is already a file with that name it will only add the
-  ones that are not generated yet"""
+  ones that are not generated yet
+  with batch_size > 0 the prompts are generated in batches of similar length
+  with reuse_prefix (and no batches) the shared prefix of the prompts of a letter is computed only once
+  with ledger the jobs are tracked in a sqlite file next to the csv (see job_ledger.py), so several workers can run on the same split
+  with a memory_budget (bytes) the prompts are scheduled by their estimated memory instead of catching out of memory errors
+  adapter_name for the name of the csv, by default the active adapter of the model
+  with a server (ServerClient) the prompts are generated by the inference server instead of the model loaded here
+  with prefetch_workers > 0 the prompts are read and tokenized in background threads and the csv is written by another one
+  with a cache_path and greedy decoding the footnotes are cached there (see generation_cache.py), prompts generated before are not generated again
+  with footnote_budget the max_new_tokens of every footnote is predicted from similar footnotes and the generation stops at the end of the note (see footnote_budget.py)
+  footnote_budget_gold_labels: the limits also from the labels of the reference footnotes, not for evaluation runs"""
 
   global DATA_DIR
+  global DECODE_STATS
   global model
   global model_id
 
@@ -130,25 +583,59 @@ def run_llama_over_prompts(prompt_type, split, long_letters_set=set(), batch_siz
   if model_name == "":  # use default name
     model_name = model_id.split("/")[-1]
 
-  if type(model.active_adapter) == str:
-    adapter_name = model.active_adapter
-  else:
-    adapter_name = "base"
+  if adapter_name == "":
+    adapter_name = adapter_label(model)
   outfile_path = os.path.join(data_path, f"model_responses/llama/{model_name}-{adapter_name}_{prompt_type.replace('_', '-')}_{split.replace('_', '-')}.csv")
   if testrun:
     outfile_path = outfile_path.replace(".csv", "_testrun.csv")
   print(f"writing results to {outfile_path}")
 
-  finished = []  # tuples of letter_id and n_footnote that are already done
+  prompt_store = PromptStore(folder_path)
+  prefix_cache = PrefixCache(model) if reuse_prefix and batch_size == 0 else None
+  budget = None
+  DECODE_STATS = None
+  if footnote_budget:
+    if server is not None or memory_budget:
+      print("the footnote budget is not used with --server or --memory_budget")
+    else:
+      # statistics without the letters generated here
+      budget = FootnoteBudget.from_data(os.path.join(data_path, "footnote_downsized_df.parquet"), {key[0] for key in prompt_store.keys()}, tokenizer, gold_labels=footnote_budget_gold_labels)
+      DECODE_STATS = DecodeStats()
+
+  generation_cache = None
+  if cache_path and server is None and not memory_budget:
+    if DO_SAMPLE:
+      print("sampling, the generation cache is not used (--greedy to use it)")
+    else:
+      generation_cache = GenerationCache(cache_path, cache_size)
+      # the adapter by name, model.active_adapter is also set with disable_adapter (base in a sweep)
+      cache_kwargs = {key: value for key, value in generation_kwargs(model, tokenizer).items() if key not in ["eos_token_id", "pad_token_id", "stopping_criteria"]}
+      if budget is not None:  # the max_new_tokens of every prompt is part of its key
+        del cache_kwargs["max_new_tokens"]
+        cache_kwargs["footnote_budget"] = budget.describe()
+      generation_cache.set_model(model.config._name_or_path, adapter_name, cache_kwargs)
+
+  if ledger:
+    unfinished = [key for key in prompt_store.keys() if key[0] not in long_letters_set]
+    run_with_ledger(outfile_path.replace(".csv", ".ledger.sqlite"), outfile_path, unfinished, prompt_store, prompt_type, folder_path, long_letters_set, batch_size, prefix_cache, generation_cache, budget)
+    prompt_store.close()
+    if generation_cache is not None:
+      print(generation_cache.report())
+      generation_cache.close()
+    if DECODE_STATS is not None:
+      print(DECODE_STATS.report())
+    return
+
+  finished = set()  # tuples of letter_id and n_footnote that are already done
   if os.path.exists(outfile_path):
     with open(outfile_path, "r", encoding="utf-8") as infile:
       reader = csv.reader(infile)
       next(reader)  # skip header
       try:
-        finished = [(row[0], row[1]) for row in reader]
+        finished = {(row[0], row[1]) for row in reader}
       except IndexError:
         print("faulty csv file found, rewriting")
-        finished = []
+        finished = set()
 
   if not finished:  # if the file was non existent or faulty... rewrite
     print("no data yet")
@@ -158,66 +645,53 @@ def run_llama_over_prompts(prompt_type, split, long_letters_set=set(), batch_siz
       print(f"already finished generations: {len(finished)}")
 
   unfinished = []
-  for filename in os.listdir(folder_path):
-    letter_id = filename.split("_")[0]
-    n_footnote = filename.split("_")[1].split(".")[0]
+  for letter_id, n_footnote in prompt_store.keys():
     if (letter_id, n_footnote) in finished:
       continue
     # ignore the long letters for if specified
     if letter_id in long_letters_set:
       continue
-    unfinished.append((filename, letter_id, n_footnote))
+    unfinished.append((letter_id, n_footnote))
   print(f"total FNs to generate: {len(finished)+len(unfinished)}")
 
+  if server is not None:
+    run_client(outfile_path, unfinished, prompt_store, server, adapter_name, client_threads)
+    prompt_store.close()
+    return
+
+  if memory_budget:
+    run_scheduled(outfile_path, unfinished, prompt_store, prompt_type, folder_path, memory_budget, batch_size)
+    prompt_store.close()
+    return
+
   if batch_size == 0:
-    for filename, letter_id, n_footnote in tqdm(unfinished):
-      torch.cuda.empty_cache()
-      filepath = os.path.join(folder_path, filename)
-      with jsonlines.open(filepath) as infile:
-        messages = [line for line in infile]
-        old_prompt_input_tokens =  tokenizer.apply_chat_template(messages,add_generation_prompt=True,return_tensors="pt").shape[1]
-        try:
-          generated_footnote = generate_chat(messages, model, tokenizer)
-        except RuntimeError as e:
-          if 'CUDA out of memory' in str(e):
-            logging.info("CUDA out of memory")
-            # Try to replace the one-shot with the shorter letter
-            print(f"letter {letter_id} causes out of memory error, trying with shorter prompt")
-            messages[1] = ONE_SHOT_10224[0]  # example user question
-            messages[2] = ONE_SHOT_10224[1]  # example answer
-            new_prompt_input_tokens = tokenizer.apply_chat_template(messages,add_generation_prompt=True,return_tensors="pt").shape[1]
-            torch.cuda.empty_cache()
-            try:
-              generated_footnote = generate_chat(messages, model, tokenizer)
-            # If it still does not work...
-            except RuntimeError as e:
-              if 'CUDA out of memory' in str(e):
-                logging.info("CUDA out of memory")
-                print(f"letter {letter_id} causes out of memory error, even with shorter prompt")
-                long_letters_set.add(letter_id)
-                torch.cuda.empty_cache()
-
-                # if we have the instruct_add prompt, we can add the window version
-                if prompt_type == "instruct_add":
-                  substitute_filepath = filepath.replace("instruct_add", "instruct_add_window")
-                  with jsonlines.open(substitute_filepath) as infile:
-                    messages = [line for line in infile]
-                    try: 
-                      generated_footnote = generate_chat(messages, model, tokenizer)
-                    except RuntimeError as e:
-                      if 'CUDA out of memory' in str(e):
-                        torch.cuda.empty_cache()
-                        continue
-          else:
-              # Raise other exceptions
-              raise e
-        torch.cuda.empty_cache()
-      with open(outfile_path, "a", encoding="utf-8") as outfile:
-        writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, escapechar="\\")
-        writer.writerow([letter_id, n_footnote, generated_footnote])
+    # the prompts of a letter are one after the other in the store, so a cached prefix is computed once per letter
+    chunks = [[key] for key in unfinished]
+  else:
+    # token length of every prompt, to put prompts of similar length in the same batch
+    index_lengths = token_lengths(folder_path, tokenizer.name_or_path)
+    lengths = [index_lengths[key] for key in unfinished]
+    chunks = length_buckets(unfinished, lengths, batch_size)
 
+  if prefetch_workers:
+    run_pipelined(outfile_path, chunks, prompt_store, prompt_type, folder_path, long_letters_set, batch_size > 0, prefix_cache, prefetch_workers, generation_cache, budget)
   else:
-    print("Batching for generation not implemented...")
+    # the csv is opened once, every row (or batch) is flushed as soon as it is done, so the file stays resumable
+    with open(outfile_path, "a", encoding="utf-8") as outfile:
+      writer = csv.writer(outfile, quoting=csv.QUOTE_MINIMAL, escapechar="\\")
+      for keys in tqdm(chunks):
+        generated_footnotes = generate_keys(keys, prompt_store, prompt_type, folder_path, long_letters_set, batch_size > 0, prefix_cache, generation_cache=generation_cache, footnote_budget=budget)
+        writer.writerows([[letter_id, n_footnote, generated_footnote] for (letter_id, n_footnote), generated_footnote in zip(keys, generated_footnotes) if generated_footnote is not None])
+        outfile.flush()
+
+  prompt_store.close()
+  if generation_cache is not None:
+    print(generation_cache.report())
+    logging.info(generation_cache.report())
+    generation_cache.close()
+  if DECODE_STATS is not None:
+    print(DECODE_STATS.report())
+    logging.info(DECODE_STATS.report())
 
 
 def make_adapter_id(adapter, size):
@@ -228,15 +702,50 @@ def make_adapter_id(adapter, size):
     exit(1)
   return adapter_id
 
-def load_model(size, adapters=[], quantized=True):
-  """load the model with the adapters, if specified into global scope"""
+def base_model_id(size, quantized=True):
+  if quantized:
+    return f"unsloth/Meta-Llama-3.1-{size}B-Instruct-bnb-4bit"
+  return f"meta-llama/Llama-3.1-{size}B-Instruct"
+
+def combo_name(adapters):
+  """name of the adapter load_model makes from the adapters (the first one, then the others from the back)"""
+  return "-".join(adapters[:1] + adapters[:0:-1])
+
+def combo_path(combo_dir, size, adapters, quantized=True):
+  """where export_adapter_combo.py saves the combination"""
+  return os.path.join(combo_dir, f"llama-{size}B{'-bnb-4bit' if quantized else ''}-{combo_name(adapters)}")
+
+def adapter_label(model):
+  """name of the active adapter (combination) for the output files, also for a merged checkpoint"""
+  if getattr(model.config, "merged_adapter", None):
+    return model.config.merged_adapter
+  if type(model.active_adapter) == str:
+    return model.active_adapter
+  return "base"
+
+def load_model(size, adapters=[], quantized=True, combo_dir=""):
+  """load the model with the adapters, if specified into global scope
+  if the combination was exported to combo_dir before (export_adapter_combo.py), it is loaded from there"""
   global model
   global tokenizer
   
-  if quantized:
-    model_id = f"unsloth/Meta-Llama-3.1-{size}B-Instruct-bnb-4bit"
-  else:
-    model_id = f"meta-llama/Llama-3.1-{size}B-Instruct"
+  model_id = base_model_id(size, quantized)
+  adapters = list(adapters)  # the list is changed below
+
+  if combo_dir and len(adapters) > 1:
+    path = combo_path(combo_dir, size, adapters, quantized)
+    if os.path.exists(os.path.join(path, "config.json")):  # merged checkpoint, safetensors are memory-mapped
+      print(f"loading merged checkpoint {path}")
+      tokenizer = AutoTokenizer.from_pretrained(path)
+      model = AutoModelForCausalLM.from_pretrained(path)
+      return
+    if os.path.exists(os.path.join(path, "adapter_config.json")):  # one combined adapter
+      print(f"loading combined adapter {path}")
+      tokenizer = AutoTokenizer.from_pretrained(model_id)
+      model = AutoModelForCausalLM.from_pretrained(model_id)
+      model = PeftModel.from_pretrained(model, path, adapter_name=combo_name(adapters))
+      return
+    print(f"{path} not found, combining the adapters")
 
   tokenizer = AutoTokenizer.from_pretrained(model_id)
   model = AutoModelForCausalLM.from_pretrained(model_id)
@@ -265,9 +774,65 @@ def load_model(size, adapters=[], quantized=True):
       model.delete_adapter(current_adapter)
       model.delete_adapter(additional_adapter)
 
-def get_model(size, adapters=[], quantized=True):
+def load_sweep(size, adapter_specs:list, quantized=True):
+  """load the base model once with all adapters of a sweep into global scope
+  adapter_specs: "base", an adapter ("EA") or a combination ("EA+qa+bible", combined like load_model does)
+  returns the adapter name of every spec, switch between them with model.set_adapter"""
+  global model
+  global tokenizer
+
+  model_id = base_model_id(size, quantized)
+  tokenizer = AutoTokenizer.from_pretrained(model_id)
+  model = AutoModelForCausalLM.from_pretrained(model_id)
+
+  names = []
+  for spec in adapter_specs:
+    if spec == "base":
+      names.append("base")
+      continue
+    adapters = spec.split("+")
+
+    # the single adapters, each loaded once
+    for adapter in adapters:
+      if isinstance(model, PeftModel) and adapter in model.peft_config:
+        continue
+      if not isinstance(model, PeftModel):
+        model = PeftModel.from_pretrained(model, make_adapter_id(adapter, size), adapter_name=adapter)
+      else:
+        model.load_adapter(make_adapter_id(adapter, size), adapter_name=adapter)
+
+    # same order as in load_model: the first adapter with the last one, the result with the one before...
+    # the single adapters and the combinations are kept, other specs may need them
+    current_adapter = adapters[0]
+    for additional_adapter in adapters[:0:-1]:
+      new_adapter = f"{current_adapter}-{additional_adapter}"
+      if new_adapter not in model.peft_config:
+        model.add_weighted_adapter([current_adapter, additional_adapter], [1.0, 1.0], adapter_name=new_adapter, combination_type="linear")
+      current_adapter = new_adapter
+    names.append(current_adapter)
+
+  print(f"loaded adapters: {list(model.peft_config) if isinstance(model, PeftModel) else []}")
+  return names
+
+
+def run_sweep(adapter_names:list, prompt_type, split, **kwargs):
+  """run_llama_over_prompts for every adapter with the model loaded once (load_sweep), each adapter writes its own csv"""
+  for adapter_name in adapter_names:
+    print(f"--- {adapter_name} ---")
+    if adapter_name == "base":
+      if isinstance(model, PeftModel):
+        with model.disable_adapter():
+          run_llama_over_prompts(prompt_type, split, adapter_name="base", **kwargs)
+      else:
+        run_llama_over_prompts(prompt_type, split, adapter_name="base", **kwargs)
+    else:
+      model.set_adapter(adapter_name)
+      run_llama_over_prompts(prompt_type, split, adapter_name=adapter_name, **kwargs)
+
+
+def get_model(size, adapters=[], quantized=True, combo_dir=""):
   """Returns the model to use in other modules"""
-  load_model(size, adapters, quantized)
+  load_model(size, adapters, quantized, combo_dir)
   return model, tokenizer
 
 def main(args):
@@ -286,9 +851,39 @@ def main(args):
     monitor_thread.start()
 
   global DATA_DIR
+  global DO_SAMPLE
   DATA_DIR = args.dir
-  load_model(args.size, args.adapters)
-  run_llama_over_prompts(args.prompt, args.split, model_name=f"llama-{args.size}B")
+  DO_SAMPLE = not args.greedy
+  if args.server:
+    # the model is loaded in the inference server, here the prompts are only sent there
+    adapter_specs = args.sweep or ["+".join(args.adapters) or "base"]
+    adapter_names = ["base" if spec == "base" else combo_name(spec.split("+")) for spec in adapter_specs]
+  elif args.sweep:
+    adapter_names = load_sweep(args.size, args.sweep)
+  else:
+    load_model(args.size, args.adapters, combo_dir=args.combo_dir)
+  long_letters_set = set()
+  if args.max_prompt_tokens:
+    _, long_letters_set = count_prompt_tokens(base_model_id(args.size), args.prompt, args.split, args.max_prompt_tokens)
+    print(f"leaving out {len(long_letters_set)} letters with prompts over {args.max_prompt_tokens} tokens")
+  memory_budget = 0
+  if args.memory_budget == "auto":  # what is free after loading the model, with some margin
+    memory_budget = 0.9 * torch.cuda.mem_get_info()[0]
+  elif args.memory_budget:
+    memory_budget = float(args.memory_budget) * GB
+  run_kwargs = {"batch_size": args.batch_size, "model_name": f"llama-{args.size}B", "reuse_prefix": args.reuse_prefix, "ledger": args.ledger, "memory_budget": memory_budget,
+                "prefetch_workers": args.prefetch_workers, "cache_size": args.cache_size, "footnote_budget": args.footnote_budget,
+                "footnote_budget_gold_labels": args.footnote_budget_gold_labels,
+                "cache_path": "" if args.no_cache else args.cache_path or os.path.join(DATA_DIR, "model_responses/llama/generation_cache.sqlite")}
+  if args.server:
+    client = ServerClient(args.server)
+    print(f"server: {client.health()}")
+    for adapter_name in adapter_names:
+      run_llama_over_prompts(args.prompt, args.split, long_letters_set, adapter_name=adapter_name, server=client, client_threads=args.client_threads, **run_kwargs)
+  elif args.sweep:
+    run_sweep(adapter_names, args.prompt, args.split, long_letters_set=long_letters_set, **run_kwargs)
+  else:
+    run_llama_over_prompts(args.prompt, args.split, long_letters_set, **run_kwargs)
 
   if args.log_gpu_usage:
     # Stop the monitoring once the main task is done
@@ -306,8 +901,29 @@ if __name__=="__main__":
     default=[],
     help="A list of adapters, if multiple are specified, they are combined (default is an empty list)"
   )
+  parser.add_argument(
+    "--sweep",
+    nargs="*",
+    default=[],
+    help="Run the split once for every adapter with one model load, 'base', an adapter or a combination like EA+qa+bible (instead of --adapters)"
+  )
+  parser.add_argument("--server", default="", help="url of a running inference_server.py (e.g. http://127.0.0.1:8765), then no model is loaded here")
+  parser.add_argument("--client_threads", default=8, type=int, help="requests sent to the server at the same time, default=8")
   parser.add_argument("--dir", default = "/data/nbauer/data", help="Directory where the data are stored, default=/data/nbauer/data")
+  parser.add_argument("--combo_dir", default="", help="Directory with adapter combinations exported by export_adapter_combo.py, used if the combination is there")
   parser.add_argument("--log_gpu_usage", default="", help="Log-file for gpu-usage, no logging if left empty")
+  parser.add_argument("--batch_size", default=0, type=int, help="number of prompts to generate at once, default=0 (one by one)")
+  parser.add_argument("--max_prompt_tokens", default=0, type=int, help="leave out letters with prompts longer than this (from the token index), default=0 (none left out)")
+  parser.add_argument("--memory_budget", default="", help="GB available for generating (on top of the model), or 'auto' for the free memory. Prompts are scheduled by their estimated memory instead of catching out of memory errors")
+  parser.add_argument("--ledger", action="store_true", default=False, help="track the jobs in a sqlite ledger next to the csv, to run several workers on the same split")
+  parser.add_argument("--footnote_budget", action="store_true", default=False, help="max_new_tokens of every footnote from the lengths of similar footnotes (edition, position) instead of 256, and stop at the end of the note")
+  parser.add_argument("--footnote_budget_gold_labels", action="store_true", default=False, help="with --footnote_budget, the limits also from the labels of the reference footnotes. NOT for evaluation runs: the limit then depends on the footnote to generate")
+  parser.add_argument("--greedy", action="store_true", default=False, help="greedy decoding instead of sampling, the footnotes are then cached and taken from the cache in later runs")
+  parser.add_argument("--cache_path", default="", help="sqlite file of the generation cache, default=<dir>/model_responses/llama/generation_cache.sqlite")
+  parser.add_argument("--cache_size", default=DEFAULT_MAX_ENTRIES, type=int, help=f"footnotes kept in the generation cache, the least recently used are removed, default={DEFAULT_MAX_ENTRIES}")
+  parser.add_argument("--no_cache", action="store_true", default=False, help="do not use the generation cache (also with --greedy)")
+  parser.add_argument("--prefetch_workers", default=0, type=int, help="threads reading and tokenizing the next prompts while generating, e.g. 2, default=0 (everything one after the other)")
+  parser.add_argument("--reuse_prefix", action="store_true", default=False, help="compute the system prompt and one-shot example of a letter only once (without batches)")
   args = parser.parse_args()
 
   main(args)
@@ -3,6 +3,25 @@ import logging
 from itertools import combinations
 
 
+class CharTokenizer:
+    """one letter per id, enough to decode what the tiny model generates"""
+
+    def decode(self, ids, **kwargs):
+        return "".join(chr(65 + int(i) % 26) for i in ids)
+
+
+def tiny_model(seed=0, name=""):
+    """tiny random llama and a tokenizer for it, runs on cpu, no download needed
+    name: _name_or_path of the model, e.g. with "llama" for the settings of the real models"""
+    from transformers import LlamaConfig, LlamaForCausalLM
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=128, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256)
+    model = LlamaForCausalLM(config).eval()
+    model.config._name_or_path = name
+    return model, CharTokenizer()
+
+
 def test_single_adapters():
         # example file
     filepath = "/data/nbauer/data/prompts/instruct_add_window/dev_100/13134_23.jsonl"
@@ -100,12 +119,244 @@ def test_adapter_combos():
         generated_text = generate_chat(messages, model, tokenizer)
         logging.info(f"Output with {model.active_adapter} adapter:\n{generated_text}")
 
+def test_batched_generation(batch_size=3, n_prompts=7, seed=0):
+    """batched generation (left padded, length buckets) gives the same greedy outputs as one by one
+    runs on cpu with a tiny random llama, no download needed"""
+    model, _ = tiny_model(seed)
+    kwargs = {"max_new_tokens": 12, "eos_token_id": 1, "pad_token_id": 0, "do_sample": False}
+
+    # prompts of different lengths
+    prompts = [torch.randint(2, model.config.vocab_size, (int(length),)).tolist() for length in torch.randint(3, 40, (n_prompts,))]
+    single = [generate_ids([ids], model, kwargs)[0].tolist() for ids in prompts]
+
+    batches = length_buckets(list(range(n_prompts)), [len(ids) for ids in prompts], batch_size)
+    batched = {}
+    for batch in batches:
+        for i, output in zip(batch, generate_ids([prompts[i] for i in batch], model, kwargs)):
+            # the padding after an early eos is not part of the answer
+            output = output.tolist()
+            batched[i] = output[:len(single[i])]
+
+    mismatches = [i for i in range(n_prompts) if batched[i] != single[i]]
+    logging.info(f"batches: {batches}, mismatches: {mismatches}")
+    print(f"{n_prompts - len(mismatches)}/{n_prompts} batched outputs equal to the unbatched ones")
+    assert not mismatches, f"batched generation differs for prompts {mismatches}"
+
+def test_prefix_cache(n_prompts=5, seed=0):
+    """generating with the cached prefix gives the same greedy outputs as computing the whole prompt
+    runs on cpu with a tiny random llama, no download needed"""
+    model, _ = tiny_model(seed)
+    kwargs = {"max_new_tokens": 12, "eos_token_id": 1, "pad_token_id": 0, "do_sample": False}
+
+    # one shared prefix (the one-shot example of a letter), different last messages
+    prefix = torch.randint(2, model.config.vocab_size, (60,)).tolist()
+    prompts = [prefix + torch.randint(2, model.config.vocab_size, (int(length),)).tolist() for length in torch.randint(3, 20, (n_prompts,))]
+
+    prefix_cache = PrefixCache(model)
+    mismatches = []
+    for i, ids in enumerate(prompts):
+        without_cache = generate_ids([ids], model, kwargs)[0].tolist()
+        with_cache = prefix_cache.generate("letter", ids, len(prefix), kwargs).tolist()
+        if with_cache != without_cache:
+            mismatches.append(i)
+
+    logging.info(f"mismatches: {mismatches}")
+    print(f"{n_prompts - len(mismatches)}/{n_prompts} outputs with the cached prefix equal to the ones without")
+    assert not mismatches, f"generation with the cached prefix differs for prompts {mismatches}"
+
+def test_attention_backends(seed=0):
+    """the attention kernels requested for a model named llama: FlashAttention only without an attention mask,
+    padded batches and prompts on a cached prefix also allow the other kernels (FlashAttention fails with a mask on gpu)"""
+    model, _ = tiny_model(seed, name="tiny-llama")
+    kwargs = {"max_new_tokens": 4, "eos_token_id": 1, "pad_token_id": 0, "do_sample": False}
+    requested = []
+    sdp_kernel = torch.backends.cuda.sdp_kernel
+
+    def recording_sdp_kernel(**backends):
+        requested.append(backends)
+        return sdp_kernel(**backends)
+
+    torch.backends.cuda.sdp_kernel = recording_sdp_kernel
+    try:
+        generate_ids([[5, 6, 7]], model, kwargs)
+        generate_ids([[5, 6, 7], [8, 9, 10]], model, kwargs)
+        generate_ids([[5, 6, 7], [8, 9]], model, kwargs)
+        prefix_cache = PrefixCache(model)
+        with_cache = prefix_cache.generate("letter", [5, 6, 7, 8, 9, 10], 4, kwargs).tolist()
+    finally:
+        torch.backends.cuda.sdp_kernel = sdp_kernel
+    flash_only = {"enable_flash": True, "enable_math": False, "enable_mem_efficient": False}
+    assert requested[0] == flash_only and requested[1] == flash_only, "prompts without padding, flash only"
+    assert requested[2]["enable_math"] and requested[2]["enable_mem_efficient"], "padded batch with flash only"
+    assert requested[3]["enable_math"] and requested[3]["enable_mem_efficient"], "prompt on the cached prefix with flash only"
+    assert with_cache == generate_ids([[5, 6, 7, 8, 9, 10]], model, kwargs)[0].tolist()
+    logging.info(f"requested kernels: {requested}")
+    print("attention kernels ok")
+
+def test_memory_scheduler():
+    """decisions of the memory scheduler with simulated budgets, no gpu (or model) needed"""
+    from transformers import LlamaConfig
+    from memory_scheduler import MemoryModel, choose_variant, schedule, GB
+    # llama 3.1 8B
+    config = LlamaConfig(vocab_size=128256, hidden_size=4096, intermediate_size=14336, num_hidden_layers=32,
+                         num_attention_heads=32, num_key_value_heads=8)
+    memory_model = MemoryModel.from_config(config)
+    budget = 8 * GB
+    max_tokens = memory_model.max_tokens(budget)
+    logging.info(f"8GB budget: prompts up to {max_tokens} tokens")
+    assert memory_model.prompt_bytes(max_tokens) <= budget < memory_model.prompt_bytes(max_tokens + 1)
+
+    # the first version that fits is taken, the shorter versions are only made if needed
+    made = []
+    def variants(lengths):
+        for name, n_tokens in lengths:
+            made.append(name)
+            yield name, n_tokens
+    lengths = [("original", 3 * max_tokens), ("short_example", 2 * max_tokens), ("window", max_tokens // 2), ("truncated", max_tokens)]
+    assert choose_variant(variants(lengths), memory_model, budget) == ("window", max_tokens // 2)
+    assert made == ["original", "short_example", "window"]
+    assert choose_variant(iter([("original", 100)]), memory_model, budget) == ("original", 100)
+    assert choose_variant(iter([("original", max_tokens + 1)]), memory_model, budget) is None  # skipped
 
+    # every job in exactly one batch, every batch within budget and max_batch
+    jobs = [((str(i), "1"), n_tokens, "original") for i, n_tokens in enumerate([50, 4000, 800, 20, max_tokens, 1200, 300, 9000, 60, 2500])]
+    for max_batch in [1, 4, 16]:
+        batches = schedule(jobs, memory_model, budget, max_batch)
+        assert sorted(job for batch in batches for job in batch) == sorted(jobs)
+        for batch in batches:
+            assert len(batch) <= max_batch
+            assert len(batch) == 1 or memory_model.batch_bytes(len(batch), max(job[1] for job in batch)) <= budget
+        logging.info(f"max_batch {max_batch}: {[[job[1] for job in batch] for batch in batches]}")
+
+    # a bigger budget never needs more batches
+    n_batches = [len(schedule(jobs, memory_model, gb * GB, 16)) for gb in [8, 16, 32, 64]]
+    assert n_batches == sorted(n_batches, reverse=True), n_batches
+    # a last message without a blank line has no document to cut, the prompt is skipped instead of stopping the run
+    assert truncate_context([{"role": "user", "content": "one paragraph only"}], 1, max_tokens, None) is None
+    print(f"memory scheduler ok, batches for 8/16/32/64GB: {n_batches}")
+
+def test_continuous_batching(n_requests=8, max_batch=3, seed=0):
+    """the continuous batching of the inference server gives the same greedy outputs as generating one by one
+    requests of different lengths join and leave the running batch, runs on cpu with a tiny random llama"""
+    from inference_server import ContinuousBatcher, Request, request_params
+    model, _ = tiny_model(seed)
+
+    prompts = [torch.randint(2, model.config.vocab_size, (int(length),)).tolist() for length in torch.randint(3, 40, (n_requests,))]
+    max_new_tokens = [int(n) for n in torch.randint(2, 16, (n_requests,))]
+    single = [generate_ids([ids], model, {"max_new_tokens": n, "eos_token_id": 1, "pad_token_id": 0, "do_sample": False})[0].tolist()
+              for ids, n in zip(prompts, max_new_tokens)]
+
+    batcher = ContinuousBatcher(model, [1], max_batch)
+    batcher.start()
+    requests = []
+    for ids, n in zip(prompts, max_new_tokens):
+        requests.append(Request(ids, max_new_tokens=n, do_sample=False))
+        batcher.submit(requests[-1])
+        time.sleep(0.01)  # the later requests arrive while the first ones are running
+    for request in requests:
+        request.done.wait()
+
+    mismatches = [i for i, request in enumerate(requests) if request.generated != single[i]]
+    logging.info(f"mismatches: {mismatches}")
+    print(f"{n_requests - len(mismatches)}/{n_requests} outputs of the continuous batching equal to the ones one by one")
+    assert not mismatches, f"continuous batching differs for requests {mismatches}"
+
+    # a request that breaks the prefill (token id outside the vocabulary) fails together with the ones admitted with it,
+    # the engine keeps running for the next requests
+    requests = [Request(prompts[0], max_new_tokens=4, do_sample=False), Request([model.config.vocab_size + 10], max_new_tokens=4, do_sample=False),
+                Request(prompts[1], max_new_tokens=4, do_sample=False)]
+    with batcher.condition:  # admitted together
+        batcher.waiting.extend(requests)
+        batcher.condition.notify()
+    assert all(request.done.wait(10) for request in requests), "a request was never finished"
+    assert requests[1].error is not None
+    request = Request(prompts[2], max_new_tokens=max_new_tokens[2], do_sample=False)
+    batcher.submit(request)
+    assert request.done.wait(10) and request.generated == single[2], "the engine did not survive the error"
+    logging.info(f"errors: {[request.error for request in requests]}")
+
+    # parameters that would fail in the engine thread are rejected before (400)
+    assert request_params({}) == {"max_new_tokens": 256, "do_sample": True, "temperature": 0.6, "top_p": 0.9}
+    for params in [{"max_new_tokens": "64"}, {"max_new_tokens": 0}, {"do_sample": "no"}, {"temperature": 0}, {"top_p": "x"}, {"top_p": 1.5}]:
+        try:
+            request_params(params)
+        except ValueError:
+            continue
+        raise AssertionError(f"{params} accepted")
+
+
+def test_generation_cache(max_entries=3):
+    """generation cache: same prompt and model -> hit, other adapter or generation arguments -> miss,
+    the least recently used footnotes are removed first. No gpu (or model) needed"""
+    import tempfile
+    from generation_cache import GenerationCache
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = GenerationCache(os.path.join(tmp_dir, "cache.sqlite"), max_entries)
+        greedy = {"max_new_tokens": 256, "do_sample": False}
+        cache.set_model("llama", "EA", greedy)
+        keys = [cache.key(f"prompt {i}") for i in range(max_entries + 1)]
+        assert cache.get(keys) == [None] * len(keys)
+        cache.put(keys[:max_entries], [f"footnote {i}" for i in range(max_entries)])
+        assert cache.get(keys[:1]) == ["footnote 0"]  # prompt 0 is used again, prompt 1 is now the oldest
+        cache.put(keys[max_entries:], ["footnote new"])
+        assert cache.get(keys) == ["footnote 0", None] + [f"footnote {i}" for i in range(2, max_entries)] + ["footnote new"]
+
+        cache.set_model("llama", "qa", greedy)
+        assert cache.key("prompt 0") != keys[0], "other adapter, same key"
+        cache.set_model("llama", "EA", dict(greedy, max_new_tokens=128))
+        assert cache.key("prompt 0") != keys[0], "other generation arguments, same key"
+        cache.set_model("llama", "EA", greedy)
+        assert cache.key("prompt 0") == keys[0]
+        assert cache.key("prompt 0", 64) != cache.key("prompt 0", 128), "other limit of the prompt, same key"
+
+        logging.info(cache.report())
+        print(cache.report())
+        cache.close()
+
+
+def test_footnote_budget(seed=0):
+    """footnote budget fitted on the example footnote_df, and StopOnPatterns stopping every row of a batch at its limit
+    or at a pattern. Runs on cpu with a tiny random llama, no download needed"""
+    import pandas as pd
+    from footnote_budget import FootnoteBudget, DecodeStats, StopOnPatterns, trim_at_stop
+
+    footnote_df = pd.read_csv("../data_analysis_and_preparation/footnote_df_10013.csv", dtype={"edition": str, "label": str})
+    # the same letter under other ids, the first one is the letter "generated"
+    footnote_df = pd.concat([footnote_df.assign(letter_id=footnote_df["letter_id"] + i) for i in range(5)])
+    budget = FootnoteBudget.fit(footnote_df, exclude_letters={"10013"}, min_count=2)
+    limits = {n: budget.max_new_tokens(10013, n) for n in footnote_df["n_footnote"].unique()}
+    assert all(budget.min_tokens <= limit <= budget.max_tokens for limit in limits.values())
+    assert budget.quantiles[("label",)][("short",)] < budget.quantiles[("label",)][("misc",)]
+    # without gold labels the limit only depends on what is known at prompting: the same label for every footnote gives the same limits
+    relabeled = FootnoteBudget.fit(footnote_df.assign(label="misc"), exclude_letters={"10013"}, min_count=2)
+    assert limits == {n: relabeled.max_new_tokens(10013, n) for n in limits}
+    gold = FootnoteBudget.fit(footnote_df, exclude_letters={"10013"}, min_count=2, gold_labels=True)
+    assert any(gold.max_new_tokens(10013, n) != limits[n] for n in limits)
+    # a predicted label is used like a gold label
+    n_footnote, label = next((n, label) for n, label in zip(footnote_df["n_footnote"], footnote_df["label"]) if ", " not in label)
+    assert budget.max_new_tokens(10013, n_footnote, label=label) == gold.max_new_tokens(10013, n_footnote)
+    logging.info(f"limits: {limits}")
+
+    model, tokenizer = tiny_model(seed)
+    kwargs = {"max_new_tokens": 40, "eos_token_id": 1, "pad_token_id": 0, "do_sample": False}
+    prompts = [torch.randint(2, model.config.vocab_size, (int(length),)).tolist() for length in (5, 9, 14)]
+    full = [tokenizer.decode(output) for output in generate_ids(prompts, model, kwargs)]
+
+    # stop the first row at a pattern from its full generation, the others at their limits
+    pattern = full[0][12:15]
+    stats = DecodeStats()
+    stopping_criteria = StoppingCriteriaList([StopOnPatterns(tokenizer, 1, [40, 10, 25], stats, patterns=[pattern])])
+    stopped = [tokenizer.decode(output) for output in generate_ids(prompts, model, dict(kwargs, stopping_criteria=stopping_criteria))]
+    assert trim_at_stop(stopped[0], [pattern]) == trim_at_stop(full[0], [pattern])
+    assert stopped[1][:10] == full[1][:10] and stopped[2][:25] == full[2][:25]
+    assert stats.ended["pattern"] == 1 and stats.ended["limit"] == 2
+    values = sorted(limits.values())
+    print(f"limits: min {values[0]}, median {values[len(values) // 2]}, max {values[-1]}, decode steps with the stops: {stats.steps} instead of {3 * kwargs['max_new_tokens']}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("test_function", choices=["single_adapters", "all_adapters", "adapter_combo"])
+    parser.add_argument("test_function", choices=["single_adapters", "all_adapters", "adapter_combo", "batched_generation", "prefix_cache", "attention_backends", "memory_scheduler", "continuous_batching", "generation_cache", "footnote_budget"])
     parser.add_argument("--log_file_name", default="")
     args = parser.parse_args()
     if args.log_file_name == "":
@@ -126,4 +377,17 @@ if __name__ == "__main__":
         test_all_adapters()
     if args.test_function == "adapter_combo":
         test_adapter_combos()
-
+    if args.test_function == "batched_generation":
+        test_batched_generation()
+    if args.test_function == "prefix_cache":
+        test_prefix_cache()
+    if args.test_function == "attention_backends":
+        test_attention_backends()
+    if args.test_function == "memory_scheduler":
+        test_memory_scheduler()
+    if args.test_function == "continuous_batching":
+        test_continuous_batching()
+    if args.test_function == "generation_cache":
+        test_generation_cache()
+    if args.test_function == "footnote_budget":
+        test_footnote_budget()
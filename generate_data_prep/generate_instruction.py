@@ -1,9 +1,15 @@
 import argparse
-import os, json, jsonlines
+import os, sys, json, jsonlines
 import pandas as pd
 import re
 from tqdm import tqdm
 from lxml import etree
+# typed footnote_df, only reading the columns needed
+module_path = "../data_analysis_and_preparation"
+sys.path.append(module_path)
+from footnote_store import read_footnote_df
+from parse_bullinger import map_letters  # process pool over the letters, same as for parsing
+from prompt_store import PromptStoreWriter
 
 DATA_PATH = "../../data"
 # SYSTEM_PROMPT = "You are a research assistant for a historian, specialized on the European reformation working on an edition of the correspondence of Heinrich Bullinger. Given a letter in TEI format, your task is to add text to a footnote."
@@ -34,6 +40,26 @@ def get_footnote_content(text, n):
   """get the content of a FN"""
   return re.search(footnote_regex(n), text).group(2)
 
+# same as footnote_regex, but for any n (matching group 2: the n)
+ANY_FOOTNOTE_REGEX = re.compile(r"( ?<note [^>]*? type=\"footnote\" n=\"([^\"]*)\">)"
+                                r"(.*?(?=<\/note>))"
+                                r"(<\/note>)")
+
+def remove_footnotes_content(text, ns):
+  """remove the content of all footnotes in ns with a single scan over the text
+  returns the text and the removed contents by n (like get_footnote_content, the first one if n appears twice)"""
+  ns_to_remove = {str(n) for n in ns}
+  contents = {}
+
+  def strip(match):
+    n = match.group(2)
+    if n not in ns_to_remove:
+      return match.group(0)
+    contents.setdefault(int(n), match.group(3))
+    return match.group(1) + match.group(4)
+
+  return ANY_FOOTNOTE_REGEX.sub(strip, text), contents
+
 def get_letter_ids(split:str):
     
     with open(os.path.join(DATA_PATH, "strat_sample.json"), "r", encoding="utf-8") as injson:
@@ -73,57 +99,213 @@ def instruct_prompt_add(letter_text, all_footnote_ns:list[int], n:int):
     :param n: footnote
     """
 
-    footnote_content = get_footnote_content(letter_text, n)
-
     # removing all FNs
-    letter_no_fns = letter_text
-    for fn_to_remove in all_footnote_ns:  # Maybe we'll have to take care of the labels here...
-        letter_no_fns = remove_footnote_content(letter_no_fns, fn_to_remove)
+    letter_no_fns, footnote_contents = remove_footnotes_content(letter_text, all_footnote_ns)  # Maybe we'll have to take care of the labels here...
+
+    if n in footnote_contents:
+        footnote_content = footnote_contents[n]
+    else:
+        footnote_content = get_footnote_content(letter_text, n)
 
     return letter_no_fns, footnote_content
 
+class LetterIndex:
+    """letter parsed once, with its sentences, paragraphs and divs indexed
+    so that the context window for every footnote can be cut out without parsing the letter again"""
+
+    def __init__(self, letter_text):
+        namespaces_tei = {'tei': 'http://www.tei-c.org/ns/1.0'}
+        self.root = etree.fromstring(letter_text)
+        tei = "{http://www.tei-c.org/ns/1.0}"
+
+        # all sentences with their n, in document order
+        self.sentences = [(int(sentence.get("n")), sentence) for sentence in self.root.xpath('.//tei:s', namespaces=namespaces_tei)]
+
+        # n of a note -> n of the first sentence containing it
+        self.note_to_sentence = {}
+        for n_sentence, sentence in self.sentences:
+            for note in sentence.iter(f"{tei}note"):
+                self.note_to_sentence.setdefault(note.get("n"), n_sentence)
+
+        # paragraphs and divs with their direct children, to know when they are empty
+        self.paragraphs = [(paragraph, paragraph.xpath('./tei:s', namespaces=namespaces_tei)) for paragraph in self.root.xpath('.//tei:p', namespaces=namespaces_tei)]
+        self.divs = [(div, div.xpath('./tei:p', namespaces=namespaces_tei)) for div in self.root.xpath('.//tei:div', namespaces=namespaces_tei)]
+        self._token_counts = {}  # tokenizer -> (tokens without sentences, tokens per sentence)
+
+    def context(self, n_footnote, window_size=5):
+        """same as get_letter_context: the letter with only the sentences in the window around the footnote
+        the elements are taken out, the tree is serialized and then the elements are put back"""
+        return self._window(self.note_to_sentence[str(n_footnote)], window_size)
+
+    def _window(self, n_sentence, window_size):
+        removed = []  # (parent, index, element) in the order of removal
+
+        def remove(element):
+            parent = element.getparent()
+            removed.append((parent, parent.index(element), element))
+            parent.remove(element)
+
+        # Remove sentences based on n attribute
+        removed_sentences = set()
+        for n_current_sentence, sentence in self.sentences:
+            if n_current_sentence < n_sentence - window_size or n_current_sentence > n_sentence + window_size:
+                remove(sentence)
+                removed_sentences.add(sentence)
+
+        # Remove empty paragraphs
+        removed_paragraphs = set()
+        for paragraph, sentences in self.paragraphs:
+            if all(sentence in removed_sentences for sentence in sentences):  # Check if no <s> elements are left
+                remove(paragraph)
+                removed_paragraphs.add(paragraph)
+
+        # Remove empty divs
+        for div, paragraphs in self.divs:
+            if all(paragraph in removed_paragraphs for paragraph in paragraphs):  # Check if no <p> elements are left
+                remove(div)
+
+        # Convert back to string to see result
+        context = etree.tostring(self.root, pretty_print=True, encoding="unicode")
+
+        # put everything back, in reverse order so the indices are right
+        for parent, index, element in reversed(removed):
+            parent.insert(index, element)
+        return context
+
+    def token_counts(self, tokenizer, ns_to_remove=()):
+        """tokens of every sentence (without the content of the footnotes in ns_to_remove) and of the letter without any sentence
+        counted once per letter and tokenizer, so the window for a token budget can be found without tokenizing again"""
+        if tokenizer.name_or_path not in self._token_counts:
+            sentence_texts = [etree.tostring(sentence, encoding="unicode") for _, sentence in self.sentences]
+            sentence_texts = [remove_footnotes_content(text, ns_to_remove)[0] for text in sentence_texts]
+            skeleton, _ = remove_footnotes_content(self._window(0, -1), ns_to_remove)  # window_size -1 removes all sentences
+            skeleton_tokens, *sentence_tokens = count_tokens([skeleton] + sentence_texts, tokenizer)
+            self._token_counts[tokenizer.name_or_path] = (skeleton_tokens, sentence_tokens)
+        return self._token_counts[tokenizer.name_or_path]
+
+    def window_for_budget(self, n_footnote, token_budget, tokenizer, ns_to_remove=()):
+        """largest window_size around the footnote with a context of at most token_budget tokens
+        (estimated from the counts per sentence, at least the sentence with the footnote is kept)"""
+        skeleton_tokens, sentence_tokens = self.token_counts(tokenizer, ns_to_remove)
+        n_sentence = self.note_to_sentence[str(n_footnote)]
+
+        # tokens of the sentences at each distance from the sentence with the footnote
+        tokens_at_distance = {}
+        for (n_current_sentence, _), n_tokens in zip(self.sentences, sentence_tokens):
+            distance = abs(n_current_sentence - n_sentence)
+            tokens_at_distance[distance] = tokens_at_distance.get(distance, 0) + n_tokens
+
+        # grow the window until the next step goes over the budget
+        window_size = 0
+        total_tokens = skeleton_tokens + tokens_at_distance.get(0, 0)
+        for distance in range(1, max(tokens_at_distance, default=0) + 1):
+            total_tokens += tokens_at_distance.get(distance, 0)
+            if total_tokens > token_budget:
+                break
+            window_size = distance
+        return window_size
+
+
+TOKENIZERS = {}  # loaded once per process
+
+def get_tokenizer(tokenizer_id):
+    if tokenizer_id not in TOKENIZERS:
+        from transformers import AutoTokenizer
+        TOKENIZERS[tokenizer_id] = AutoTokenizer.from_pretrained(tokenizer_id)
+    return TOKENIZERS[tokenizer_id]
+
+def count_tokens(texts, tokenizer):
+    """number of tokens of each text, without special tokens"""
+    return [len(input_ids) for input_ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
 def get_letter_context(letter_text, n_footnote, window_size=5):
     """get a window of the letter around the sentence with the footnote"""
-    root = etree.fromstring(letter_text)
-    namespaces_tei = {'tei': 'http://www.tei-c.org/ns/1.0'}
-    # get the sentence to the footnote
-    sentence = root.xpath(f".//tei:s[descendant::tei:note[@n='{n_footnote}']]", namespaces=namespaces_tei)[0]
-    n_sentence = int(sentence.get('n'))
-
-    # Remove sentences based on n attribute
-    for sentence in root.xpath('.//tei:s', namespaces=namespaces_tei):
-        n_current_sentence = int(sentence.get("n"))
-        if n_current_sentence < n_sentence - window_size or n_current_sentence > n_sentence + window_size:
-            sentence.getparent().remove(sentence)
-
-    # Remove empty paragraphs
-    for paragraph in root.xpath('.//tei:p', namespaces=namespaces_tei):
-        if len(paragraph.xpath('./tei:s', namespaces=namespaces_tei)) == 0:  # Check if no <s> elements are left
-            paragraph.getparent().remove(paragraph)
-    
-    # Remove empty divs
-    for div in root.xpath('.//tei:div', namespaces=namespaces_tei):
-        if len(div.xpath('./tei:p', namespaces=namespaces_tei)) == 0:  # Check if no <p> elements are left
-            div.getparent().remove(div)
+    return LetterIndex(letter_text).context(n_footnote, window_size)
 
-    # Convert back to string to see result
-    return etree.tostring(root, pretty_print=True, encoding="unicode")
 
-
-def instruct_prompt_add_window(letter_text, all_footnote_ns:list[int], n:int, window_size):
+def instruct_prompt_add_window(letter_text, all_footnote_ns:list[int], n:int, window_size, letter_index=None, footnote_contents=None, token_budget=0, tokenizer=None):
     """like instruct_prompt_add but instead of returning the whole letter, it takes away all sentences outside of window size
+    pass a LetterIndex of the letter to avoid parsing it again for every footnote
+    and the footnote_contents of the letter (from remove_footnotes_content) to avoid searching the letter for every footnote
+    with a token_budget (and tokenizer) the window grows as long as the context stays within the budget, window_size is then ignored
     """
-    footnote_content = get_footnote_content(letter_text, n)
-    letter_context = get_letter_context(letter_text, n, window_size)
-    letter_context_no_fns = letter_context
-    for fn_to_remove in all_footnote_ns:
-        letter_context_no_fns = remove_footnote_content(letter_context_no_fns, fn_to_remove)
+    if footnote_contents is not None and n in footnote_contents:
+        footnote_content = footnote_contents[n]
+    else:
+        footnote_content = get_footnote_content(letter_text, n)
+    if letter_index is None:
+        letter_index = LetterIndex(letter_text)
+    if token_budget:
+        window_size = letter_index.window_for_budget(n, token_budget, tokenizer, all_footnote_ns)
+    letter_context = letter_index.context(n, window_size)
+    letter_context_no_fns, _ = remove_footnotes_content(letter_context, all_footnote_ns)
     
     return letter_context_no_fns, footnote_content
 
 
 
 
+def make_letter_prompts(task):
+    """all prompts of a letter: list of (n, messages), or (n, text) for the continue prompts
+    (top level function, so it can be sent to the worker processes)"""
+    letter_id, ns, prompt_type, window_size, token_budget, tokenizer_id = task
+    letter_text = get_letter_text(letter_id)
+    tokenizer = get_tokenizer(tokenizer_id) if token_budget else None
+
+    # Footnote numbers in this letter, the first one is the one-shot example
+    ns = list(ns)
+    example_n = ns.pop(0)
+    prompts = []
+
+    if prompt_type == "continue":
+        for n in ns:
+            text_until_fn, _ = instruct_continue_prompt(letter_text, n)
+            prompts.append((n, text_until_fn))
+        return prompts
+
+    # make the 1-shot example
+    if prompt_type == "instruct_continue":
+        example_query, example_answer = instruct_continue_prompt(letter_text, example_n)
+    
+    if prompt_type == "instruct_add":
+        all_footnote_ns = [example_n] + ns  # The function will remove the ns passed, so we need to pass a list with all of them
+
+        # will have to do this only once, bc letter_no_fns can be used again
+        letter_no_fns, example_answer = instruct_prompt_add(letter_text, all_footnote_ns, example_n)
+        example_query = HISTORIAN_PROMPT(letter_no_fns, example_n)
+
+    if prompt_type == "instruct_add_window":
+        all_footnote_ns = [example_n] + ns
+        letter_index = LetterIndex(letter_text)  # parse the letter only once for all the windows
+        _, footnote_contents = remove_footnotes_content(letter_text, all_footnote_ns)
+        letter_context_no_fns, example_answer = instruct_prompt_add_window(letter_text, all_footnote_ns, example_n, window_size, letter_index, footnote_contents, token_budget, tokenizer)
+        example_query = HISTORIAN_PROMPT(letter_context_no_fns, example_n)
+
+    one_shot = [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': example_query},
+        {'role': 'assistant', 'content': example_answer}
+    ]
+
+    for n in ns:
+
+        if prompt_type == "instruct_continue":
+            query, _ = instruct_continue_prompt(letter_text, n)
+        
+        if prompt_type == "instruct_add":
+            query = HISTORIAN_PROMPT(letter_no_fns, n)
+
+        if prompt_type == "instruct_add_window":
+            letter_context_no_fns, _ = instruct_prompt_add_window(letter_text, all_footnote_ns, n, window_size, letter_index, footnote_contents, token_budget, tokenizer)
+            query = HISTORIAN_PROMPT(letter_context_no_fns, n)
+
+        messages = one_shot + [{'role': 'user', 'content': query}]
+        prompts.append((n, messages))
+
+    return prompts
+
+
 if __name__ == "__main__":
 
     # Example call: python generate_instruction.py test instruct_continue --example
@@ -131,7 +313,10 @@ if __name__ == "__main__":
     parser.add_argument("split", choices=["train", "dev", "test"])
     parser.add_argument("prompt_type", choices=["continue", "instruct_continue", "instruct_add", "instruct_add_window"])  # todo: add continue prompt...
     parser.add_argument("--window_size", default=10, type=int, help="window size for instruct_add_window, default=10")
+    parser.add_argument("--token_budget", default=0, type=int, help="instruct_add_window: grow the window until the context has this many tokens, instead of a fixed window_size")
+    parser.add_argument("--tokenizer", default="meta-llama/Llama-3.1-8B-Instruct", help="tokenizer to count the tokens for --token_budget")
     parser.add_argument("--example", action="store_true", default=False)  # only do 5 example letters for testing purposes
+    parser.add_argument("--workers", default=1, type=int, help="number of processes making the prompts, default=1")
 
     args = parser.parse_args()
     split = args.split
@@ -142,79 +327,31 @@ if __name__ == "__main__":
     if example:
         out_path = os.path.join(DATA_PATH, "prompts", prompt_type, "example")
     
-    footnote_df = pd.read_csv(os.path.join(DATA_PATH, "footnote_downsized_df.csv"))
+    footnote_df = read_footnote_df(os.path.join(DATA_PATH, "footnote_downsized_df.parquet"), columns=["letter_id", "n_footnote"])
+    # Footnote numbers per letter, in the order of the df
+    ns_per_letter = footnote_df.groupby("letter_id", sort=False)["n_footnote"].apply(list).to_dict()
 
     # get the letter ids from the split
     letter_ids = get_letter_ids(split)
     if example:
         letter_ids = letter_ids[:5]
 
-    for letter_id in tqdm(letter_ids):
-
-        letter_text = get_letter_text(letter_id)
-
-        # Footnote numbers in this letter
-        ns = list(footnote_df[footnote_df["letter_id"] == int(letter_id)].n_footnote)
-        example_n = ns.pop(0)
+    # the prompts are made in the workers, but written here in the order of the letters
+    tasks = [(letter_id, ns_per_letter.get(int(letter_id), []), prompt_type, args.window_size, args.token_budget, args.tokenizer) for letter_id in letter_ids]
 
-        if prompt_type == "continue":
-            for n in ns:
-                text_until_fn, _ = instruct_continue_prompt(letter_text, n)
+    if prompt_type != "continue":  # continue prompts are plain text files
+        prompt_store = PromptStoreWriter(out_path)
 
+    for (letter_id, *_), prompts in zip(tasks, map_letters(make_letter_prompts, tasks, args.workers)):
+        for n, prompt in prompts:
+            if prompt_type == "continue":
                 outfile_name = f"{letter_id}_{n}.txt"
                 outfile_path = os.path.join(out_path, outfile_name)
                 with open(outfile_path, "w", encoding="utf-8") as outfile:
-                    outfile.write(text_until_fn)
-
-        else:
-
-            # make the 1-shot example
-            if prompt_type == "instruct_continue":
-                example_query, example_answer = instruct_continue_prompt(letter_text, example_n)
-            
-            if prompt_type == "instruct_add":
-                all_footnote_ns = [example_n] + ns  # The function will remove the ns passed, so we need to pass a list with all of them
-
-                # will have to do this only once, bc letter_no_fns can be used again
-                letter_no_fns, example_answer = instruct_prompt_add(letter_text, all_footnote_ns, example_n)
-                example_query = HISTORIAN_PROMPT(letter_no_fns, example_n)
-
-            if prompt_type == "instruct_add_window":
-                all_footnote_ns = [example_n] + ns
-                letter_context_no_fns, example_answer = instruct_prompt_add_window(letter_text, all_footnote_ns, example_n, 10)
-                example_query = HISTORIAN_PROMPT(letter_context_no_fns, example_n)
-
-            
-
-            one_shot = [
-                {'role': 'system', 'content': SYSTEM_PROMPT},
-                {'role': 'user', 'content': example_query},
-                {'role': 'assistant', 'content': example_answer}
-            ]
-
-
-            for n in ns:
-
-                if prompt_type == "instruct_continue":
-                    query, _ = instruct_continue_prompt(letter_text, n)
-                
-                if prompt_type == "instruct_add":
-                    query = HISTORIAN_PROMPT(letter_no_fns, n)
-
-                if prompt_type == "instruct_add_window":
-                    letter_context_no_fns, _ = instruct_prompt_add_window(letter_text, all_footnote_ns, n, 10)
-                    query = HISTORIAN_PROMPT(letter_context_no_fns, n)
-
-                messages = one_shot + [{'role': 'user', 'content': query}]
-
-
-                # what would be a better way to save the files??
-                # maybee as a big json?
-                # or a long jsonl file, every 4 lines starts a new letter. Convenient, but I'd loose metadata
-                # So json or many smaller files is better...
-                outfile_name = f"{letter_id}_{n}.jsonl"
-                outfile_path = os.path.join(out_path, outfile_name)
-                with jsonlines.open(outfile_path, "w") as outfile:
-                    outfile.write_all(messages)
-
+                    outfile.write(prompt)
+            else:
+                # saved in the shards of the prompt store, with an index by letter_id and n (see prompt_store.py)
+                prompt_store.write(letter_id, n, prompt)
 
+    if prompt_type != "continue":
+        prompt_store.close()
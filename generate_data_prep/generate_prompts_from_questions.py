@@ -1,9 +1,13 @@
 import pandas as pd
-import os, re
-from generate_instruction import remove_footnote_content, get_footnote_content
-import jsonlines
+import os, sys, re
+from generate_instruction import remove_footnotes_content, get_footnote_content, map_letters
+from prompt_store import PromptStoreWriter
 import argparse
 from tqdm import tqdm
+# typed footnote_df, only reading the columns needed
+module_path = "../data_analysis_and_preparation"
+sys.path.append(module_path)
+from footnote_store import read_footnote_df
 
 DATA_PATH = "../../data/"
 
@@ -14,17 +18,12 @@ def QUESTION_PROMPT(text, n, q):  # used in the instruction_add prompt
 def get_query(sentence, n_footnote, question):
     # removing all footnotes, thus for the one-shot case, the desired footnote is not in the prompt...
     fns_in_sent = return_fns_in_sentence(sentence)
-    sentence_removed_fn = sentence
-    for fn in fns_in_sent:
-        sentence_removed_fn = remove_footnote_content(sentence_removed_fn, fn)
+    sentence_removed_fn, _ = remove_footnotes_content(sentence, fns_in_sent)
     return QUESTION_PROMPT(sentence_removed_fn, n_footnote, question)
 
 
-def save_file(letter_id, n, messages, out_path):
-    outfile_name = f"{letter_id}_{n}.jsonl"
-    outfile_path = os.path.join(out_path, outfile_name)
-    with jsonlines.open(outfile_path, "w") as outfile:
-        outfile.write_all(messages)
+def save_file(letter_id, n, messages, prompt_store):
+    prompt_store.write(letter_id, n, messages)
 
 def return_fns_in_sentence(sent):
     # regex pattern to match footnote numbers
@@ -48,8 +47,32 @@ def make_one_shot_example(example_row):
     return messages
 
 
-def main(split):   
-    footnote_df = pd.read_csv("../../data/footnote_downsized_df.csv")
+def make_letter_prompts(task):
+    """prompts of a letter from its rows in the merged df, the first row is the one-shot example
+    returns a list of (n_footnote, messages)"""
+    letter_id, rows = task
+    example_row, *rows = rows
+
+    prompts = []
+    for row in rows:
+
+        # redo the one-shot example
+        messages = make_one_shot_example(example_row)
+
+        question = row["generated_footnote"]
+        sentence = row["xml_sentence"]
+        n_footnote = row["n_footnote"]
+        
+        query = get_query(sentence, n_footnote, question)
+        messages.append({
+            "role": "user", "content": query
+        })
+        prompts.append((n_footnote, messages))
+    return prompts
+
+
+def main(split, workers=1):   
+    footnote_df = read_footnote_df("../../data/footnote_downsized_df.parquet", columns=["letter_id", "n_footnote", "xml_sentence"])
 
     # get the generated questions
     gpt_response_folder = "../../data/model_responses/gpt"
@@ -59,36 +82,24 @@ def main(split):
 
     # define where to save the prompt files
     out_path = f"../../data/prompts/instruct_qa/{split}"
+    prompt_store = PromptStoreWriter(out_path)
 
     merged_df = pd.merge(footnote_df, question_df, on=["letter_id", "n_footnote"])
-    letter_ids = list(merged_df["letter_id"])
-
-    for letter_id in tqdm(letter_ids):
-        letter_df_iter = merged_df[merged_df["letter_id"]==letter_id].iterrows()
 
-        # for the one-shot example
-        _, example_row = next(letter_df_iter)
-        
-        
-        # add the rest
-        for _, row in letter_df_iter:
+    # rows per letter, in the order of the df (each letter only once, the prompts of a letter used to be rewritten for every row)
+    tasks = [(letter_id, letter_df.to_dict("records")) for letter_id, letter_df in merged_df.groupby("letter_id", sort=False)]
 
-            # redo the one-shot example
-            messages = make_one_shot_example(example_row)
+    # the prompts are made in the workers, but written here in the order of the letters
+    for (letter_id, _), prompts in zip(tasks, map_letters(make_letter_prompts, tasks, workers)):
+        for n_footnote, messages in prompts:
+            save_file(letter_id, n_footnote, messages, prompt_store)
 
-            question = row["generated_footnote"]
-            sentence = row["xml_sentence"]
-            n_footnote = row["n_footnote"]
-            
-            query = get_query(sentence, n_footnote, question)
-            messages.append({
-                "role": "user", "content": query
-            })
-            save_file(letter_id, n_footnote, messages, out_path)
+    prompt_store.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("split", choices=["train", "dev", "test", "example"])
+    parser.add_argument("--workers", default=1, type=int, help="number of processes making the prompts, default=1")
     args = parser.parse_args()
-    main(args.split)
\ No newline at end of file
+    main(args.split, args.workers)
@@ -1,9 +1,14 @@
 import argparse
-import os
+import os, sys
 import pandas as pd
 import json
 import jsonlines
 from tqdm import tqdm
+# typed footnote_df, only reading the columns needed
+module_path = "../data_analysis_and_preparation"
+sys.path.append(module_path)
+from footnote_store import read_footnote_df
+from prompt_store import PromptStoreWriter
 
 # open the meta data file
 def get_letter_ids(split):
@@ -11,7 +16,7 @@ def get_letter_ids(split):
         samples = json.load(injson)
     return samples[split]
 
-footnote_df = pd.read_csv("../../data/footnote_downsized_df.csv")
+footnote_df = read_footnote_df("../../data/footnote_downsized_df.parquet", columns=["letter_id", "n_footnote", "xml_sentence"])
 
 
 # get the letter, get the sentence with the footnote
@@ -49,13 +54,12 @@ if __name__ == "__main__":
         letter_ids = letter_ids[:5]
 
     # go over letters
+    prompt_store = PromptStoreWriter(out_path)
     for letter_id in tqdm(letter_ids):
 
         letter_df = footnote_df[footnote_df["letter_id"]==int(letter_id)]
         for _, row in letter_df.iterrows():
             messages = make_prompt(row.n_footnote, row.xml_sentence)
-            outfile_name = f"{letter_id}_{row.n_footnote}.jsonl"
-            outfile_path = os.path.join(out_path, outfile_name)
-            with jsonlines.open(outfile_path, "w") as outfile:
-                outfile.write_all(messages)
+            prompt_store.write(letter_id, row.n_footnote, messages)
+    prompt_store.close()
         
@@ -2,6 +2,8 @@ import tiktoken
 import argparse, os
 import jsonlines, json
 from tqdm import tqdm
+from prompt_store import PromptStore
+from token_index import token_lengths
 
 
 
@@ -61,39 +63,43 @@ if __name__ == "__main__":
 
     
 
+    prompt_store = PromptStore(folder_path)
     if human_eval:
         with open(os.path.join(DATA_DIR,"human_feedback_prompts.json"), "r", encoding="utf-8") as injson:
-            human_eval_list = json.load(injson)
+            human_eval_list = json.load(injson)  # filenames of the old layout: {letter_id}_{n}.jsonl
+        human_eval_keys = [tuple(el.split(".")[0].split("_")) for el in human_eval_list]
+        human_eval_key_set = set(human_eval_keys)
 
-        for el in human_eval_list:
-            if el not in os.listdir(folder_path):
+        for el, key in zip(human_eval_list, human_eval_keys):
+            if key not in prompt_store:
                 print(el)
         
-        filenames = [filename for filename in os.listdir(folder_path) if filename in human_eval_list]
+        keys = [key for key in prompt_store.keys() if key in human_eval_key_set]
     else:
-        filenames = os.listdir(folder_path)
+        keys = prompt_store.keys()
+
+    # input tokens from the cached token index (see token_index.py)
+    in_tokens = token_lengths(folder_path, f"tiktoken:{model_name}")
+    if example_out_message != "":
+        example_out_toks = calculate_tokens_for_chat([{"role": "assistant", "content": example_out_message}], encoding)
 
     tokens = []  # list of tuples, in- and out token count
 
-    for filename in tqdm(filenames):
-        filepath = os.path.join(folder_path, filename)
-        
+    for letter_id, n_footnote in tqdm(keys):
         # The prompt file will be the input tokens
-        with jsonlines.open(filepath, mode="r") as reader:
-            messages = list(reader)
-        
+        in_toks = in_tokens[(letter_id, n_footnote)]
         
         if example_out_message != "":
-            out_message = {"role": "assistant", "content": example_out_message}
+            out_toks = example_out_toks
         else:
+            messages = prompt_store.get(letter_id, n_footnote)
             try:
                 out_message = messages[2]  # taken the example Footnote as estimate for the output
             except IndexError:
                 print("No example answer in the prompt file, please specify --example_out_message")
                 exit(1)
+            out_toks = calculate_tokens_for_chat([out_message], encoding)
         
-        in_toks = calculate_tokens_for_chat(messages, encoding)
-        out_toks = calculate_tokens_for_chat([out_message], encoding)
         tokens.append((in_toks, out_toks))
     
     cost = calculate_openai_cost(tokens, (price_in_per_M, price_out_per_M))
@@ -0,0 +1,272 @@
+#####
+# Store for the prompt files
+# Instead of one {letter_id}_{n}.jsonl file per footnote, the prompts of a split are appended to a few large
+# shards (one json record per line), with an index of (letter_id, n_footnote) -> shard, offset and length.
+# Folder layout: prompts/<prompt_type>/<split>/index.tsv and shard_00000.jsonl, shard_00001.jsonl, ...
+# All prompts of a letter start with the same system prompt and one-shot example, this prefix is stored only once
+# in prefixes.jsonl (indexed by its hash in prefixes.tsv) and the records only reference it.
+
+import argparse
+import os, json, hashlib
+import jsonlines
+from tqdm import tqdm
+
+INDEX_FILENAME = "index.tsv"
+PREFIX_FILENAME = "prefixes.jsonl"
+PREFIX_INDEX_FILENAME = "prefixes.tsv"
+SHARD_SIZE = 256 * 1024**2  # start a new shard after 256MB
+
+
+def shard_filename(prefix, i):
+    return f"{prefix}_{i:05d}.jsonl"
+
+
+def prefix_hash(prefix_messages):
+    """content address of the shared prefix (all messages except the last one)"""
+    return hashlib.sha1(json.dumps(prefix_messages, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_prefix_index(path):
+    """prefix hash -> (offset, length) in prefixes.jsonl"""
+    prefix_index = {}
+    prefix_index_path = os.path.join(path, PREFIX_INDEX_FILENAME)
+    if os.path.exists(prefix_index_path):
+        with open(prefix_index_path, "r", encoding="utf-8") as infile:
+            for line in infile:
+                key, offset, length = line.rstrip("\n").split("\t")
+                prefix_index[key] = (int(offset), int(length))
+    return prefix_index
+
+
+class PromptStoreWriter:
+    """append prompts (lists of messages) to the shards of a store
+    mode 'w' removes the prompts of a previous run, mode 'a' adds to them (later prompts replace earlier ones with the same key)
+    writing the same prompt again in one run (same key and content) is skipped, like rewriting the same file used to be"""
+
+    def __init__(self, path, mode="w", prefix="shard", shard_size=SHARD_SIZE, index_filename=INDEX_FILENAME, dedup_prefix=True):
+        self.path = path
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.dedup_prefix = dedup_prefix
+        os.makedirs(path, exist_ok=True)
+
+        existing_shards = sorted(filename for filename in os.listdir(path) if filename.startswith(f"{prefix}_") and filename.endswith(".jsonl"))
+        if mode == "w":
+            for filename in existing_shards:
+                os.remove(os.path.join(path, filename))
+            existing_shards = []
+
+        # never append to an existing shard, so what is in the index stays valid
+        self.shard_number = len(existing_shards)
+        self.shard = None
+        self.index = open(os.path.join(path, index_filename), mode, encoding="utf-8")
+
+        # in mode 'a' the prefixes are only appended, records of earlier runs may still point to them
+        self.prefix_hashes = set(load_prefix_index(path)) if mode == "a" else set()
+        self.prefixes = open(os.path.join(path, PREFIX_FILENAME), f"{mode}b")
+        self.prefix_index = open(os.path.join(path, PREFIX_INDEX_FILENAME), mode, encoding="utf-8")
+        self.written = {}  # (letter_id, n_footnote) -> hash of the record written in this run
+        self.duplicates = 0
+
+    def _open_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+        self.shard_name = shard_filename(self.prefix, self.shard_number)
+        self.shard = open(os.path.join(self.path, self.shard_name), "wb")
+        self.shard_number += 1
+
+    def _write_prefix(self, prefix_messages):
+        key = prefix_hash(prefix_messages)
+        if key not in self.prefix_hashes:
+            record = json.dumps(prefix_messages).encode("utf-8") + b"\n"
+            offset = self.prefixes.tell()
+            self.prefixes.write(record)
+            self.prefix_index.write(f"{key}\t{offset}\t{len(record)}\n")
+            self.prefix_hashes.add(key)
+        return key
+
+    def write(self, letter_id, n_footnote, messages):
+        record = {"letter_id": str(letter_id), "n_footnote": str(n_footnote), "messages": messages}
+        key = ""
+        if self.dedup_prefix and len(messages) > 1:
+            key = self._write_prefix(messages[:-1])
+            record["prefix"] = key
+            record["messages"] = messages[-1:]
+        record = json.dumps(record).encode("utf-8") + b"\n"
+        record_hash = hashlib.sha1(record).hexdigest()
+        if self.written.get((str(letter_id), str(n_footnote))) == record_hash:
+            self.duplicates += 1
+            return
+        self.written[(str(letter_id), str(n_footnote))] = record_hash
+        if self.shard is None or self.shard.tell() >= self.shard_size:
+            self._open_shard()
+        offset = self.shard.tell()
+        self.shard.write(record)
+        self.index.write(f"{letter_id}\t{n_footnote}\t{self.shard_name}\t{offset}\t{len(record)}\t{key}\n")
+
+    def close(self):
+        if self.duplicates:
+            print(f"{self.duplicates} prompts were written more than once, kept once")
+        if self.shard is not None:
+            self.shard.close()
+        self.index.close()
+        self.prefixes.close()
+        self.prefix_index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PromptStore:
+    """read the prompts of a split, either from a store (folder with index.tsv)
+    or from the old layout with one {letter_id}_{n}.jsonl file per footnote"""
+
+    def __init__(self, path):
+        self.path = path
+        self.legacy = not os.path.exists(os.path.join(path, INDEX_FILENAME))
+        self.locations = {}  # (letter_id, n_footnote) -> (shard, offset, length) or the filename in the old layout
+        self.prefix_keys = {}  # (letter_id, n_footnote) -> hash of the shared prefix
+        self.prefix_index = {}
+        self._files = {}
+        self._prefix_cache = (None, None)  # last prefix read, the prompts of a letter come one after the other
+
+        if self.legacy:
+            for filename in sorted(os.listdir(path)):
+                if not filename.endswith(".jsonl"):
+                    continue
+                letter_id, n_footnote = filename.split(".")[0].split("_")
+                self.locations[(letter_id, n_footnote)] = filename
+        else:
+            with open(os.path.join(path, INDEX_FILENAME), "r", encoding="utf-8") as infile:
+                for line in infile:
+                    letter_id, n_footnote, shard, offset, length, *key = line.rstrip("\n").split("\t")
+                    self.locations[(letter_id, n_footnote)] = (shard, int(offset), int(length))
+                    if key and key[0]:
+                        self.prefix_keys[(letter_id, n_footnote)] = key[0]
+            self.prefix_index = load_prefix_index(path)
+
+    def keys(self):
+        """(letter_id, n_footnote) as strings, in the order they were written"""
+        return list(self.locations)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return (str(key[0]), str(key[1])) in self.locations
+
+    def get(self, letter_id, n_footnote):
+        """messages of the prompt for the footnote"""
+        location = self.locations[(str(letter_id), str(n_footnote))]
+        if self.legacy:
+            with jsonlines.open(os.path.join(self.path, location)) as infile:
+                return [line for line in infile]
+
+        shard, offset, length = location
+        record = json.loads(self._read(shard, offset, length))
+        if "prefix" in record:
+            return self.get_prefix(record["prefix"]) + record["messages"]
+        return record["messages"]
+
+    def _read(self, filename, offset, length):
+        if filename not in self._files:
+            self._files[filename] = open(os.path.join(self.path, filename), "rb")
+        infile = self._files[filename]
+        infile.seek(offset)
+        return infile.read(length)
+
+    def content_hash(self, letter_id, n_footnote):
+        """hash of the stored prompt, without parsing it (the record references its prefix by hash, thus that is covered too)"""
+        location = self.locations[(str(letter_id), str(n_footnote))]
+        if self.legacy:
+            with open(os.path.join(self.path, location), "rb") as infile:
+                return hashlib.sha1(infile.read()).hexdigest()
+        return hashlib.sha1(self._read(*location)).hexdigest()
+
+    def prefix_key(self, letter_id, n_footnote):
+        """hash of the shared prefix of the prompt (None if not deduplicated), prompts with the same key start with the same messages"""
+        return self.prefix_keys.get((str(letter_id), str(n_footnote)))
+
+    def get_prefix(self, key):
+        """messages of the shared prefix"""
+        if self._prefix_cache[0] != key:
+            offset, length = self.prefix_index[key]
+            self._prefix_cache = (key, self._read(PREFIX_FILENAME, offset, length))
+        return json.loads(self._prefix_cache[1])  # new objects every time, callers may change the messages
+
+    def __iter__(self):
+        """(letter_id, n_footnote, messages), the shards are read sequentially"""
+        for letter_id, n_footnote in self.keys():
+            yield letter_id, n_footnote, self.get(letter_id, n_footnote)
+
+    def close(self):
+        for shard_file in self._files.values():
+            shard_file.close()
+        self._files = {}
+
+
+def prefix_stats(store_path, tokenizer_id=""):
+    """bytes (and tokens, if a tokenizer is given) saved by storing the shared prefixes only once"""
+    store = PromptStore(store_path)
+    uses = {}
+    for key in store.prefix_keys.values():
+        uses[key] = uses.get(key, 0) + 1
+
+    if tokenizer_id:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
+
+    stored_bytes = saved_bytes = saved_tokens = 0
+    for key, n_uses in tqdm(uses.items()):
+        _, length = store.prefix_index[key]
+        stored_bytes += length
+        saved_bytes += length * (n_uses - 1)
+        if tokenizer_id:
+            n_tokens = len(tokenizer.apply_chat_template(store.get_prefix(key), tokenize=True))
+            saved_tokens += n_tokens * (n_uses - 1)
+    store.close()
+
+    print(f"prompts: {len(store)}, distinct prefixes: {len(uses)}")
+    print(f"prefix bytes stored: {stored_bytes}, bytes saved: {saved_bytes}")
+    if tokenizer_id:
+        print(f"prefix tokens saved ({tokenizer_id}): {saved_tokens}")
+    return saved_bytes, saved_tokens
+
+
+def export_legacy(store_path, out_path):
+    """write the prompts of a store as one {letter_id}_{n}.jsonl file per footnote, for scripts still reading that"""
+    os.makedirs(out_path, exist_ok=True)
+    store = PromptStore(store_path)
+    for letter_id, n_footnote, messages in tqdm(store):
+        with jsonlines.open(os.path.join(out_path, f"{letter_id}_{n_footnote}.jsonl"), "w") as outfile:
+            outfile.write_all(messages)
+    store.close()
+
+
+def import_legacy(legacy_path, store_path):
+    """put the {letter_id}_{n}.jsonl files of a folder into a store"""
+    legacy_store = PromptStore(legacy_path)
+    with PromptStoreWriter(store_path) as writer:
+        for letter_id, n_footnote, messages in tqdm(legacy_store):
+            writer.write(letter_id, n_footnote, messages)
+
+
+if __name__ == "__main__":
+    # example call: python prompt_store.py export ../../data/prompts/instruct_add/test ../../data/prompts_legacy/instruct_add/test
+    # python prompt_store.py stats ../../data/prompts/instruct_add/test --tokenizer meta-llama/Llama-3.1-8B-Instruct
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["export", "import", "stats"], help="export: store to one file per footnote, import: one file per footnote to store, stats: savings of the shared prefixes")
+    parser.add_argument("inpath")
+    parser.add_argument("outpath", nargs="?", default="")
+    parser.add_argument("--tokenizer", default="", help="stats: tokenizer to count the saved tokens with")
+    args = parser.parse_args()
+
+    if args.mode == "export":
+        export_legacy(args.inpath, args.outpath)
+    elif args.mode == "import":
+        import_legacy(args.inpath, args.outpath)
+    elif args.mode == "stats":
+        prefix_stats(args.inpath, args.tokenizer)
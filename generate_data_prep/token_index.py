@@ -0,0 +1,125 @@
+#####
+# Token lengths of the prompts of a prompt store, cached next to the prompts
+# token_lengths.tsv in the store folder: letter_id, n_footnote, content hash, tokenizer id, number of tokens
+# only prompts that are new or changed (other content hash) are tokenized again, in parallel
+# tokenizer ids: a huggingface model id (chat template with the generation prompt, as in run_llama_over_prompts.py)
+# or tiktoken:<openai model> (estimate of openai_cost_estimate.py)
+
+import argparse
+import os
+from multiprocessing import Pool
+from tqdm import tqdm
+from prompt_store import PromptStore
+
+TOKEN_INDEX_FILENAME = "token_lengths.tsv"
+LONG_PROMPT_TOKENS = 20000  # prompts longer than this used to be left out (long_letters_set)
+
+
+def load_token_index(store_path):
+    """(tokenizer_id, letter_id, n_footnote) -> (content hash, number of tokens)"""
+    token_index = {}
+    index_path = os.path.join(store_path, TOKEN_INDEX_FILENAME)
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as infile:
+            for line in infile:
+                letter_id, n_footnote, content_hash, tokenizer_id, n_tokens = line.rstrip("\n").split("\t")
+                token_index[(tokenizer_id, letter_id, n_footnote)] = (content_hash, int(n_tokens))
+    return token_index
+
+
+def write_token_index(store_path, token_index):
+    index_path = os.path.join(store_path, TOKEN_INDEX_FILENAME)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        for (tokenizer_id, letter_id, n_footnote), (content_hash, n_tokens) in token_index.items():
+            outfile.write(f"{letter_id}\t{n_footnote}\t{content_hash}\t{tokenizer_id}\t{n_tokens}\n")
+    os.replace(tmp_path, index_path)
+
+
+def make_counter(tokenizer_id):
+    """function messages -> number of tokens"""
+    if tokenizer_id.startswith("tiktoken:"):
+        import tiktoken
+        from openai_cost_estimate import calculate_tokens_for_chat
+        encoding = tiktoken.encoding_for_model(tokenizer_id.split(":", 1)[1])
+        return lambda messages: calculate_tokens_for_chat(messages, encoding)
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
+
+    def count(messages):
+        input_ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=True)
+        if not isinstance(input_ids, list):  # newer versions of transformers return a BatchEncoding
+            input_ids = input_ids["input_ids"]
+        return len(input_ids)
+    return count
+
+
+# tokenizer and store loaded once per worker process
+worker_state = {}
+
+def init_worker(store_path, tokenizer_id):
+    worker_state["store"] = PromptStore(store_path)
+    worker_state["count"] = make_counter(tokenizer_id)
+
+def count_keys(keys):
+    store, count = worker_state["store"], worker_state["count"]
+    return [count(store.get(letter_id, n_footnote)) for letter_id, n_footnote in keys]
+
+
+def token_lengths(store_path, tokenizer_id, workers=1, chunk_size=256):
+    """(letter_id, n_footnote) -> number of tokens of every prompt in the store, updating the cached index"""
+    store = PromptStore(store_path)
+    token_index = load_token_index(store_path)
+
+    # what is missing or changed since the last time
+    hashes = {key: store.content_hash(*key) for key in store.keys()}
+    stale = [key for key, content_hash in hashes.items() if token_index.get((tokenizer_id, *key), (None,))[0] != content_hash]
+    store.close()
+
+    if stale:
+        print(f"tokenizing {len(stale)} of {len(hashes)} prompts with {tokenizer_id}")
+        chunks = [stale[start:start+chunk_size] for start in range(0, len(stale), chunk_size)]
+        if workers <= 1:
+            init_worker(store_path, tokenizer_id)
+            results = map(count_keys, chunks)
+            pool = None
+        else:
+            pool = Pool(workers, initializer=init_worker, initargs=(store_path, tokenizer_id))
+            results = pool.imap(count_keys, chunks)
+        for chunk, counts in tqdm(zip(chunks, results), total=len(chunks)):
+            for key, n_tokens in zip(chunk, counts):
+                token_index[(tokenizer_id, *key)] = (hashes[key], n_tokens)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        # prompts no longer in the store are dropped
+        token_index = {index_key: value for index_key, value in token_index.items() if index_key[0] != tokenizer_id or index_key[1:] in hashes}
+        write_token_index(store_path, token_index)
+
+    return {key: token_index[(tokenizer_id, *key)][1] for key in hashes}
+
+
+def long_letters(lengths, max_tokens=LONG_PROMPT_TOKENS):
+    """letters with a prompt longer than max_tokens"""
+    return {letter_id for (letter_id, _), n_tokens in lengths.items() if n_tokens > max_tokens}
+
+
+if __name__ == "__main__":
+    # example call: python token_index.py ../../data/prompts/instruct_add_window/dev meta-llama/Llama-3.1-8B-Instruct --workers 8
+    # python token_index.py ../../data/prompts/instruct_add/test tiktoken:gpt-4o-mini
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_path", help="folder of a prompt store, e.g. ../../data/prompts/instruct_add/dev")
+    parser.add_argument("tokenizer_id", help="huggingface model id, or tiktoken:<openai model>")
+    parser.add_argument("--workers", default=1, type=int, help="number of processes tokenizing, default=1")
+    parser.add_argument("--max_tokens", default=LONG_PROMPT_TOKENS, type=int, help="prompts longer than this are counted as long, default=20000")
+    args = parser.parse_args()
+
+    lengths = token_lengths(args.store_path, args.tokenizer_id, args.workers)
+    n_tokens = sorted(lengths.values())
+    print(f"prompts: {len(n_tokens)}, prompt tokens: {sum(n_tokens)}")
+    if n_tokens:
+        print(f"min: {n_tokens[0]}, median: {n_tokens[len(n_tokens) // 2]}, max: {n_tokens[-1]}")
+    long_letter_ids = long_letters(lengths, args.max_tokens)
+    print(f"letters with prompts over {args.max_tokens} tokens: {len(long_letter_ids)} {sorted(long_letter_ids)}")